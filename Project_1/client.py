@@ -4,7 +4,14 @@
 """ This is the (GUI) client-side of a server/client application in which the client can create
 MAX_CLIENTS number (defined in server.py) of sub-clients. Each client will have its
 own socket, running on its own thread. The server will then give a countdown timer to
-a randomly selected client, which the client will then use to countdown (displayed in GUI)."""
+a randomly selected client, which the client will then use to countdown (displayed in GUI).
+
+The clients are kept in a session registry (see sessions.py), and the threads only ever
+change their records, and push their status lines into an event_log.EventLog. The GUI is
+derived from both by a QTimer every REFRESH_INTERVAL milliseconds: it drops the clients
+that were removed from the client list, shows the countdown of the selected client, and
+adds the new status lines to the status box, so no thread touches a widget, or looks for
+its client in the client list."""
 
 __author__ = "Hannan Khan"
 __credits__ = ["Hannan Khan"]
@@ -19,13 +26,18 @@ import time
 
 from PyQt5 import QtWidgets, QtGui
 from PyQt5.QtGui import QFont
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow, QInputDialog, QMessageBox
 
+import framing
+from event_log import EventLog
 from lwi import ClientWidgetItem
+from sessions import SessionRecord, SessionRegistry
 
 PORT_NUMBER = 55556
 HOST = socket.gethostname()
+# how often the client list and the countdown are brought up to date, in milliseconds.
+REFRESH_INTERVAL = 100
 
 
 class ClientApp(QMainWindow):
@@ -58,12 +70,11 @@ class ClientApp(QMainWindow):
         self._init_top_layout()
         self._init_middle_layout()
 
-        # this var has the index for the current selected client.
-        self.selected_client_idx = None
-        # these arrays keep track of all clients' labels, threads, and sockets.
-        self.list_of_all_countdown_labels = []
-        self.list_of_all_threads = []
-        self.list_of_all_sockets = []
+        # every client, by session id and by name. The connection of a record is its socket,
+        # its view is its item in the client list, which carries the session id.
+        self.sessions = SessionRegistry(track_changes=True)
+        # the status lines of every thread, shown by refresh_clients().
+        self.status_log = EventLog()
 
         # finishing the setup of the GUI here.
         self.status_label = QtWidgets.QLabel()
@@ -77,6 +88,10 @@ class ClientApp(QMainWindow):
 
         self.main_frame.setLayout(self.main_layout)
         self.setCentralWidget(self.main_frame)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh_clients)
+        self.refresh_timer.start(REFRESH_INTERVAL)
         self.show()
 
     def _init_menu(self):
@@ -143,10 +158,13 @@ class ClientApp(QMainWindow):
         self.client_list_widget.setFixedSize(540, 220)
         self.client_list_widget.itemClicked.connect(self.show_selected_client_countdown)
 
-        self.countdown_frame = QtWidgets.QFrame()
+        # shows the countdown of the selected client.
+        self.countdown_label = QtWidgets.QLabel()
+        self.countdown_label.setFont(QFont("Consolas", 25))
+        self.countdown_label.setText("0")
 
         self.middle_layout.addWidget(self.client_list_widget)
-        self.middle_layout.addWidget(self.countdown_frame)
+        self.middle_layout.addWidget(self.countdown_label)
 
         self.main_inter_layout.addLayout(self.middle_layout)
 
@@ -164,204 +182,173 @@ class ClientApp(QMainWindow):
             text, boo = msg_box.getText(self, "Add New Client", "Insert New Client Name\nClient name cannot be empty.")
 
         if boo and not client_exists:
-            # create an associated countdown label for this client, and append it to the list:
-            new_countdown_label = QtWidgets.QLabel()
-            new_countdown_label.setFont(QFont("Consolas", 25))
-            new_countdown_label.setText("0")
-            self.list_of_all_countdown_labels.append(new_countdown_label)
-            self.middle_layout.addWidget(new_countdown_label)
-            self.show_selected_client_countdown()
-
-            # create a new client widget item. This will have the countdown label association.
-            new_client_widget_item = ClientWidgetItem(text=text, associated_countdown_label=new_countdown_label)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            record = self.sessions.add(text, sock, state="Connecting...")
+            # create a new client widget item. It carries the session id of the client.
+            new_client_widget_item = ClientWidgetItem(text=text, session_id=record.session_id)
+            record.view = new_client_widget_item
             self.client_list_widget.addItem(new_client_widget_item)
-            self.client_list_widget.setCurrentItem(self.client_list_widget.item(self.client_list_widget.count() - 1))
-            self.update_selected_client_idx()
-            client_idx = self.get_client_idx(text)
+            self.client_list_widget.setCurrentItem(new_client_widget_item)
+            self.show_selected_client_countdown()
             # Here we start to create the socket for the client, in its own thread.
-            self.create_socket_with_thread(text, new_client_widget_item, client_idx)
+            self.create_socket_with_thread(record)
 
     def delete_client(self):
         """Deletes the client that is currently selected in the client_list_widget. This func
-        will close the appropriate socket, join the appropriate thread (with timeout since
-        join() is a blocking call), and then it will delete the appropriate countdown label."""
+        will close the appropriate socket, which ends the thread of the client, and remove
+        it from the session registry."""
 
         # check for if a client has been selected or not.
-        if self.client_list_widget.currentItem() is None:
+        record = self.get_selected_record()
+        if record is None:
             msg_box = QMessageBox(QMessageBox.Information, "Error", "You must select a client to delete.")
             msg_box.exec()
         else:
-            client_idx = self.get_client_idx(self.client_list_widget.item(self.client_list_widget.currentRow()).text())
-            self.update_status("Deleting %s..." % self.client_list_widget.item(client_idx).text())
-            client_to_be_deleted = self.client_list_widget.takeItem(self.client_list_widget.currentRow())
-            try:
-                # we delete the socket, thread, and the label.
-                sock_to_be_deleted = self.list_of_all_sockets.pop(client_idx)
-                sock_to_be_deleted.close()
-                thread_to_be_closed: threading.Thread = self.list_of_all_threads.pop(client_idx)
-                # thread is deleted with timeout.
-                thread_to_be_closed.join(0.3)
-                self.list_of_all_countdown_labels.remove(client_idx)
-                try:
-                    self.client_list_widget.setCurrentRow(0)
-                except:
-                    self.client_list_widget.setCurrentItem(None)
-                self.update_selected_client_idx()
-                self.show_selected_client_countdown()
-            except ValueError:
-                pass
-
-    def create_socket_with_thread(self, client_name, client_widget_item, client_idx):
-        """This function will create a socket, and a thread, attaching both to the
-        client_name, via the arrays that keep track of everything. The thread that is
-        started is a daemon, as I would want it to end with the program (harder to do
+            self.update_status("Deleting %s..." % record.client_name)
+            self.client_list_widget.takeItem(self.client_list_widget.row(record.view))
+            record.view = None
+            self.sessions.remove(record.session_id)
+            # the thread is a daemon, it ends once it notices that its socket is closed.
+            record.connection.close()
+            self.show_selected_client_countdown()
+
+    def create_socket_with_thread(self, record: SessionRecord):
+        """This function will create a thread for the socket of the client. The thread that
+        is started is a daemon, as I would want it to end with the program (harder to do
         with 'while True' loops, and no daemon thread)."""
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        t = threading.Thread(target=self.add_client_socket, args=(sock, client_name, client_widget_item, client_idx))
+        t = threading.Thread(target=self.add_client_socket, args=(record,))
         t.daemon = True
-        self.list_of_all_sockets.append(sock)
-        self.list_of_all_threads.append(t)
         t.start()
 
-    def add_client_socket(self, sock: socket.socket, client_name: str, client_widget_item: ClientWidgetItem,
-                          client_idx):
+    def add_client_socket(self, record: SessionRecord):
         """This function will handle the majority of client communication with the server.
 
-        It will first connect and send the client_name to the server, then await response.
-         the client_add_msg is the response, and can be one of the following:
-         *Client already exists.
-         *Client added.
-         *Too many clients. Client dropped.
+        It will first connect and send the client_name to the server (OP_HELLO), then await
+         response. The response is a status frame, holding one of the following:
+         *STATUS_EXISTS - Client already exists.
+         *STATUS_ADDED - Client added.
+         *STATUS_TOO_MANY - Too many clients. Client dropped.
          If the client was denied, then add_client_socket_denied() will be called.
          Otherwise, the client will enter a 'while True' loop in which it will keep listening
-         for a message from the server which will contain the countdown_time.
-         Then it will enter a loop to iterate through the decrements of countdown_time."""
-
-        countdown_time = 0
-        sock.connect((HOST, PORT_NUMBER))
-        sock.send(bytes(client_name, "utf-8"))
-        client_added_msg = sock.recv(1024).decode("utf-8")
+         for an OP_COUNTDOWN frame from the server which will contain the countdown_time.
+         Then it will count down the record of the client, a second at a time, until it
+         reaches 0 (or the countdown is stopped), and tell the server it has finished."""
+
+        sock = record.connection
+        client_name = record.client_name
+        try:
+            sock.connect((HOST, PORT_NUMBER))
+            reader = framing.FrameReader(sock)
+            framing.send_frame(sock, framing.OP_HELLO, payload=client_name.encode("utf-8"))
+            opcode, request_id, payload = reader.read_frame()
+        except (ConnectionError, OSError):
+            payload = b""
         # we check to see if we have received anything at all.
-        if client_added_msg:
-            self.update_status(client_added_msg)
-            if client_added_msg == f"SERVER: Too many clients. {client_name} dropped.":
-                self.add_client_socket_denied(sock, client_name, client_widget_item, client_idx)
-                return
-            if client_added_msg == f"SERVER: Client {client_name} already exists.":
-                self.add_client_socket_denied(sock, client_name, client_widget_item, client_idx)
-                return
-            else:
-                # here we have a while loop that handles the countdown, and waits for it.
-                while True:
-                    try:
-                        countdown_time = int(sock.recv(1024).decode("utf-8"))
-                    except Exception as e:
-                        self.update_status(e.__str__())
-                    client_idx = self.get_client_idx(client_name)
-                    countdown_copy = countdown_time
-                    self.update_status(f"{client_name} has received {countdown_time}.")
-                    if client_idx is not None:
-                        # we update the countdown label to match the value of countdown time.
-                        self.list_of_all_countdown_labels[client_idx].setText(str(countdown_time))
-                        # client_widget_item.associated_countdown_label.setText(str(countdown_time))
-                        while countdown_time >= 0:
-                            if self.get_client_idx(client_name) != client_idx:
-                                self.list_of_all_countdown_labels[client_idx].setText("0")
-                                client_idx = self.get_client_idx(client_name)
-                            # first we check to see if it is 0 or not. If it is, we send finish message.
-                            if int(self.list_of_all_countdown_labels[client_idx].text()) == 0:
-                                sock.send(bytes(f"CLIENT: {client_name} finished", "utf-8"))
-                                break
-                            # sleep for 1 sec. This is like pseudo-pause for python thread.
-                            time.sleep(1)
-                            self.update_client_countdown_value(client_idx)
-                            countdown_time = countdown_time - 1
-                    elif client_idx is None:
-                        break
-
-    def add_client_socket_denied(self, sock: socket.socket, client_name: str, client_widget_item: ClientWidgetItem,
-                                 client_idx):
-        """This function will handle if a client has been denied a socket connection from
-        the server. It is practically the same as deleting a client, however, a client does
-        not have to be selected from the client_list_widget."""
-
-        self.update_status(f"Removing {client_name} from list...")
-        item_to_be_deleted = self.client_list_widget.takeItem(self.client_list_widget.count() - 1)
-        self.update_status("Closing %s's socket..." % client_name)
-        # update the socket, and the current thread.
-        self.list_of_all_sockets.remove(sock)
-        # thread is a daemon, it will close with the application process, or when the target func has returned.
-        self.list_of_all_threads.remove(threading.current_thread())
-        countdown_label = self.list_of_all_countdown_labels.pop(client_idx)
-        countdown_label.hide()
-        sock.close()
-
-    def get_client_idx(self, client_name: str) -> int:
-        """:returns the index of a client in the self.client_list_widget.
-        This index corresponds across all arrays."""
-
-        for i in range(0, self.client_list_widget.count()):
-            item = self.client_list_widget.item(i)
-            if item.text() == client_name:
-                return i
-
-    def update_selected_client_idx(self):
-        """Updates the self.selected_client_idx based on which client is selected in the
-        self.client_list_widget."""
-
-        for i in range(0, self.client_list_widget.count()):
-            item = self.client_list_widget.item(i)
-            if item.isSelected():
-                self.selected_client_idx = i
-                return
-        self.selected_client_idx = -1
+        if not payload:
+            self.update_status(f"{client_name} could not connect.")
+            self.add_client_socket_denied(record)
+            return
+        status = payload[0]
+        if status == framing.STATUS_TOO_MANY:
+            self.update_status(f"SERVER: Too many clients. {client_name} dropped.")
+            self.add_client_socket_denied(record)
+            return
+        if status == framing.STATUS_EXISTS:
+            self.update_status(f"SERVER: Client {client_name} already exists.")
+            self.add_client_socket_denied(record)
+            return
 
-    def show_selected_client_countdown(self):
-        """Displays the correct countdown label based on which client is selected in the
-        self.client_list_widget. Hides all other labels."""
+        self.update_status(f"SERVER: Client {client_name} added.")
+        record.state = "Connected"
+        # here we have a while loop that handles the countdown, and waits for it.
+        while True:
+            try:
+                opcode, request_id, payload = reader.read_frame()
+            except (ConnectionError, OSError):
+                # the client was deleted, or the server is gone.
+                break
+            record.countdown = framing.COUNTDOWN.unpack(payload)[0]
+            record.countdowns += 1
+            self.update_status(f"{client_name} has received {record.countdown}.")
+            # the stop button sets the countdown to 0.
+            while record.countdown > 0:
+                # sleep for 1 sec. This is like pseudo-pause for python thread.
+                time.sleep(1)
+                record.countdown = max(0, record.countdown - 1)
+            try:
+                framing.send_frame(sock, framing.OP_FINISHED, request_id)
+            except OSError:
+                break
 
-        self.update_selected_client_idx()
-        if len(self.list_of_all_countdown_labels) == 0:
+    def add_client_socket_denied(self, record: SessionRecord):
+        """This function will handle if a client has been denied a socket connection from
+        the server. It is practically the same as deleting a client, however, a client does
+        not have to be selected from the client_list_widget: it is removed from the session
+        registry, and from the client list on the next refresh."""
+
+        self.update_status(f"Removing {record.client_name} from list...")
+        self.sessions.remove(record.session_id)
+        self.update_status("Closing %s's socket..." % record.client_name)
+        record.connection.close()
+
+    def get_selected_record(self) -> SessionRecord:
+        """:returns the record of the client selected in the self.client_list_widget, found
+        by the session id its item carries, or None if none is selected."""
+
+        item = self.client_list_widget.currentItem()
+        if item is None:
+            return None
+        return self.sessions.get(item.session_id)
+
+    def refresh_clients(self):
+        """Runs on the GUI thread every REFRESH_INTERVAL milliseconds. Removes the clients the
+        threads removed from the session registry (e.g. denied by the server) from the client
+        list, shows the countdown of the selected client, and adds the status lines that came
+        in since the last run to the status box in one go. It will also keep scrolling to the
+        bottom each time it updates."""
+
+        _, removed = self.sessions.take_changes()
+        for record in removed:
+            if record.view is not None:
+                self.client_list_widget.takeItem(self.client_list_widget.row(record.view))
+                record.view = None
+        self.show_selected_client_countdown()
+
+        lines, dropped = self.status_log.drain()
+        if dropped:
+            lines.insert(0, f"... {dropped} status lines skipped ...")
+        if not lines:
             return
-        if (self.client_list_widget.count() == 0) and (len(self.list_of_all_countdown_labels) > 0):
-            for i, label in enumerate(self.list_of_all_countdown_labels):
-                label.hide()
-        else:
-            for i, label in enumerate(self.list_of_all_countdown_labels):
-                if i == self.selected_client_idx:
-                    label.show()
-                else:
-                    label.hide()
+        self.status_box.append("\n".join(lines))
+        # reference: https://stackoverflow.com/questions/7778726/autoscroll-pyqt-qtextwidget
+        self.status_box.moveCursor(QtGui.QTextCursor.End)
 
-    def update_client_countdown_value(self, client_idx):
-        """Updates the countdown label value for a certain client."""
+    def show_selected_client_countdown(self):
+        """Displays the countdown of the client selected in the self.client_list_widget, 0
+        if none is selected."""
 
-        current_text = int(self.list_of_all_countdown_labels[client_idx].text())
-        if current_text >= 1:
-            current_text = str(current_text - 1)
-            self.list_of_all_countdown_labels[client_idx].setText(current_text)
+        record = self.get_selected_record()
+        countdown = str(record.countdown) if record is not None else "0"
+        if self.countdown_label.text() != countdown:
+            self.countdown_label.setText(countdown)
 
     def stop_countdown_of_selected_client(self):
         """Helper function to stop the countdown of a selected client. Does this by
-        setting the countdown value to 0. The while loop that the thread runs will check
-        for this condition every time, and will send a message everytime a countdown
-        has terminated."""
+        setting the countdown value to 0. The thread of the client checks for this
+        condition every second, and will send a message everytime a countdown has
+        terminated."""
 
-        self.update_selected_client_idx()
-        client_list_item = self.client_list_widget.item(self.selected_client_idx)
-        current_countdown_value = int(self.list_of_all_countdown_labels[self.selected_client_idx].text())
-        if current_countdown_value > 0:
-            self.list_of_all_countdown_labels[self.selected_client_idx].setText("0")
+        record = self.get_selected_record()
+        if record is not None and record.countdown > 0:
+            record.countdown = 0
+            self.show_selected_client_countdown()
 
     def update_status(self, msg):
-        """Updates the status by adding a line to the status box. It will also keep scrolling
-        to the bottom each time it updates."""
+        """Adds a line for the status box. Safe to call from any thread, the line is shown by
+        refresh_clients()."""
 
-        self.status_box.append(msg)
-        # reference: https://stackoverflow.com/questions/7778726/autoscroll-pyqt-qtextwidget
-        self.status_box.moveCursor(QtGui.QTextCursor.End)
-        self.update()
+        self.status_log.push(msg)
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         # reference: https://www.qtcentre.org/threads/26554-how-to-catch-close-event-in-this-program-pyqt
@@ -371,8 +358,8 @@ class ClientApp(QMainWindow):
         """Closes all sockets before terminating the application. The threads need not be
         terminated/joined since they are all daemon threads."""
 
-        for sock in self.list_of_all_sockets:
-            sock.close()
+        for record in self.sessions.records():
+            record.connection.close()
         sys.exit(0)
 
 
@@ -0,0 +1,63 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the event log of the server and the client. Any thread can push a status line
+into it without touching Qt; the GUI drains it at a fixed rate (see
+ServerApp.drain_status_log() and ClientApp.refresh_clients()) and shows all the lines of a
+drain with a single append. The log is a ring buffer: when lines come in faster than they
+are drained, the oldest ones are dropped and only counted, so neither memory nor the work
+done by the GUI grows with the amount of traffic.
+
+Every line has a level, so the GUI can leave out the per-request chatter:
+    LEVEL_DEBUG     every countdown sent and finished.
+    LEVEL_INFO      clients coming and going, the server starting up.
+    LEVEL_WARNING   errors."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import threading
+from collections import deque
+
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARNING = 30
+LEVEL_NAMES = {LEVEL_DEBUG: "Debug", LEVEL_INFO: "Info", LEVEL_WARNING: "Warning"}
+
+# how many lines are kept between two drains.
+RING_CAPACITY = 4096
+
+
+class EventLog:
+    def __init__(self, capacity: int = RING_CAPACITY, min_level: int = LEVEL_DEBUG):
+        self.capacity = capacity
+        # lines below this level are left out as soon as they are pushed.
+        self.min_level = min_level
+        # the lines, oldest first.
+        self.events = deque(maxlen=capacity)
+        # lines pushed out of the ring before they were drained.
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def push(self, message, level: int = LEVEL_INFO):
+        """Adds a line to the log, unless it is below min_level. Safe to call from any thread."""
+
+        if level < self.min_level:
+            return
+        line = str(message)
+        with self.lock:
+            if len(self.events) == self.capacity:
+                self.dropped += 1
+            self.events.append(line)
+
+    def drain(self) -> ([str], int):
+        """:returns the lines pushed since the last drain, and how many lines were dropped in
+        the meantime. The log is empty afterwards."""
+
+        with self.lock:
+            events, self.events = self.events, deque(maxlen=self.capacity)
+            dropped, self.dropped = self.dropped, 0
+        return list(events), dropped
@@ -0,0 +1,135 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the framing module of the client/server application. Every message sent over a
+socket is a frame: a fixed size header followed by a payload. The header holds the length
+of the payload, an opcode saying what the frame is, and a request id which the server
+copies into its replies, so a reply can always be matched to the request it answers.
+
+    payload length (I) | opcode (B) | request id (I) | payload
+
+Since the length is known up front, messages can no longer run into each other (or be
+split up) the way bare recv(1024) calls could. FrameReader receives into one reusable
+buffer, so a single recv_into() can hand back many frames at once. A frame longer
+than MAX_FRAME_SIZE is refused with ConnectionError, since its length cannot be trusted.
+
+Replies use compact numeric status codes instead of sentences that both sides have to
+format and compare."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import socket
+import struct
+from collections import deque
+
+HEADER = struct.Struct("!IBI")
+# the largest payload taken from a peer, so a forged length cannot make the buffer grow without bound.
+MAX_FRAME_SIZE = 1 << 24
+
+# opcodes sent by the client.
+OP_HELLO = 1
+OP_FINISHED = 2
+# opcodes sent by the server.
+OP_STATUS = 64
+OP_COUNTDOWN = 65
+
+# status codes, the first byte of every OP_STATUS payload (the reply to OP_HELLO).
+STATUS_ADDED = 0
+STATUS_EXISTS = 1
+STATUS_TOO_MANY = 2
+
+STATUS = struct.Struct("!B")
+# OP_COUNTDOWN payload: the number of seconds to count down from.
+COUNTDOWN = struct.Struct("!I")
+
+
+def encode_frame(opcode: int, request_id: int = 0, payload: bytes = b"") -> bytes:
+    """:returns the frame as bytes, header included."""
+
+    return HEADER.pack(len(payload), opcode, request_id) + payload
+
+
+def send_frame(sock: socket.socket, opcode: int, request_id: int = 0, payload: bytes = b""):
+    """Sends a single frame over sock."""
+
+    sock.sendall(encode_frame(opcode, request_id, payload))
+
+
+def encode_status(status: int, request_id: int = 0, payload: bytes = b"") -> bytes:
+    """:returns an OP_STATUS frame holding status, followed by payload."""
+
+    return encode_frame(OP_STATUS, request_id, STATUS.pack(status) + payload)
+
+
+class FrameReader:
+    def __init__(self, sock: socket.socket, buffer_size: int = 65536):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        # the received, but not yet decoded, bytes are buffer[start:end].
+        self.start = 0
+        self.end = 0
+        # frames that were decoded, but not yet handed out by read_frame().
+        self.frames = deque()
+
+    def _fill(self):
+        """Receives as much as fits into the buffer with a single recv_into().
+        Moves the undecoded bytes to the front first, and grows the buffer if a frame
+        would not fit into it."""
+
+        if self.start > 0:
+            leftover = self.end - self.start
+            self.buffer[:leftover] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, leftover
+        if self.end == len(self.buffer):
+            self.buffer.extend(bytes(len(self.buffer)))
+
+        with memoryview(self.buffer) as view:
+            received = self.sock.recv_into(view[self.end:])
+        if not received:
+            raise ConnectionError("Connection closed by peer.")
+        self.end += received
+
+    def _decode(self) -> [(int, int, bytes)]:
+        """:returns every complete frame in the buffer as (opcode, request id, payload).
+        Raises ConnectionError if a frame is larger than MAX_FRAME_SIZE."""
+
+        frames = []
+        while self.end - self.start >= HEADER.size:
+            length, opcode, request_id = HEADER.unpack_from(self.buffer, self.start)
+            if length > MAX_FRAME_SIZE:
+                # the stream cannot be read any further.
+                raise ConnectionError(f"A frame of {length} bytes is larger than {MAX_FRAME_SIZE} bytes.")
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                if HEADER.size + length > len(self.buffer):
+                    # make room for the whole frame in one go.
+                    self.buffer.extend(bytes(HEADER.size + length - len(self.buffer)))
+                break
+            frames.append((opcode, request_id, bytes(self.buffer[self.start + HEADER.size:frame_end])))
+            self.start = frame_end
+        return frames
+
+    def read_frames(self) -> [(int, int, bytes)]:
+        """:returns all the frames that are available, receiving until there is at least one.
+        Raises ConnectionError once the connection has been closed."""
+
+        if self.frames:
+            frames = list(self.frames)
+            self.frames.clear()
+            return frames
+        frames = self._decode()
+        while not frames:
+            self._fill()
+            frames = self._decode()
+        return frames
+
+    def read_frame(self) -> (int, int, bytes):
+        """:returns the next frame as (opcode, request id, payload)."""
+
+        if not self.frames:
+            self.frames.extend(self.read_frames())
+        return self.frames.popleft()
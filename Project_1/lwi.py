@@ -6,8 +6,9 @@ create MAX_CLIENTS number of sub-clients. Each client will have its own socket,
 running on its own thread. The server will then give a countdown timer to a randomly
 selected client, which the client will then use to countdown (displayed in client's GUI).
 This class is used to define the QListWidgetItem that is used to display the clients.
-Each client is a QListWidgetItem within the QListWidget. Created due to clients
-usually having a unique countdown label associated with them."""
+Each client is a QListWidgetItem within the QListWidget, which carries the session id of
+the client, so its record is found in the session registry (see sessions.py) without
+looking through the list."""
 
 __author__ = "Hannan Khan"
 __credits__ = ["Hannan Khan"]
@@ -16,11 +17,11 @@ __maintainer__ = "Hannan Khan"
 __email__ = "hannan.khan@mavs.uta.edu"
 
 import PyQt5
-from PyQt5.QtWidgets import QListWidgetItem, QLabel
+from PyQt5.QtWidgets import QListWidgetItem
 
 
 class ClientWidgetItem(QListWidgetItem):
-    def __init__(self, text: str = "", associated_countdown_label: QLabel = None):
+    def __init__(self, text: str = "", session_id: int = None):
         super(ClientWidgetItem, self).__init__()
         self.setText(text)
-        self.associated_countdown_label = associated_countdown_label
+        self.session_id = session_id
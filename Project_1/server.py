@@ -4,7 +4,13 @@
 """ This is the (GUI) server-side of a server/client application in which the client can
 create MAX_CLIENTS number of sub-clients. Each client will have its own socket,
 running on its own thread. The server will then give a countdown timer to a randomly
-selected client, which the client will then use to countdown (displayed in client's GUI)."""
+selected client, which the client will then use to countdown (displayed in client's GUI).
+
+The threads never touch the status box themselves: update_status() pushes the line into an
+event_log.EventLog, which a QTimer drains on the GUI thread every STATUS_DRAIN_INTERVAL
+milliseconds. The status box keeps at most STATUS_MAX_LINES lines. Neither do they touch
+the client lists: the clients are kept in a session registry (see sessions.py), whose
+changes the same timer takes and shows in one go."""
 
 __author__ = "Hannan Khan"
 __credits__ = ["Hannan Khan"]
@@ -14,12 +20,21 @@ __email__ = "hannan.khan@mavs.uta.edu"
 
 import sys, socket, threading, time, random
 from PyQt5 import QtWidgets, QtGui
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow
 
+import event_log
+import framing
+from event_log import EventLog
+from sessions import SessionRecord, SessionRegistry
+
 MAX_CLIENTS = 3
 PORT_NUMBER = 55556
 HOST = socket.gethostname()
+# how often the status box is brought up to date, in milliseconds.
+STATUS_DRAIN_INTERVAL = 100
+# the oldest lines of the status box are dropped past this many.
+STATUS_MAX_LINES = 1000
 
 
 class ServerApp(QMainWindow):
@@ -46,9 +61,11 @@ class ServerApp(QMainWindow):
         self.main_inter_layout.setSpacing(0)
         self.main_inter_layout.setContentsMargins(0, 0, 0, 0)
 
-        self.list_of_all_clients = []
-        self.list_of_all_client_sockets = []
+        # every client, by session id and by name. The connection of a record is the FrameReader of its socket.
+        self.sessions = SessionRegistry(track_changes=True)
         self.list_of_all_threads: [threading.Thread] = []
+        # status lines waiting to be shown, written to by every thread.
+        self.status_log = EventLog(min_level=event_log.LEVEL_INFO)
 
         self._init_menu()
         self._init_top_layout()
@@ -58,6 +75,10 @@ class ServerApp(QMainWindow):
         self.main_frame.setLayout(self.main_layout)
         self.setCentralWidget(self.main_frame)
 
+        self.status_timer = QTimer(self)
+        self.status_timer.timeout.connect(self.drain_status_log)
+        self.status_timer.start(STATUS_DRAIN_INTERVAL)
+
         self._init_socket()
         self.listening_bool = True
         self._start_listening_thread()
@@ -121,15 +142,30 @@ class ServerApp(QMainWindow):
         self.bottom_layout = QtWidgets.QVBoxLayout()
         self.bottom_layout.setSpacing(10)
 
+        self.status_header_layout = QtWidgets.QHBoxLayout()
+
         self.status_label = QtWidgets.QLabel()
         self.status_label.setText("Status")
         self.status_label.setFont(self.current_font)
 
-        self.status_box_widget = QtWidgets.QTextEdit()
+        self.status_level_combo = QtWidgets.QComboBox()
+        self.status_level_combo.setFont(self.current_font)
+        for level, level_name in event_log.LEVEL_NAMES.items():
+            self.status_level_combo.addItem(level_name, level)
+        self.status_level_combo.setCurrentIndex(self.status_level_combo.findData(self.status_log.min_level))
+        self.status_level_combo.currentIndexChanged.connect(self.set_status_level)
+
+        self.status_header_layout.addWidget(self.status_label)
+        self.status_header_layout.addStretch()
+        self.status_header_layout.addWidget(self.status_level_combo)
+
+        # a plain text box with a block limit, so appending stays cheap however long it runs.
+        self.status_box_widget = QtWidgets.QPlainTextEdit()
         self.status_box_widget.setReadOnly(True)
         self.status_box_widget.setFont(self.current_font)
+        self.status_box_widget.setMaximumBlockCount(STATUS_MAX_LINES)
 
-        self.bottom_layout.addWidget(self.status_label)
+        self.bottom_layout.addLayout(self.status_header_layout)
         self.bottom_layout.addWidget(self.status_box_widget)
 
         self.main_inter_layout.addLayout(self.bottom_layout)
@@ -169,57 +205,101 @@ class ServerApp(QMainWindow):
             # we wait for and accept a connection.
             client_socket, address = self.sock.accept()
             self.update_status("%s has established connection." % address[1])
-            # we recieve the client name from client.
-            client_name = client_socket.recv(1024).decode("utf-8")
+            # we recieve the client name from client, it is the first frame it sends.
+            reader = framing.FrameReader(client_socket)
+            try:
+                opcode, request_id, payload = reader.read_frame()
+            except ConnectionError:
+                client_socket.close()
+                continue
+            client_name = payload.decode("utf-8")
             # we check to see if there are too many clients.
-            if len(self.list_of_all_clients) < MAX_CLIENTS:
+            if len(self.sessions) < MAX_CLIENTS:
                 # we check to see if the client name already exists in the current clients.
-                if client_name in self.list_of_all_clients:
+                if self.sessions.find(client_name) is not None:
                     # we close the connection if the name already exists.
-                    client_added_msg = f"SERVER: Client {client_name} already exists."
-                    client_socket.send(bytes(client_added_msg, "utf-8"))
+                    client_socket.sendall(framing.encode_status(framing.STATUS_EXISTS, request_id))
                     client_socket.close()
                 else:
                     # now we will set a thread to manage this socket, and its countdowns.
-                    self.manage_client(client_socket, address, client_name)
+                    self.manage_client(client_socket, address, client_name, reader, request_id)
             else:
                 # here we reject connection if there are too many clients. And update
                 # the client that we have rejected it.
-                client_added_msg = f"SERVER: Too many clients. {client_name} dropped."
                 self.update_status(f"Too many clients. {client_name} has been removed.")
-                client_socket.send(bytes(client_added_msg, "utf-8"))
+                client_socket.sendall(framing.encode_status(framing.STATUS_TOO_MANY, request_id))
                 client_socket.close()
 
-    def update_status(self, msg):
-        """Updates the status by adding a line to the status box. It will also keep scrolling
-        to the bottom each time it updates."""
+    def update_status(self, msg, level: int = event_log.LEVEL_INFO):
+        """Adds a line for the status box. Safe to call from any thread, the line is shown by
+        drain_status_log()."""
+
+        self.status_log.push(msg, level)
+
+    def drain_status_log(self):
+        """Runs on the GUI thread every STATUS_DRAIN_INTERVAL milliseconds. Brings the client
+        lists up to date, then adds the status lines that came in since the last run to the
+        status box in one go. It will also keep scrolling to the bottom each time it updates."""
 
-        self.status_box_widget.append(msg)
+        self.refresh_client_lists()
+        lines, dropped = self.status_log.drain()
+        if dropped:
+            lines.insert(0, f"... {dropped} status lines skipped ...")
+        if not lines:
+            return
+        self.status_box_widget.appendPlainText("\n".join(lines))
         # reference: https://stackoverflow.com/questions/7778726/autoscroll-pyqt-qtextwidget
         self.status_box_widget.moveCursor(QtGui.QTextCursor.End)
-        self.update()
 
-    def manage_client(self, client_socket, address, client_name):
-        """This function will take a client as an input, and will update the client list,
-        update the status, update all arrays to reflect the new client joining, update
-        the client_status_widget with 'Connected', and FINALLY it will send an update
-        to the client saying that the client was accepted."""
+    def set_status_level(self, index: int):
+        """Changes the lowest level of status lines shown, as selected in the level box."""
 
-        # creates an item for the client list widget.
-        list_item = QtWidgets.QListWidgetItem()
-        list_item.setText(client_name)
-        self.client_list_widget.addItem(list_item)
+        self.status_log.min_level = self.status_level_combo.itemData(index)
+
+    def manage_client(self, client_socket, address, client_name, reader, request_id):
+        """This function will take a client as an input, and will register it in the session
+        registry (as 'Connected', the client lists show it on the next refresh), update the
+        status, and FINALLY it will send an update to the client saying that the client
+        was accepted."""
+
+        self.sessions.add(client_name, reader, address)
         self.update_status(f"{address[1]} added under {client_name}.")
-        # we update all lists with this clients info.
-        self.list_of_all_client_sockets.append(client_socket)
-        self.list_of_all_clients.append(client_name)
-        # we update the client status box with this clients info.
-        list_item1 = QtWidgets.QListWidgetItem()
-        list_item1.setText("Connected")
-        self.client_status_widget.addItem(list_item1)
         # we message the client side to say that the client has been added.
-        client_added_msg = f"SERVER: Client {client_name} added."
-        client_socket.send(bytes(client_added_msg, "utf-8"))
+        client_socket.sendall(framing.encode_status(framing.STATUS_ADDED, request_id))
+
+    def refresh_client_lists(self):
+        """Takes the clients added, changed and removed since the last run from the session
+        registry, and shows them in the client list and the client status list in one go."""
+
+        changed, removed = self.sessions.take_changes()
+        for record in removed:
+            # a client added and removed since the last run was never shown.
+            if record.view is not None:
+                self.remove_client(record)
+        for record in changed:
+            if record.view is None:
+                self.new_client_handler(record)
+            record.view[1].setText(record.state)
+
+    def new_client_handler(self, record: SessionRecord):
+        """Adds a client to the client list and the client status list. The items are kept
+        as the view of the client's record."""
+
+        list_item = QtWidgets.QListWidgetItem()
+        list_item.setText(record.client_name)
+        self.client_list_widget.addItem(list_item)
+        status_item = QtWidgets.QListWidgetItem()
+        status_item.setText(record.state)
+        self.client_status_widget.addItem(status_item)
+        record.view = (list_item, status_item)
+
+    def remove_client(self, record: SessionRecord):
+        """Removes a client whose connection was closed from the client lists."""
+
+        list_item, status_item = record.view
+        self.client_list_widget.takeItem(self.client_list_widget.row(list_item))
+        self.client_status_widget.takeItem(self.client_status_widget.row(status_item))
+        record.view = None
 
     def _start_countdowns_thread(self):
         """This func will start the countdowns_thread which will constantly (every 10
@@ -237,58 +317,52 @@ class ServerApp(QMainWindow):
         of this function is written to handle some WinErrors I kept getting when I was
         deleting clients via the client GUI."""
 
-        # random_client_idx stays an int, while random_num does not (gets made into a string).
-        random_client_idx = 0
+        # random_num gets made into a string.
         random_num = 0
         self.update_status("Countdown thread starting...")
         self.update_status("Current thread started is %s" % threading.current_thread())
         while True:
             # checks to see if there are any clients currently.
-            if len(self.list_of_all_clients) > 0:
+            if len(self.sessions) > 0:
                 # sleeps for the remaining of the 10 seconds.
                 time_to_sleep = 10 - int(random_num)
                 time.sleep(time_to_sleep)
-                # sets the previous clients status to connected.
-                # chooses a random client index.
-                random_client_idx = random.randrange(0, len(self.list_of_all_clients))
+                all_records = self.sessions.records()
+                if not all_records:
+                    continue
+                # chooses a random client.
+                record = random.choice(all_records)
                 # updates that clients status to reflect counting down.
-                self.client_status_widget.item(random_client_idx).setText("Counting Down...")
-                self.update()
+                self.sessions.set_state(record, "Counting Down...")
                 # chooses a random countdown value.
                 random_num = str(random.randrange(2, 9))
-                # here we get the client socket and name from the lists.
-                client_socket = self.list_of_all_client_sockets[random_client_idx]
-                client_name = self.list_of_all_clients[random_client_idx]
+                record.countdowns += 1
+                record.countdown = int(random_num)
+                # here we get the client socket and name from its record.
+                reader = record.connection
+                client_socket = reader.sock
+                client_name = record.client_name
                 try:
-                    # we try to send the countdown value and wait for the message.
-                    client_socket.send(bytes(random_num, "utf-8"))
-                    self.update_status("Sent %s to client %s" % (random_num, client_name))
-                    recv_msg = client_socket.recv(1024).decode("utf-8")
-                    self.update_status(recv_msg)
-                    self.client_status_widget.item(random_client_idx).setText("Connected")
-                    self.update()
+                    # we try to send the countdown value and wait for the finished frame.
+                    framing.send_frame(client_socket, framing.OP_COUNTDOWN,
+                                       payload=framing.COUNTDOWN.pack(int(random_num)))
+                    self.update_status("Sent %s to client %s" % (random_num, client_name), event_log.LEVEL_DEBUG)
+                    opcode, request_id, payload = reader.read_frame()
+                    if opcode == framing.OP_FINISHED:
+                        self.update_status(f"CLIENT: {client_name} finished", event_log.LEVEL_DEBUG)
+                    record.countdown = 0
+                    self.sessions.set_state(record, "Connected")
                 except Exception as e:
                     # here we will notice if a client has been deleted.
-                    self.update_status(e.__str__())
+                    self.update_status(e.__str__(), event_log.LEVEL_WARNING)
                     self.update_status(f"{client_name}'s connection was closed by client.")
-                    self.list_of_all_clients.pop(random_client_idx)
+                    # the client is removed from the client lists on the next refresh.
+                    self.sessions.remove(record.session_id)
                     # socket for that client will be closed.
-                    socket_to_del = self.list_of_all_client_sockets.pop(random_client_idx)
-                    socket_to_del.close()
-                    # client will be removed from the client list widget.
-                    self.client_list_widget.takeItem(random_client_idx)
-                    self.client_status_widget.takeItem(random_client_idx)
+                    client_socket.close()
             else:
                 pass
 
-    def get_client_name_idx(self, client_name) -> int:
-        """:returns the index of a client in the self.list_of_all_clients.
-        This index corresponds across all arrays."""
-
-        for i, name in enumerate(self.list_of_all_clients):
-            if client_name == name:
-                return i
-
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         # reference: https://www.qtcentre.org/threads/26554-how-to-catch-close-event-in-this-program-pyqt
         self.exit_app()
@@ -299,8 +373,8 @@ class ServerApp(QMainWindow):
         MainThread."""
 
         print(self.list_of_all_threads)
-        for client_socket in self.list_of_all_client_sockets:
-            client_socket.close()
+        for record in self.sessions.records():
+            record.connection.sock.close()
         self.sock.close()
         sys.exit(0)
 
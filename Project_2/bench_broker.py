@@ -0,0 +1,295 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmarks of the message broker's hot paths, run on a headless broker (no sockets,
+no GUI):
+    _init_repository_dict()          loading the repository file.
+    add_to_queue()                   uploading (and converting, see --storage) one value.
+    add_many_to_queue()              uploading a batch of values.
+    update_all_queues_file()         a full snapshot of a backlog, and one after a few uploads.
+    _init_all_queues()               recovering a backlog after a clean stop, and after a crash
+                                     (replaying the log).
+    lease_messages() / ack()         draining a backlog a page at a time (what the server did in
+                                     send_messages_from_queue()).
+    SessionRegistry                  looking a client up by name and by session id, and setting
+                                     its status, as the server does for every check (see
+                                     sessions.py).
+The backlog benchmarks run for every backlog size (--sizes). Every number is the best of a
+few runs, per operation (or per message).
+
+The results can be saved as a baseline (--save), which later runs are compared against: any
+benchmark more than --tolerance slower than its baseline is reported as a regression, and the
+run fails. A baseline only means something on the machine it was saved on.
+
+Run from the Project_2 directory (the repository file is read from there). The broker runs in
+a temporary directory, so its queue files are thrown away afterwards:
+    python bench_broker.py --save
+    python bench_broker.py [--baseline bench_baseline.json] [--sizes 10000 100000] [--quick]"""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import queue_log
+from broker import Broker, HOST, STORAGE, STORAGE_RAW, STORAGE_TEXT
+from sessions import SessionRegistry
+
+BASELINE_PATH = "bench_baseline.json"
+SIZES = [10000, 100000, 1000000]
+QUICK_SIZES = [1000, 10000]
+# how many clients the session registry holds.
+CLIENT_COUNTS = [10, 100, 1000, 100000]
+# how many times every benchmark is run, the best run counts.
+REPEAT = 3
+# how many values are uploaded by the upload benchmarks, and how many at once by add_many_to_queue().
+UPLOAD_COUNT = 20000
+BATCH_SIZE = 1000
+# how many values are uploaded between the two snapshots of update_all_queues_file().
+INCREMENT = 1000
+PAGE_ITEMS = 500
+# the queue the benchmarks upload to.
+QUEUE = "A"
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace, repository: str):
+        self.args = args
+        self.repository = repository
+        self.results = {}
+
+    def record(self, name: str, seconds: float, per: str = "op"):
+        """Keeps (and prints) a result: the seconds an operation (or a message) took."""
+
+        self.results[name] = seconds
+        print(f"{name:<52} {seconds * 1e6:>12.2f} us/{per}", flush=True)
+
+    def new_broker(self, recover: bool = True) -> Broker:
+        """:returns a broker on the queue files of the current directory, with its repository
+        loaded, and its queues too unless recover is False."""
+
+        broker = Broker(HOST, 0, queue_log.DURABILITY_BATCHED, storage=self.args.storage)
+        broker._init_repository_dict()
+        if recover:
+            broker._init_all_queues()
+        return broker
+
+    def fill(self, broker: Broker, count: int):
+        """Uploads count values to QUEUE, and waits until they are durable."""
+
+        durable = None
+        for start in range(0, count, BATCH_SIZE):
+            messages, durable = broker.add_many_to_queue(values(min(BATCH_SIZE, count - start)), QUEUE)
+        if durable is not None:
+            durable.result()
+
+    def run(self):
+        self.bench_repository()
+        self.bench_uploads()
+        for size in self.args.sizes:
+            self.bench_backlog(size)
+        self.bench_client_lookup()
+
+    def bench_repository(self):
+        with scratch_directory(self.repository):
+            broker = self.new_broker(recover=False)
+
+            def init_repository_dict():
+                broker.repository_dict = {}
+                broker.default_queue_units = {}
+                broker._init_repository_dict()
+
+            self.record("_init_repository_dict()", best_of(init_repository_dict, number=100) / 100)
+            broker.queue_log.close()
+
+    def bench_uploads(self):
+        all_meters = values(UPLOAD_COUNT)
+        single, batch = [], []
+        for _ in range(REPEAT):
+            with scratch_directory(self.repository):
+                broker = self.new_broker()
+                started = time.perf_counter()
+                for meters in all_meters:
+                    broker.add_to_queue(meters, QUEUE)
+                single.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                for start in range(0, UPLOAD_COUNT, BATCH_SIZE):
+                    broker.add_many_to_queue(all_meters[start:start + BATCH_SIZE], QUEUE)
+                batch.append(time.perf_counter() - started)
+                broker.queue_log.close()
+        self.record("add_to_queue()", min(single) / UPLOAD_COUNT, "value")
+        self.record(f"add_many_to_queue() x{BATCH_SIZE}", min(batch) / UPLOAD_COUNT, "value")
+
+    def bench_backlog(self, size: int):
+        """Snapshots, recovers and drains a backlog of size messages."""
+
+        timings = {"full": [], "incremental": [], "clean": [], "crash": [], "drain": []}
+        compact_min_records = queue_log.COMPACT_MIN_RECORDS
+        # no compaction on its own, so the snapshots are the ones measured, and a crash leaves
+        # the whole log behind.
+        queue_log.COMPACT_MIN_RECORDS = sys.maxsize
+        try:
+            for _ in range(REPEAT):
+                with scratch_directory(self.repository):
+                    broker = self.new_broker()
+                    self.fill(broker, size)
+                    timings["full"].append(timed(broker.update_all_queues_file))
+                    self.fill(broker, INCREMENT)
+                    timings["incremental"].append(timed(broker.update_all_queues_file))
+                    broker.queue_log.close()
+                    broker = self.new_broker(recover=False)
+                    timings["clean"].append(timed(broker._init_all_queues))
+                    broker.queue_log.close()
+
+                with scratch_directory(self.repository):
+                    # the broker is left as it is, as if it had crashed.
+                    self.fill(self.new_broker(), size)
+                    broker = self.new_broker(recover=False)
+                    timings["crash"].append(timed(broker._init_all_queues))
+                    consumer = broker.open_consumer("bench")
+
+                    def drain():
+                        remaining = 1
+                        while remaining:
+                            deliveries, remaining = broker.lease_messages(consumer, QUEUE, PAGE_ITEMS)
+                            if deliveries:
+                                broker.ack(consumer, deliveries[-1][0])
+
+                    timings["drain"].append(timed(drain))
+                    broker.queue_log.close()
+        finally:
+            queue_log.COMPACT_MIN_RECORDS = compact_min_records
+
+        self.record(f"update_all_queues_file() {size} messages", min(timings["full"]))
+        self.record(f"update_all_queues_file() {size} + {INCREMENT} messages", min(timings["incremental"]))
+        self.record(f"_init_all_queues() {size} messages, clean stop", min(timings["clean"]))
+        self.record(f"_init_all_queues() {size} messages, log replay", min(timings["crash"]))
+        self.record(f"lease_messages()/ack() drain {size} messages", min(timings["drain"]) / size, "message")
+
+    def bench_client_lookup(self):
+        for count in CLIENT_COUNTS:
+            # the server's registry, whose changes the GUI takes on its timer.
+            registry = SessionRegistry(track_changes=True)
+            records = [registry.add(f"client{idx}") for idx in range(count)]
+            lookups = random.Random(count).choices(records, k=1000)
+
+            def find():
+                for record in lookups:
+                    registry.find(record.client_name)
+
+            def get():
+                for record in lookups:
+                    registry.get(record.session_id)
+
+            def set_state():
+                for record in lookups:
+                    registry.set_state(record, "Checking...")
+                registry.take_changes()
+
+            self.record(f"SessionRegistry.find() {count} clients", best_of(find) / len(lookups))
+            self.record(f"SessionRegistry.get() {count} clients", best_of(get) / len(lookups))
+            self.record(f"SessionRegistry.set_state() {count} clients", best_of(set_state) / len(lookups))
+
+
+class scratch_directory:
+    """Runs the with block in a new temporary directory holding a copy of the repository file,
+    and deletes it afterwards."""
+
+    def __init__(self, repository: str):
+        self.repository = repository
+        self.directory = None
+        self.working_directory = None
+
+    def __enter__(self) -> str:
+        self.working_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix="bench_broker_")
+        os.chdir(self.directory)
+        shutil.copy(self.repository, "repository.txt")
+        return self.directory
+
+    def __exit__(self, *exc_info):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def values(count: int) -> [float]:
+    """:returns count random meters values."""
+
+    return [random.uniform(0, 10000) for _ in range(count)]
+
+
+def timed(func) -> float:
+    """:returns how many seconds a call of func took."""
+
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+def best_of(func, number: int = 1) -> float:
+    """:returns how many seconds number calls of func took, at best of REPEAT tries."""
+
+    return min(timed(lambda: [func() for _ in range(number)]) for _ in range(REPEAT))
+
+
+def compare(results: {str: float}, baseline: dict, tolerance: float) -> bool:
+    """Prints how every result changed since the baseline. :returns False if any of them got
+    slower than tolerance allows."""
+
+    passed = True
+    print(f"\nCompared to the baseline of {baseline.get('saved', 'unknown')} (tolerance {tolerance:.0%}):")
+    for name, seconds in results.items():
+        baseline_seconds = baseline["results"].get(name)
+        if not baseline_seconds:
+            print(f"{name:<52} {'new':>12}")
+            continue
+        change = seconds / baseline_seconds - 1
+        regressed = change > tolerance
+        passed = passed and not regressed
+        print(f"{name:<52} {change:>+12.1%}{'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks the hot paths of the message broker.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="the backlog sizes")
+    parser.add_argument("--quick", action="store_true", help=f"only backlogs of {QUICK_SIZES}")
+    parser.add_argument("--storage", default=STORAGE, choices=[STORAGE_RAW, STORAGE_TEXT])
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="the baseline file")
+    parser.add_argument("--save", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much slower is still no regression")
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes = QUICK_SIZES
+
+    bench = Bench(args, os.path.abspath("repository.txt"))
+    print(f"Python {platform.python_version()}, storage: {args.storage}")
+    bench.run()
+
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump({"saved": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+                       "storage": args.storage, "results": bench.results}, file, indent=2)
+        print(f"\nSaved as the baseline: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("storage") != args.storage:
+            print(f"\nThe baseline was saved with --storage {baseline.get('storage')}, not compared.")
+        elif not compare(bench.results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark of the message broker's conversion step. Compares the old eval() based
+conversion (one expression per unit per message) against the compiled conversion table,
+converting one value at a time and in batches.
+
+Run from the Project_2 directory (the repository file is read from there):
+    python bench_conversion.py [number of values]"""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import random
+import sys
+import timeit
+
+import conversion
+from conversion import ConversionTable, read_repository
+
+
+def eval_convert(repository_dict: {str: str}, units: [str], meters: float) -> str:
+    """The conversion as it was done before the conversion table."""
+
+    return " ".join([str(eval(str(meters) + repository_dict[unit])) for unit in units])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repository_dict, queue_units = read_repository()
+    table = ConversionTable(repository_dict, queue_units)
+    all_meters = [random.uniform(0, 10000) for _ in range(count)]
+    units = queue_units["A"]
+
+    timings = {
+        "eval": lambda: [eval_convert(repository_dict, units, meters) for meters in all_meters],
+        "table": lambda: [ConversionTable.format_results(table.convert(meters, "A")) for meters in all_meters],
+        "table batch": lambda: [ConversionTable.format_results(row) for row in table.convert_many(all_meters, "A")],
+        "table batch (no formatting)": lambda: table.convert_many(all_meters, "A"),
+    }
+
+    print(f"Converting {count} values into queue A ({len(units)} units), numpy: {conversion.numpy is not None}")
+    baseline = None
+    for name, func in timings.items():
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        baseline = baseline or best
+        print(f"{name:<30} {best * 1e6 / count:8.2f} us/value {baseline / best:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,934 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the message broker of the server, kept apart from the GUI so that it can also
+run on machines without a display (see main()). The message broker takes care of
+maintaining/updating the queue storage file, updating the queue, and adding messages to
+the correct output queue. The clients are served by the engine (see engine.py).
+
+The functions that could be considered as part of the message broker are:
+    _init_repository_dict()
+    _init_all_queues()
+    add_to_queue()
+    update_all_queues_file()
+
+Queues are kept in a registry keyed by their name (all_queues), each with its own units
+(queue_units), and can be created and deleted while the broker runs (see create_queue()
+and delete_queue()). The queues defined in the repository file exist from the start.
+
+Messages are delivered at least once. Checking a queue does not remove its messages, it
+leases them to the consumer (see Consumer and lease_messages()) for a visibility timeout.
+Each delivery gets a tag, and the consumer acknowledges every delivery up to a tag at once
+(see ack()). Only acknowledged messages are removed from the queue and from the storage
+file. Leases that time out, or whose consumer disconnects, go back to the front of their
+queue to be delivered again. A consumer never holds more than its prefetch window of
+unacknowledged messages.
+
+Consumers do not have to poll an empty queue either: wait_for_messages() hands out a
+Future that is resolved the moment the queue gets messages (or the consumer's window gets
+room), from within add_to_queue() and the other functions that make that happen. The
+engine builds its long-polls and push subscriptions on it.
+
+Every queue has a lock of its own (see _locked_queue()), so clients of different queues
+never wait for each other, and neither does a snapshot: it collects the queues one at a
+time. queues_lock only guards creating and deleting queues, and every consumer has a lock
+for its leases. Locks are always taken in that order: queues_lock, the lock of a queue,
+the lock of a consumer.
+
+Persistence is handled by queue_log.QueueLog: every queue mutation is appended to a
+log file, and the queues are only fully re-serialized when the log gets compacted.
+The log is written by its own persistence thread, which batches the changes made by
+all clients (see DURABILITY, FLUSH_INTERVAL and FLUSH_BATCH_SIZE).
+
+A queue only keeps its head and its tail in memory, the rest is spilled into
+memory-mapped segment files (see segment_queue.py). How much memory each queue may use is
+set by memory_limit, and per queue by queue_memory_limits (see set_queue_memory_limit()).
+
+Messages are stored as raw meters (STORAGE_RAW, a float per message) and only converted into
+the units of their queue once they are delivered (see lease_messages()). The older
+STORAGE_TEXT mode converts them on upload and stores the results as text instead.
+Consumers get the same messages either way, and a queue may hold both kinds.
+
+The broker (and its engine) keep metrics of what they do: messages enqueued, delivered and
+acknowledged per queue, queue depths, bytes in and out, the latency of every command, how
+long log flushes and snapshots take, and connected clients. Recording them takes no lock
+(see metrics.py), and they are served over HTTP when metrics_port is set.
+
+Whatever happens on the broker is published as an event to every observer that has
+subscribed to it (see subscribe()). The GUI (server.py) is one such observer, in headless
+mode the status events are printed instead. Events are (kind, args) tuples:
+    EVENT_STATUS (status_message, level)
+    EVENT_CLIENT_ADDED (session_id, address, client_name)
+    EVENT_CLIENT_STATUS (session_id, client_name, status)
+    EVENT_CLIENT_REMOVED (session_id, client_name)
+The clients themselves are kept in the session registry of the broker (sessions, see
+sessions.py), from which a GUI can take the changes in batches instead.
+
+Usage:
+    python broker.py --headless     runs the broker without a GUI (PyQt5 is never imported).
+    python broker.py                runs the broker with the server GUI.
+    --memory-limit 256M --memory-limit A=1G
+                                    keeps at most 256 MiB of every queue in memory, 1 GiB of A.
+    --storage text                  stores the converted results instead of the meters.
+    --metrics-port 9557             serves the metrics on http://127.0.0.1:9557/metrics (Prometheus)
+                                    and /metrics.json.
+    --trace --trace-sample 0.05     traces the phases of 5% of the uploads and checks into
+                                    broker_trace.jsonl (see tracing.py)."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import argparse
+import contextlib
+import heapq
+import itertools
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+
+from conversion import ConversionTable, read_repository
+from engine import BrokerServer
+from event_log import LEVEL_DEBUG, LEVEL_INFO, LEVEL_WARNING
+from metrics import Metrics
+from tracing import Tracer, BROKER_TRACE_PATH, SAMPLE_RATE
+from queue_log import QueueLog, all_durable, DURABILITY_NONE, DURABILITY_BATCHED, DURABILITY_FSYNC
+from segment_queue import SegmentedQueue, MEMORY_LIMIT
+from sessions import SessionRecord, SessionRegistry
+
+HOST = socket.gethostname()
+PORT = 55557
+# one of queue_log.DURABILITY_NONE/DURABILITY_BATCHED/DURABILITY_FSYNC.
+DURABILITY = DURABILITY_BATCHED
+# how long (in seconds) the persistence thread lets changes pile up before writing them.
+FLUSH_INTERVAL = 0.005
+# the persistence thread writes right away once this many changes are pending.
+FLUSH_BATCH_SIZE = 512
+# where the queues spill their segment files.
+SPILL_DIR = "."
+# how messages are stored: as raw meters, converted once they are delivered, or as the text
+# of the converted results.
+STORAGE_RAW = "raw"
+STORAGE_TEXT = "text"
+STORAGE = STORAGE_RAW
+# where the metrics are served over HTTP (see metrics.py). Port 0 does not serve them, they are
+# recorded either way.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+# queue names are sent in frames and stored in log records.
+MAX_QUEUE_NAME_LENGTH = 255
+# a page of messages sent for a single CHECK never holds more than this many items/bytes,
+# whatever the client asks for.
+MAX_PAGE_ITEMS = 1000
+MAX_PAGE_BYTES = 1 << 20
+# how long (in seconds) a leased message stays invisible before it is delivered again,
+# unless the consumer asks for another timeout.
+VISIBILITY_TIMEOUT = 30.0
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60.0
+# how many unacknowledged messages a consumer may hold, unless it asks for fewer.
+PREFETCH_WINDOW = 2 * MAX_PAGE_ITEMS
+# how many of the message ids that came with the uploads to a queue are remembered, to drop
+# the uploads that come again (see add_many_to_queue()).
+DEDUP_WINDOW = 100000
+
+EVENT_STATUS = "status"
+EVENT_CLIENT_ADDED = "client_added"
+EVENT_CLIENT_STATUS = "client_status"
+EVENT_CLIENT_REMOVED = "client_removed"
+
+
+class Consumer:
+    def __init__(self, consumer_id: int, name: str):
+        self.consumer_id = consumer_id
+        self.name = name
+        # the messages leased to this consumer, as delivery tag -> (queue name, message id),
+        # in the order they were delivered.
+        self.leases: {int: (str, int)} = {}
+        # hands out the delivery tags.
+        self.delivery_tags = itertools.count(1)
+        # the Futures of those waiting for this consumer's prefetch window to get room.
+        self.window_waiters: [Future] = []
+        # held while leases or window_waiters are used. It may be taken while holding the
+        # lock of a queue, but never the other way around.
+        self.lock = threading.Lock()
+
+
+class Broker:
+    def __init__(self, host: str = HOST, port: int = PORT, durability: str = DURABILITY,
+                 memory_limit: int = MEMORY_LIMIT, queue_memory_limits: {str: int} = None, spill_dir: str = SPILL_DIR,
+                 storage: str = STORAGE, metrics_port: int = METRICS_PORT, tracer: Tracer = None):
+        if storage not in (STORAGE_RAW, STORAGE_TEXT):
+            raise ValueError(f"Unknown storage mode: {storage}")
+
+        # stores the conversion rules of each unit.
+        self.repository_dict = {}
+        # the conversion rules compiled into one factor per unit. Built from repository_dict.
+        self.conversion_table: ConversionTable = None
+        # the queues defined in the repository file, with their units.
+        self.default_queue_units: {str: [str]} = {}
+        # stores every queue by its name. The items are (message id, message) tuples, where
+        # message is the meters (a float) or the converted results (a string), see storage.
+        self.all_queues: {str: SegmentedQueue} = {}
+        self.storage = storage
+        # how many bytes of messages a queue keeps in memory, and the queues that keep more
+        # (or fewer). The rest is spilled into spill_dir.
+        self.memory_limit = memory_limit
+        self.queue_memory_limits: {str: int} = dict(queue_memory_limits or {})
+        self.spill_dir = spill_dir
+        # the leased, not yet acknowledged, messages of every queue as message id -> message.
+        self.in_flight: {str: {int: object}} = {}
+        # the leases of every queue as a heap of (deadline, order, consumer, delivery tag),
+        # earliest deadline first. Acknowledged leases are only dropped once they reach the top.
+        self.lease_deadlines: {str: list} = {}
+        # breaks ties between lease deadlines, so consumers are never compared.
+        self.lease_order = itertools.count()
+        # hands out the consumer ids.
+        self.consumer_ids = itertools.count(1)
+        # the Futures of those waiting for messages, per queue (see wait_for_messages()).
+        # They are resolved while holding the queue's lock, so their callbacks must be quick.
+        self.queue_waiters: {str: [Future]} = {}
+        # stores the units of every queue.
+        self.queue_units: {str: [str]} = {}
+        # the last DEDUP_WINDOW message ids that came with the uploads to every queue, oldest
+        # first, with the durability Future of their upload. Guarded by the lock of the queue.
+        self.upload_ids: {str: OrderedDict} = {}
+        # every client attached, by session id and by name.
+        self.sessions = SessionRegistry()
+        # callbacks that get every event, see subscribe().
+        self.observers = []
+        # counters, histograms and gauges of the broker, served on metrics_port.
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self._init_metrics()
+        # traces a sample of the requests, if set (see tracing.py).
+        self.tracer = tracer
+        # serves every client connection on a single event loop.
+        self.engine = BrokerServer(self, host, port)
+        # append-only log that persists every change made to the queues.
+        self.queue_log = QueueLog("all_queues", durability, FLUSH_INTERVAL, FLUSH_BATCH_SIZE)
+        self.queue_log.snapshot_fn = self.update_all_queues_file
+        self.queue_log.flush_fn = self._observe_flush
+        self.queue_log.error_fn = self._observe_log_error
+        # held while queues are created or deleted: the dicts keyed by queue name only gain or
+        # lose a queue while holding it.
+        self.queues_lock = threading.Lock()
+        # the lock of every queue, held while the queue (its messages, leases and waiters) is
+        # changed and the change is logged, so the log order always matches the order of the
+        # queue in memory. Different queues are changed in parallel (see _locked_queue()).
+        self.queue_locks: {str: threading.Lock} = {}
+
+    def subscribe(self, observer):
+        """Registers observer(kind, *args) to be called with every event of the broker.
+        Events are published from whichever thread caused them (mostly the engine thread),
+        so observers must be quick and thread-safe."""
+
+        self.observers.append(observer)
+
+    def publish(self, kind: str, *args):
+        """Calls every observer with the event."""
+
+        for observer in self.observers:
+            observer(kind, *args)
+
+    def _init_metrics(self):
+        """Defines the metrics the broker records. The engine adds its own (see BrokerServer)."""
+
+        self.metric_enqueued = self.metrics.counter("broker_messages_enqueued_total",
+                                                    "Messages added to a queue.", "queue")
+        self.metric_delivered = self.metrics.counter("broker_messages_delivered_total",
+                                                     "Messages leased to a consumer, redeliveries included.", "queue")
+        self.metric_acked = self.metrics.counter("broker_messages_acked_total",
+                                                 "Messages acknowledged, and removed from their queue.", "queue")
+        self.metric_redelivered = self.metrics.counter("broker_messages_requeued_total",
+                                                       "Leased messages put back into their queue to be delivered "
+                                                       "again.", "queue")
+        self.metrics.gauge("broker_queue_depth", "Messages in a queue, waiting to be delivered.",
+                           lambda: {q: each_queue.qsize() for q, each_queue in list(self.all_queues.items())}, "queue")
+        self.metrics.gauge("broker_queue_in_flight", "Messages of a queue leased, but not acknowledged yet.",
+                           lambda: {q: len(in_flight) for q, in_flight in list(self.in_flight.items())}, "queue")
+        self.metric_flush_seconds = self.metrics.histogram("broker_log_flush_seconds",
+                                                           "Time taken to write a batch of log records.")
+        self.metric_flushed_records = self.metrics.counter("broker_log_records_total", "Log records written.")
+        self.metric_snapshot_seconds = self.metrics.histogram("broker_snapshot_seconds",
+                                                              "Time taken to compact the log into a snapshot.")
+        self.metric_log_errors = self.metrics.counter("broker_log_errors_total",
+                                                      "Failed log writes and compactions.")
+
+    def _observe_flush(self, seconds: float, records: int):
+        """Records a batch written by the persistence thread."""
+
+        self.metric_flush_seconds.observe(seconds)
+        self.metric_flushed_records.inc(records)
+
+    def _observe_log_error(self, what: str, error: Exception):
+        """Records a write or a compaction the persistence thread could not finish."""
+
+        self.metric_log_errors.inc()
+        self.update_status(f"{what}: {error}", LEVEL_WARNING)
+
+    def start(self):
+        """Loads the repository and the queues, then starts serving clients (and the metrics,
+        if metrics_port is set)."""
+
+        self._init_repository_dict()
+        self._init_all_queues()
+        self._start_engine()
+        if self.metrics_port:
+            self.metrics.serve(METRICS_HOST, self.metrics_port)
+            self.update_status(f"Metrics are served on http://{METRICS_HOST}:{self.metrics_port}/metrics")
+
+    def _start_engine(self):
+        """Starts the engine, which creates the socket to which all clients will bind to
+        and listens for them on its own thread."""
+
+        self.update_status("Socket is being created...")
+        self.engine.start()
+
+    def stop(self):
+        """Closes all sockets and writes out every change that is still waiting on the
+        persistence thread."""
+
+        self.engine.stop()
+        self.metrics.stop()
+        self.queue_log.close()
+        if self.tracer is not None:
+            self.tracer.close()
+
+    def _init_repository_dict(self):
+        """Opens the repository text file, and loads the conversion rules into memory.
+        Assumes that the file already exists, so the application can run.
+        The first lines of the repository contain the units of each default queue, which
+        are named A, B, C, ... in order.
+        The rest of the lines contain a unit and its conversion rules.
+        This way, the repository can be modified and still run.
+        The rules are then compiled into a conversion table, so they need not be parsed
+        again for every message (see conversion.read_repository())."""
+
+        try:
+            self.repository_dict, self.default_queue_units = read_repository()
+        except FileNotFoundError as e:
+            print(e)
+            print("No repository file found.\nApplication cannot run without a repository file.")
+            sys.exit(1)
+
+        try:
+            self.conversion_table = ConversionTable(self.repository_dict, self.default_queue_units)
+        except (KeyError, ValueError) as e:
+            print(e)
+            print("The repository file is invalid.\nApplication cannot run without a valid repository file.")
+            sys.exit(1)
+
+
+    def _init_all_queues(self):
+        """Initializes all the queues, and loads the persisted versions into volatile memory.
+        The snapshot file is loaded first, then the log of changes made after it is
+        replayed on top. The log file is created if none exists. The messages of the
+        snapshot are not read, their data files are mapped into the queues as they are (see
+        QueueLog.recover()), so only the messages logged after it take any time."""
+
+        started = time.perf_counter()
+        self.all_queues, self.queue_units = self.queue_log.recover(self.default_queue_units, self._new_queue)
+        elapsed = time.perf_counter() - started
+        try:
+            self.conversion_table = ConversionTable(self.repository_dict, self.queue_units)
+        except KeyError as e:
+            print(e)
+            print("A stored queue uses a unit that is missing from the repository file.")
+            sys.exit(1)
+
+        for q in self.all_queues:
+            self.queue_locks[q] = threading.Lock()
+            self.in_flight[q] = {}
+            self.lease_deadlines[q] = []
+        self.update_status(f"{len(self.all_queues)} queues loaded into volatile memory in {elapsed:.3f} s: "
+                           f"{self.queue_log.snapshot_items} messages from the snapshot, "
+                           f"{self.queue_log.log_items} from the log.")
+        for q, each_queue in self.all_queues.items():
+            self.update_status(f"Queue {q}: {each_queue.qsize()} messages.", LEVEL_DEBUG)
+
+
+    def _new_queue(self, q: str) -> SegmentedQueue:
+        """:returns a new, empty queue for q, with its memory limit."""
+
+        return SegmentedQueue(self.queue_memory_limits.get(q, self.memory_limit), self.spill_dir)
+
+
+    def set_queue_memory_limit(self, q: str = "", memory_limit: int = MEMORY_LIMIT):
+        """Sets how many bytes of messages queue q keeps in memory, from now on (and for a
+        queue created under that name later). Raises KeyError if there is no queue q."""
+
+        with self._locked_queue(q) as selected_queue:
+            self.queue_memory_limits[q] = memory_limit
+            selected_queue.set_memory_limit(memory_limit)
+
+
+    @contextlib.contextmanager
+    def _locked_queue(self, q: str):
+        """Holds the lock of queue q for the duration of the with block, and yields the queue.
+        Raises KeyError if there is no queue q, also if it is deleted while waiting for the
+        lock."""
+
+        with self.queues_lock:
+            queue_lock = self.queue_locks[q]
+        with queue_lock:
+            # delete_queue() holds the lock as well, so the queue is either still there or gone.
+            if self.queue_locks.get(q) is not queue_lock:
+                raise KeyError(q)
+            yield self.all_queues[q]
+
+
+    def create_queue(self, q: str = "", units: [str] = ()) -> Future:
+        """:returns a Future that is resolved once the new queue is durable.
+
+        Creates an empty queue named q, whose messages are converted into units. Raises
+        ValueError if the name is invalid or taken, or if a unit is not in the repository."""
+
+        units = list(units)
+        if not q or len(q.encode("utf-8")) > MAX_QUEUE_NAME_LENGTH or q.split() != [q]:
+            raise ValueError(f"Invalid queue name: {q!r}")
+        if not units:
+            raise ValueError(f"Queue {q} needs at least one unit.")
+        unknown_units = [unit for unit in units if unit not in self.repository_dict]
+        if unknown_units:
+            raise ValueError(f"Units not in the repository: {' '.join(unknown_units)}")
+
+        with self.queues_lock:
+            if q in self.all_queues:
+                raise ValueError(f"Queue {q} already exists.")
+            self.conversion_table.add_queue(q, units)
+            self.queue_units[q] = units
+            self.all_queues[q] = self._new_queue(q)
+            self.queue_locks[q] = threading.Lock()
+            self.in_flight[q] = {}
+            self.lease_deadlines[q] = []
+            durable = self.queue_log.append_create(q, units)
+
+        self.update_status(f"Queue {q} created: {' '.join(units)}")
+        return durable
+
+
+    def delete_queue(self, q: str = "") -> Future:
+        """:returns a Future that is resolved once the deletion is durable.
+
+        Deletes queue q along with every message still in it, leased or not. Raises KeyError
+        if there is no such queue."""
+
+        with self.queues_lock, self.queue_locks[q]:
+            del self.queue_locks[q]
+            deleted_queue = self.all_queues.pop(q)
+            deleted_in_flight = self.in_flight.pop(q)
+            self.upload_ids.pop(q, None)
+            # every lease still held has an entry in the heap, drop them from their consumers.
+            for deadline, order, consumer, tag in self.lease_deadlines.pop(q):
+                with consumer.lock:
+                    consumer.leases.pop(tag, None)
+            del self.queue_units[q]
+            self.conversion_table.remove_queue(q)
+            durable = self.queue_log.append_delete(q, deleted_queue.qsize() + len(deleted_in_flight))
+            # those waiting on the queue find out it is gone once they try to lease from it.
+            self._wake(self.queue_waiters.pop(q, []))
+
+        self.update_status(f"Queue {q} deleted.")
+        return durable
+
+
+    def list_queues(self) -> {str: [str]}:
+        """:returns a dict of queue name -> units, for every queue."""
+
+        with self.queues_lock:
+            return {q: list(units) for q, units in self.queue_units.items()}
+
+
+    def add_to_queue(self, meters: float = 0.0, q: str = "") -> (str, Future):
+        """:returns the results in a string to be shown in the status box, and a Future that
+        is resolved once the results are durable (the upload must not be confirmed before).
+
+        Converts the meters input into the units specified in the selected q.
+        Places the results (or only the meters, see storage) into the related queue file
+        (non-volatile mem.). Raises KeyError if there is no queue q."""
+
+        if self.storage == STORAGE_RAW:
+            meters = float(meters)
+            with self._locked_queue(q) as selected_queue:
+                # rendered while the queue is locked, since delete_queue() drops its factors.
+                results_string = self.conversion_table.render(meters, q)
+                message_ids, durable = self.queue_log.append_enqueue_raw(q, [meters])
+                selected_queue.put((message_ids[0], meters))
+                self._wake(self.queue_waiters.pop(q, []))
+            self.metric_enqueued.inc(1, q)
+            return results_string, durable
+
+        # Here we convert the meters into the units for the queue, and concatenate
+        # them to get our results_string.
+        results_string = ConversionTable.format_results(self.conversion_table.convert(meters, q))
+
+        with self._locked_queue(q) as selected_queue:
+            # logs the string to non-volatile memory, and puts it into our queue under its id.
+            message_id, durable = self.queue_log.append_enqueue(q, results_string)
+            selected_queue.put((message_id, results_string))
+            self._wake(self.queue_waiters.pop(q, []))
+        self.metric_enqueued.inc(1, q)
+
+        return results_string, durable
+
+
+    def add_many_to_queue(self, all_meters: [float] = (), q: str = "", upload_ids: [str] = None) -> (list, Future):
+        """:returns the messages that were stored (the results of every value as strings, or
+        the meters themselves, see storage), and a Future that is resolved once all of them
+        are durable.
+
+        Converts all of the meters values at once into the units specified in the selected q,
+        unless they are stored raw (which logs them as a single record).
+        All of the results are placed into the queue together, so no other message can end
+        up in between them. Raises KeyError if there is no queue q.
+        upload_ids (if any) are the message ids the producer gave the values (see outbox.py).
+        The values whose message id came with one of the last DEDUP_WINDOW uploads to q are
+        dropped, so a producer may send an upload again if its confirmation was lost. The
+        Future then waits for that earlier upload to be durable as well."""
+
+        if self.storage == STORAGE_RAW:
+            all_results = [float(meters) for meters in all_meters]
+        else:
+            all_results = [ConversionTable.format_results(results)
+                           for results in self.conversion_table.convert_many(all_meters, q)]
+
+        with self._locked_queue(q) as selected_queue:
+            earlier = []
+            if upload_ids is not None:
+                upload_ids, all_results, earlier = self._drop_uploaded(q, upload_ids, all_results)
+            if not all_results:
+                message_ids, durable = [], all_durable([])
+            elif self.storage == STORAGE_RAW:
+                message_ids, durable = self.queue_log.append_enqueue_raw(q, all_results)
+            else:
+                message_ids, durable = self.queue_log.append_enqueue_many(q, all_results)
+            for item in zip(message_ids, all_results):
+                selected_queue.put(item)
+            if upload_ids:
+                self._remember_uploaded(q, upload_ids, durable)
+            if all_results:
+                self._wake(self.queue_waiters.pop(q, []))
+        self.metric_enqueued.inc(len(all_results), q)
+
+        return all_results, all_durable([durable] + earlier) if earlier else durable
+
+
+    def _drop_uploaded(self, q: str, upload_ids: [str], all_results: list) -> ([str], list, [Future]):
+        """:returns the message ids and results of the values not uploaded to queue q before
+        (see add_many_to_queue()), and the durability Futures of the uploads that the others
+        came with. Called holding the lock of q."""
+
+        recent_ids = self.upload_ids.get(q, {})
+        new_ids, new_results = {}, []
+        earlier = {}
+        for upload_id, result in zip(upload_ids, all_results):
+            durable = recent_ids.get(upload_id)
+            if durable is not None:
+                earlier[durable] = None
+            elif upload_id not in new_ids:
+                new_ids[upload_id] = None
+                new_results.append(result)
+        return list(new_ids), new_results, list(earlier)
+
+
+    def _remember_uploaded(self, q: str, upload_ids: [str], durable: Future):
+        """Remembers the message ids of an upload to queue q, until DEDUP_WINDOW later ones
+        came in, or the upload could not be made durable. Called holding the lock of q."""
+
+        recent_ids = self.upload_ids.setdefault(q, OrderedDict())
+        for upload_id in upload_ids:
+            recent_ids[upload_id] = durable
+        while len(recent_ids) > DEDUP_WINDOW:
+            recent_ids.popitem(last=False)
+        durable.add_done_callback(lambda durable: self._forget_uploaded(q, recent_ids, upload_ids, durable))
+
+
+    def _forget_uploaded(self, q: str, recent_ids: OrderedDict, upload_ids: [str], durable: Future):
+        """Forgets the message ids of an upload to queue q that could not be made durable, so
+        it is stored once it comes again."""
+
+        if durable.exception() is None:
+            return
+        try:
+            with self._locked_queue(q):
+                for upload_id in upload_ids:
+                    if recent_ids.get(upload_id) is durable:
+                        del recent_ids[upload_id]
+        except KeyError:
+            # the queue is gone, along with its message ids.
+            pass
+
+
+    def update_all_queues_file(self):
+        """Updates the queues storage file with the most up-to-date values. Called by the
+        persistence thread once the log has grown large enough (see QueueLog).
+        The queues are written into a data file and listed in the 'all_queues.p' file,
+        after which the log records it covers are dropped. Leased messages are stored too
+        (in front of the rest), since they have not been acknowledged yet.
+        The queues are collected one at a time, each under its own lock (along with its
+        last sequence number), so no queue waits for any other. Only their in-memory parts
+        are copied: their segments are read while the snapshot is written (see
+        SegmentedQueue.snapshot()). The parts the snapshot copied are then swapped for their
+        copies (see SegmentedQueue.rebase()), so the next snapshot only refers to them
+        instead of copying them again."""
+
+        started = time.perf_counter()
+        # the queues deleted before they are collected keep counting up their sequence numbers.
+        seqs = self.queue_log.current_seqs()
+        with self.queues_lock:
+            all_queue_locks = dict(self.queue_locks)
+        all_contents = {}
+        all_units = {}
+        for q, queue_lock in all_queue_locks.items():
+            with queue_lock:
+                if self.queue_locks.get(q) is not queue_lock:
+                    # deleted in the meantime, the log has its DELETE record.
+                    continue
+                each_queue = self.all_queues[q]
+                all_contents[q] = (len(self.in_flight[q]) + each_queue.qsize(),
+                                   [list(self.in_flight[q].items())] + each_queue.snapshot())
+                all_units[q] = list(self.queue_units[q])
+                seqs[q] = self.queue_log.current_seq(q)
+
+        # the (slow) serialization happens outside of the locks, so uploads can carry on.
+        all_copies = self.queue_log.write_snapshot(all_contents, seqs, all_units)
+
+        for q, copies in all_copies.items():
+            queue_lock = all_queue_locks[q]
+            with queue_lock:
+                # a queue deleted (or re-created) in the meantime has none of those segments.
+                if self.queue_locks.get(q) is queue_lock:
+                    self.all_queues[q].rebase(copies)
+        self.metric_snapshot_seconds.observe(time.perf_counter() - started)
+
+
+    def queue_has_messages(self, q: str = "") -> int:
+        """Checks whether a queue has messages in it. Returns zero or one correspondingly.
+        Used in lieu of the queue.empty() function since I am using a FOR-loop iteration,
+        and not a while loop iteration, for iterating over items in the queue.
+        Raises KeyError if there is no queue q."""
+
+        if self.all_queues[q].qsize() > 0:
+            return 1
+        return 0
+
+
+    def open_consumer(self, name: str = "") -> Consumer:
+        """:returns a new Consumer, which messages can be leased to. Opened by the engine for
+        every client connection."""
+
+        return Consumer(next(self.consumer_ids), name)
+
+
+    def close_consumer(self, consumer: Consumer):
+        """Puts every message still leased to consumer back into its queue, to be delivered
+        again. Called by the engine once the client's connection is closed."""
+
+        for q, message_ids in self._drop_leases(consumer).items():
+            try:
+                with self._locked_queue(q):
+                    self._requeue(q, message_ids)
+            except KeyError:
+                # the queue was deleted, along with its messages.
+                pass
+
+
+    def lease_messages(self, consumer: Consumer, q: str = "", max_items: int = 0, max_bytes: int = 0,
+                       prefetch: int = 0, visibility_timeout: float = 0.0) -> ([(int, str)], int):
+        """:returns the next page of messages in queue q as (delivery tag, message) tuples,
+        and the number of messages left in the queue after it. The messages stay in the queue,
+        leased to consumer, until consumer acknowledges them (see ack()) or visibility_timeout
+        seconds have passed.
+
+        A page holds at most max_items messages of max_bytes bytes in all (0, or anything past
+        MAX_PAGE_ITEMS/MAX_PAGE_BYTES, means the server's limit), but always at least one
+        message, so that a message larger than max_bytes can still be fetched. It never takes
+        consumer past prefetch unacknowledged messages (0 means PREFETCH_WINDOW): the page is
+        empty while the window is full. The whole page is taken from the queue at once, under
+        its lock, so pages taken by concurrent consumers never interleave.
+        This function is operated by the engine. Raises KeyError if there is no queue q."""
+
+        max_items = min(max_items or MAX_PAGE_ITEMS, MAX_PAGE_ITEMS)
+        max_bytes = min(max_bytes or MAX_PAGE_BYTES, MAX_PAGE_BYTES)
+        deadline = time.monotonic() + min(visibility_timeout or VISIBILITY_TIMEOUT, MAX_VISIBILITY_TIMEOUT)
+        deliveries = []
+        page_bytes = 0
+
+        with self._locked_queue(q) as selected_queue:
+            in_flight = self.in_flight[q]
+            lease_deadlines = self.lease_deadlines[q]
+            self._expire_leases(q)
+
+            with consumer.lock:
+                max_items = min(max_items, (prefetch or PREFETCH_WINDOW) - len(consumer.leases))
+                # every change to the queue is made under its lock, so the front message can be
+                # looked at before it is taken. Raw meters are converted right here.
+                while len(deliveries) < max_items and selected_queue.qsize() > 0:
+                    message = self.conversion_table.render(selected_queue.peek()[1], q)
+                    # the messages are converted numbers, so one character is one byte.
+                    message_bytes = len(message)
+                    if deliveries and page_bytes + message_bytes > max_bytes:
+                        break
+                    message_id, stored_message = selected_queue.get()
+                    tag = next(consumer.delivery_tags)
+                    consumer.leases[tag] = (q, message_id)
+                    in_flight[message_id] = stored_message
+                    heapq.heappush(lease_deadlines, (deadline, next(self.lease_order), consumer, tag))
+                    deliveries.append((tag, message))
+                    page_bytes += message_bytes
+            remaining = selected_queue.qsize()
+        if deliveries:
+            self.metric_delivered.inc(len(deliveries), q)
+
+        return deliveries, remaining
+
+
+    def wait_for_messages(self, consumer: Consumer, q: str = "", prefetch: int = 0) -> (Future, float):
+        """:returns a Future that is resolved once lease_messages() may have something for
+        consumer in queue q: q has messages, and consumer's prefetch window has room. It is
+        resolved right away if that is already so, and also if q is deleted.
+        Also returns how many seconds are left until the next lease of q times out (None if
+        q has no leases): timed out leases are only put back into the queue when someone
+        asks for them, so that is how long it is worth waiting on the Future at most.
+        This function is operated by the engine. Raises KeyError if there is no queue q."""
+
+        future = Future()
+        with self._locked_queue(q) as selected_queue:
+            self._expire_leases(q)
+            lease_deadlines = self.lease_deadlines[q]
+            expires_in = lease_deadlines[0][0] - time.monotonic() if lease_deadlines else None
+
+            with consumer.lock:
+                if len(consumer.leases) >= (prefetch or PREFETCH_WINDOW):
+                    self._add_waiter(consumer.window_waiters, future)
+                    return future, expires_in
+            if selected_queue.qsize() == 0:
+                self._add_waiter(self.queue_waiters.setdefault(q, []), future)
+            else:
+                future.set_result(None)
+
+        return future, expires_in
+
+
+    @staticmethod
+    def _add_waiter(waiters: [Future], future: Future):
+        """Adds future to waiters, and drops the Futures of those that have given up waiting."""
+
+        waiters[:] = [waiter for waiter in waiters if not waiter.done()]
+        waiters.append(future)
+
+
+    def ack(self, consumer: Consumer, tag: int = 0) -> (int, Future):
+        """:returns how many messages were acknowledged, and a Future that is resolved once
+        that is durable.
+
+        Acknowledges every message leased to consumer with a delivery tag up to tag: they are
+        removed from their queues for good. Leases that have already timed out are skipped,
+        those messages will be delivered again."""
+
+        acked = {}
+        acked_count = 0
+        # the acknowledgement is durable once the records of every queue are.
+        all_futures = []
+
+        with consumer.lock:
+            acked_tags = list(itertools.takewhile(lambda lease_tag: lease_tag <= tag, consumer.leases))
+            for lease_tag in acked_tags:
+                q, message_id = consumer.leases.pop(lease_tag)
+                acked.setdefault(q, []).append(message_id)
+            if acked_tags:
+                self._wake(consumer.window_waiters)
+                consumer.window_waiters = []
+
+        # the leases are gone from the consumer, so they can no longer time out: the messages
+        # only have to be removed from their queues.
+        for q, message_ids in acked.items():
+            try:
+                with self._locked_queue(q):
+                    in_flight = self.in_flight[q]
+                    message_ids = [message_id for message_id in message_ids
+                                   if in_flight.pop(message_id, None) is not None]
+                    if message_ids:
+                        all_futures.append(self.queue_log.append_ack(q, message_ids))
+                        acked_count += len(message_ids)
+                        self.metric_acked.inc(len(message_ids), q)
+                    lease_deadlines = self.lease_deadlines[q]
+                    if len(lease_deadlines) > 2 * len(in_flight) + MAX_PAGE_ITEMS:
+                        # most of the heap are acknowledged leases waiting to reach the top, drop
+                        # them. A lease never comes back once it is gone from its consumer, so
+                        # this needs no consumer lock: at worst a lease gone just now is kept.
+                        lease_deadlines[:] = [lease for lease in lease_deadlines if lease[3] in lease[2].leases]
+                        heapq.heapify(lease_deadlines)
+            except KeyError:
+                # the queue was deleted, along with its messages.
+                pass
+
+        return acked_count, all_durable(all_futures)
+
+
+    def _expire_leases(self, q: str):
+        """Puts the messages of queue q whose lease has timed out back into the queue.
+        Must be called while holding the lock of q."""
+
+        lease_deadlines = self.lease_deadlines[q]
+        now = time.monotonic()
+        expired = {}
+        while lease_deadlines and lease_deadlines[0][0] <= now:
+            deadline, order, consumer, tag = heapq.heappop(lease_deadlines)
+            expired.setdefault(consumer, []).append(tag)
+        for consumer, tags in expired.items():
+            for message_ids in self._drop_leases(consumer, tags).values():
+                self._requeue(q, message_ids)
+
+
+    def _drop_leases(self, consumer: Consumer, tags: [int] = None) -> {str: [int]}:
+        """Takes the leases under tags (all of them by default) away from consumer, skipping
+        those it no longer holds. :returns the ids of their messages, per queue."""
+
+        dropped = {}
+        with consumer.lock:
+            for tag in list(consumer.leases) if tags is None else tags:
+                lease = consumer.leases.pop(tag, None)
+                if lease is not None:
+                    dropped.setdefault(lease[0], []).append(lease[1])
+            if dropped:
+                self._wake(consumer.window_waiters)
+                consumer.window_waiters = []
+        return dropped
+
+
+    def _requeue(self, q: str, message_ids: [int]):
+        """Puts the leased messages message_ids back at the front of queue q, oldest message
+        first, to be delivered again. Must be called while holding the lock of q."""
+
+        in_flight = self.in_flight[q]
+        items = sorted((message_id, in_flight.pop(message_id)) for message_id in message_ids
+                       if message_id in in_flight)
+        if items:
+            self.all_queues[q].put_front(items)
+            self._wake(self.queue_waiters.pop(q, []))
+            self.metric_redelivered.inc(len(items), q)
+            self.update_status(f"{len(items)} messages of Queue {q} will be delivered again.", LEVEL_DEBUG)
+
+
+    @staticmethod
+    def _wake(waiters: [Future]):
+        """Resolves every Future in waiters, except those whose waiter has given up."""
+
+        for waiter in waiters:
+            try:
+                waiter.set_result(None)
+            except InvalidStateError:
+                # cancelled in the meantime.
+                pass
+
+
+    def update_status(self, status_message, level: int = LEVEL_INFO):
+        """Publishes a line for the status box. level is one of the event_log levels, the
+        per-request lines are LEVEL_DEBUG."""
+
+        self.publish(EVENT_STATUS, status_message, level)
+
+    def new_client_handler(self, address: tuple = (), client_name: str = "", connection=None) -> SessionRecord:
+        """Handles the addition of a new client. The engine takes care of confirming the
+        addition to the client. :returns its record, whose session id the client gets."""
+
+        record = self.sessions.add(client_name, connection, address)
+        self.update_status(f"{address[1]} added under {client_name}.")
+        self.publish(EVENT_CLIENT_ADDED, record.session_id, address, client_name)
+        return record
+
+    def set_client_status(self, record: SessionRecord, status: str = ""):
+        """Sets and publishes the status of a client (Connected, Checking..., etc.)."""
+
+        self.sessions.set_state(record, status)
+        self.publish(EVENT_CLIENT_STATUS, record.session_id, record.client_name, status)
+
+    def remove_client(self, record: SessionRecord):
+        """Removes a client that has ended its connection."""
+
+        self.update_status(f"Closing and removing {record.client_name}...")
+        self.sessions.remove(record.session_id)
+        self.publish(EVENT_CLIENT_REMOVED, record.session_id, record.client_name)
+
+
+def parse_size(size: str) -> int:
+    """:returns the number of bytes in size, e.g. 4096, 64K, 256M or 2G. Raises ValueError."""
+
+    multiplier = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}.get(size[-1:].upper(), 1)
+    number = size[:-1] if multiplier > 1 else size
+    if not number.isdigit() or int(number) == 0:
+        raise ValueError(f"Invalid size: {size}")
+    return int(number) * multiplier
+
+
+def print_status(kind: str, *args):
+    """The observer used in headless mode, prints the status events."""
+
+    if kind == EVENT_STATUS:
+        print(args[0], flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the message broker server.")
+    parser.add_argument("--headless", action="store_true", help="run without the GUI, PyQt5 is not needed")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--durability", default=DURABILITY, choices=[DURABILITY_NONE, DURABILITY_BATCHED,
+                                                                     DURABILITY_FSYNC])
+    parser.add_argument("--quiet", action="store_true", help="do not print status events in headless mode")
+    parser.add_argument("--memory-limit", action="append", default=[], metavar="[QUEUE=]SIZE",
+                        help="how much of a queue is kept in memory (e.g. 64M), for every queue or for QUEUE")
+    parser.add_argument("--spill-dir", default=SPILL_DIR, help="where queues spill the rest")
+    parser.add_argument("--storage", default=STORAGE, choices=[STORAGE_RAW, STORAGE_TEXT],
+                        help="store the meters and convert them on delivery, or store the converted text")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help=f"serve the metrics over HTTP on {METRICS_HOST} at this port (0: do not serve them)")
+    parser.add_argument("--trace", nargs="?", const=BROKER_TRACE_PATH, metavar="FILE",
+                        help=f"trace the phases of a sample of the uploads and checks (into {BROKER_TRACE_PATH})")
+    parser.add_argument("--trace-sample", type=float, default=SAMPLE_RATE,
+                        help="the fraction of the requests that is traced")
+    args, remaining_args = parser.parse_known_args()
+
+    memory_limit = MEMORY_LIMIT
+    queue_memory_limits = {}
+    try:
+        for each_limit in args.memory_limit:
+            q, _, size = each_limit.rpartition("=")
+            if q:
+                queue_memory_limits[q] = parse_size(size)
+            else:
+                memory_limit = parse_size(size)
+    except ValueError as e:
+        parser.error(str(e))
+    tracer = Tracer(args.trace, "server", args.trace_sample) if args.trace else None
+    broker_args = (HOST, args.port, args.durability, memory_limit, queue_memory_limits, args.spill_dir, args.storage,
+                   args.metrics_port, tracer)
+
+    if not args.headless:
+        # imported here, so PyQt5 is only loaded when the GUI is wanted.
+        import server
+        server.main(Broker(*broker_args), remaining_args)
+        return
+
+    broker = Broker(*broker_args)
+    if not args.quiet:
+        broker.subscribe(print_status)
+    broker.start()
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    while not stopped.is_set():
+        stopped.wait(1)
+    broker.stop()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the client library of the message broker: producers and consumers that speak the
+protocol (see framing.py) from a script, without a GUI and without PyQt5. It comes in a sync
+and an asyncio flavor, both built on the connection pool (see connection_pool.py):
+
+    with broker_client.connect("producer1") as client:
+        client.upload(1.5, "A")
+        client.upload_many([1.0, 2.0, 3.0], "A")
+        for message in client.iter_messages("A"):
+            print(message)
+
+    async with await broker_client.connect_async("consumer1") as client:
+        await client.upload(1.5, "A")
+        async for message in client.iter_messages("A"):
+            print(message)
+
+connect() attaches a new client to the server, on a connection of its own, or on a pool of
+connections shared with other clients (pool=). Every call waits for the reply of the server,
+and raises BrokerError if the server refused the request (ConnectionError if the connection
+was lost). To keep many uploads in flight at once, see Client.pipeline(); with asyncio, the
+uploads gathered at once (asyncio.gather()) are all in flight.
+
+Draining is streamed: iter_messages() (and iter_pages()) leases a page of messages at a time,
+and acknowledges the messages it has handed out along with the request for the next page,
+or once the iteration ends. A message counts as processed once it has been handed out. The
+messages of a page that were not handed out (the iteration was stopped midway) are delivered
+again once their visibility timeout has passed, or the client is closed. check() drains a
+queue into a list.
+
+Every call may be given a trace (see tracing.py), whose send and wait (or receive, and ack)
+phases it marks; the caller marks the rest and finishes it.
+
+asyncio is only imported by the asyncio flavor, so importing the library stays cheap."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import socket
+
+import framing
+from connection_pool import ConnectionPool, Pipeline, Reply, Session, MAX_IN_FLIGHT
+
+HOST = socket.gethostname()
+PORT = 55557
+# the most messages (and bytes of messages) asked for in a single page when checking a queue.
+CHECK_PAGE_ITEMS = 500
+CHECK_PAGE_BYTES = 256 * 1024
+# the most unacknowledged messages held at once, and how long (in seconds) before the server
+# delivers an unacknowledged message again.
+CHECK_PREFETCH = 2 * CHECK_PAGE_ITEMS
+CHECK_VISIBILITY_TIMEOUT = 30.0
+# how long (in seconds) the server may hold a check of an empty queue, waiting for a message.
+CHECK_WAIT = 2.0
+# why the server refused a request, by status code.
+STATUS_REASONS = {
+    framing.STATUS_NOT_FOUND: "the queue does not exist",
+    framing.STATUS_WINDOW_FULL: "the client holds too many unacknowledged messages",
+}
+
+
+class BrokerError(Exception):
+    def __init__(self, status: int, message: str):
+        super(BrokerError, self).__init__(message)
+        # the status code of the reply, see framing.py.
+        self.status = status
+
+
+def raise_for_status(reply: Reply, what: str) -> Reply:
+    """:returns reply, if it is STATUS_OK or STATUS_EMPTY. Raises BrokerError otherwise,
+    saying what failed and why."""
+
+    if reply.status in (framing.STATUS_OK, framing.STATUS_EMPTY):
+        return reply
+    reason = STATUS_REASONS.get(reply.status) or reply.text() or f"status {reply.status}"
+    raise BrokerError(reply.status, f"{what} failed: {reason}.")
+
+
+def pack_page_check(q: str, wait: float) -> bytes:
+    """:returns the payload of the OP_CHECK of a page of queue q."""
+
+    return framing.pack_check(q, CHECK_PAGE_ITEMS, CHECK_PAGE_BYTES, CHECK_PREFETCH, CHECK_VISIBILITY_TIMEOUT, wait)
+
+
+def connect(client_name: str, host: str = HOST, port: int = PORT, pool: ConnectionPool = None) -> "Client":
+    """Attaches a client named client_name to the server, on a connection of pool (a new
+    one of its own if None). :returns the Client. Raises OSError (ConnectionError) if the
+    server cannot be reached or does not accept it."""
+
+    own_pool = ConnectionPool(host, port, 1) if pool is None else None
+    try:
+        session = (pool or own_pool).attach(client_name)
+    except Exception:
+        if own_pool is not None:
+            own_pool.close()
+        raise
+    return Client(session, own_pool)
+
+
+async def connect_async(client_name: str, host: str = HOST, port: int = PORT,
+                        pool: ConnectionPool = None) -> "AsyncClient":
+    """connect() for asyncio. :returns the AsyncClient."""
+
+    import asyncio
+
+    client = await asyncio.get_running_loop().run_in_executor(None, connect, client_name, host, port, pool)
+    return AsyncClient(client)
+
+
+class Client:
+    def __init__(self, session: Session, own_pool: ConnectionPool = None):
+        self.session = session
+        self.client_name = session.client_name
+        # the pool opened for this client alone, closed along with it.
+        self.own_pool = own_pool
+
+    def _call(self, opcode: int, payload: bytes = b"", what: str = "", trace=None, phase: str = "wait",
+              timeout: float = None) -> Reply:
+        """Sends a request and waits for its reply, for at most timeout seconds (forever if
+        None). :returns the reply. Raises BrokerError if it was refused (saying what failed),
+        or TimeoutError if no reply came in time."""
+
+        request = self.session.request(opcode, payload)
+        if trace is not None:
+            trace.mark("send")
+            trace.set_request_id(request.request_id)
+        reply = request.result(timeout)
+        if trace is not None:
+            trace.mark(phase)
+        return raise_for_status(reply, what)
+
+    def upload(self, meters: float, q: str, trace=None):
+        """Uploads meters to queue q, and waits until the server has stored it."""
+
+        self._call(framing.OP_UPLOAD, framing.pack_upload(meters, q), f"Uploading to Queue {q}", trace)
+
+    def upload_many(self, all_meters: [float], q: str, trace=None, timeout: float = None,
+                    upload_ids: [str] = None) -> int:
+        """Uploads all the values to queue q with a single request, and waits until the
+        server has stored them, for at most timeout seconds (see _call()). upload_ids (if any)
+        are the message ids of the values: the server leaves out those that came with one of
+        its last uploads to q (see outbox.py). :returns how many were stored."""
+
+        return self._call(framing.OP_UPLOAD_BATCH, framing.pack_upload_batch(all_meters, q, upload_ids),
+                          f"Uploading to Queue {q}", trace, timeout=timeout).count()
+
+    def pipeline(self, max_in_flight: int = MAX_IN_FLIGHT) -> Pipeline:
+        """:returns a Pipeline of this client, which keeps up to max_in_flight uploads in flight."""
+
+        return Pipeline(self.session, max_in_flight)
+
+    def create_queue(self, q: str, units: [str]):
+        """Creates queue q, holding the given units of every message."""
+
+        self._call(framing.OP_CREATE_QUEUE, framing.pack_queue_definition(q, units), f"Creating Queue {q}")
+
+    def delete_queue(self, q: str):
+        """Deletes queue q, and every message in it."""
+
+        self._call(framing.OP_DELETE_QUEUE, q.encode("utf-8"), f"Deleting Queue {q}")
+
+    def list_queues(self) -> {str: [str]}:
+        """:returns the units of every queue, by queue name."""
+
+        return framing.unpack_queue_list(self._call(framing.OP_LIST_QUEUES, what="Listing the queues").payload)
+
+    def check(self, q: str, wait: float = CHECK_WAIT) -> [str]:
+        """:returns every message of queue q (draining it), see iter_messages()."""
+
+        return list(self.iter_messages(q, wait))
+
+    def iter_messages(self, q: str, wait: float = CHECK_WAIT):
+        """Yields every message of queue q, until it is drained. If the queue is empty, the
+        server waits up to wait seconds for a message to come in."""
+
+        handed_out = [0]
+        pages = self._drain(q, wait, handed_out)
+        try:
+            for page in pages:
+                for tag, message in page:
+                    handed_out[0] = tag
+                    yield message.strip()
+        finally:
+            pages.close()
+
+    def iter_pages(self, q: str, wait: float = CHECK_WAIT, trace=None):
+        """Yields the messages of queue q a page at a time, until it is drained, see
+        iter_messages()."""
+
+        handed_out = [0]
+        pages = self._drain(q, wait, handed_out, trace)
+        try:
+            for page in pages:
+                handed_out[0] = page[-1][0]
+                yield [message.strip() for tag, message in page]
+        finally:
+            pages.close()
+
+    def _drain(self, q: str, wait: float, handed_out: [int], trace=None):
+        """Yields the pages of queue q, as (delivery tag, message) lists, until it is drained.
+        The deliveries up to handed_out[0] (the last one handed out) are acknowledged along
+        with the request for the next page, and once done."""
+
+        acked = 0
+        try:
+            while True:
+                ack = None
+                if handed_out[0] > acked:
+                    # the server answers in order, so the acknowledgement comes back before the page.
+                    ack = self.session.request(framing.OP_ACK, framing.DELIVERY_TAG.pack(handed_out[0]))
+                    acked = handed_out[0]
+                reply = self._call(framing.OP_CHECK, pack_page_check(q, wait), f"Checking Queue {q}", trace,
+                                   "receive")
+                wait = 0.0
+                if ack is not None:
+                    raise_for_status(ack.result(), f"Acknowledging the messages of Queue {q}")
+                if not reply.messages:
+                    return
+                yield reply.messages
+                if not reply.count():
+                    return
+        finally:
+            if handed_out[0] > acked:
+                try:
+                    self._call(framing.OP_ACK, framing.DELIVERY_TAG.pack(handed_out[0]),
+                               f"Acknowledging the messages of Queue {q}")
+                except ConnectionError:
+                    # the server puts the leases of a lost client back into their queue.
+                    pass
+                if trace is not None:
+                    trace.mark("ack")
+
+    def close(self):
+        """Detaches the client from the server, and closes its connection unless it is shared."""
+
+        self.session.close()
+        if self.own_pool is not None:
+            self.own_pool.close()
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncClient:
+    def __init__(self, client: Client):
+        # the requests are sent by the sync client, their replies are awaited.
+        self.client = client
+        self.client_name = client.client_name
+
+    async def _call(self, opcode: int, payload: bytes = b"", what: str = "") -> Reply:
+        """Sends a request and awaits its reply, see Client._call()."""
+
+        import asyncio
+
+        reply = await asyncio.wrap_future(self.client.session.request(opcode, payload))
+        return raise_for_status(reply, what)
+
+    async def upload(self, meters: float, q: str):
+        """Uploads meters to queue q, and waits until the server has stored it."""
+
+        await self._call(framing.OP_UPLOAD, framing.pack_upload(meters, q), f"Uploading to Queue {q}")
+
+    async def upload_many(self, all_meters: [float], q: str) -> int:
+        """Uploads all the values to queue q with a single request. :returns how many were uploaded."""
+
+        reply = await self._call(framing.OP_UPLOAD_BATCH, framing.pack_upload_batch(all_meters, q),
+                                 f"Uploading to Queue {q}")
+        return reply.count()
+
+    async def create_queue(self, q: str, units: [str]):
+        await self._call(framing.OP_CREATE_QUEUE, framing.pack_queue_definition(q, units), f"Creating Queue {q}")
+
+    async def delete_queue(self, q: str):
+        await self._call(framing.OP_DELETE_QUEUE, q.encode("utf-8"), f"Deleting Queue {q}")
+
+    async def list_queues(self) -> {str: [str]}:
+        return framing.unpack_queue_list((await self._call(framing.OP_LIST_QUEUES, what="Listing the queues")).payload)
+
+    async def check(self, q: str, wait: float = CHECK_WAIT) -> [str]:
+        """:returns every message of queue q (draining it), see Client.iter_messages()."""
+
+        return [message async for message in self.iter_messages(q, wait)]
+
+    async def iter_messages(self, q: str, wait: float = CHECK_WAIT):
+        """Yields every message of queue q, until it is drained, see Client.iter_messages()."""
+
+        handed_out = [0]
+        pages = self._drain(q, wait, handed_out)
+        try:
+            async for page in pages:
+                for tag, message in page:
+                    handed_out[0] = tag
+                    yield message.strip()
+        finally:
+            await pages.aclose()
+
+    async def iter_pages(self, q: str, wait: float = CHECK_WAIT):
+        """Yields the messages of queue q a page at a time, until it is drained."""
+
+        handed_out = [0]
+        pages = self._drain(q, wait, handed_out)
+        try:
+            async for page in pages:
+                handed_out[0] = page[-1][0]
+                yield [message.strip() for tag, message in page]
+        finally:
+            await pages.aclose()
+
+    async def _drain(self, q: str, wait: float, handed_out: [int]):
+        """Yields the pages of queue q, see Client._drain()."""
+
+        import asyncio
+
+        acked = 0
+        try:
+            while True:
+                ack = None
+                if handed_out[0] > acked:
+                    ack = asyncio.wrap_future(self.client.session.request(
+                        framing.OP_ACK, framing.DELIVERY_TAG.pack(handed_out[0])))
+                    acked = handed_out[0]
+                reply = await self._call(framing.OP_CHECK, pack_page_check(q, wait), f"Checking Queue {q}")
+                wait = 0.0
+                if ack is not None:
+                    raise_for_status(await ack, f"Acknowledging the messages of Queue {q}")
+                if not reply.messages:
+                    return
+                yield reply.messages
+                if not reply.count():
+                    return
+        finally:
+            if handed_out[0] > acked:
+                try:
+                    await self._call(framing.OP_ACK, framing.DELIVERY_TAG.pack(handed_out[0]),
+                                     f"Acknowledging the messages of Queue {q}")
+                except ConnectionError:
+                    pass
+
+    async def close(self):
+        import asyncio
+
+        await asyncio.get_running_loop().run_in_executor(None, self.client.close)
+
+    async def __aenter__(self) -> "AsyncClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
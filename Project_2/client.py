@@ -2,10 +2,22 @@
 # -*- coding: utf-8 -*-
 
 """ This is the (GUI) client-side of a server/client application in which the client can create
-a number of sub-clients. Each client will have its own socket, and multithreading is used
-to allow clients to send/receive messages from the server simultaneously. A thread
-is created whenever a client wishes to upload or check for messages. Maintenance of
-the queues is done completely on the server side."""
+a number of sub-clients. Every sub-client is a client of the client library (see
+broker_client.py), and they all share a small pool of connections, each attached to one of
+them as a session of its own (see connection_pool.py), so hundreds of sub-clients cost a few
+sockets. Uploads and checks run on a few worker threads, so the GUI never waits for the
+server, and sub-clients send/receive messages from the server simultaneously without a
+thread of their own. Maintenance of the queues is done completely on the server side: the
+queues to pick from are fetched from the server (OP_LIST_QUEUES) whenever a client connects,
+and queues can be created and deleted from the Queues menu.
+
+With --outbox DIR, every sub-client uploads through an outbox of its own in DIR (see
+outbox.py): an upload is kept there until the server has confirmed it, and a sub-client
+that cannot reach the server is kept, rather than deleted, and reconnects on its own.
+
+The worker threads and the outboxes never touch a widget: their status lines go into an
+event_log.EventLog, which a QTimer drains on the GUI thread every STATUS_DRAIN_INTERVAL
+milliseconds."""
 
 __author__ = "Hannan Khan"
 __credits__ = ["Hannan Khan"]
@@ -13,24 +25,35 @@ __version__ = "1.0"
 __maintainer__ = "Hannan Khan"
 __email__ = "hannan.khan@mavs.uta.edu"
 
-import socket
+import argparse
+import os
+import re
 import sys
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5 import QtWidgets, QtGui
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow, QInputDialog, QMessageBox
 
-import utils
+import broker_client
+import framing
+from broker_client import BrokerError, Client, HOST, PORT, CHECK_WAIT
+from connection_pool import ConnectionPool, POOL_SIZE
+from event_log import EventLog
+from outbox import Outbox
+from sessions import SessionRecord, SessionRegistry
+from tracing import Tracer, NULL_TRACE, CLIENT_TRACE_PATH, SAMPLE_RATE
 from utils import UploadCheckDialog
 
-
-HOST = socket.gethostname()
-PORT = 55557
+# how many uploads and checks run at once, each on a worker thread.
+WORKERS = 8
+# how often the status box is brought up to date, in milliseconds.
+STATUS_DRAIN_INTERVAL = 100
 
 
 class ClientApp(QMainWindow):
-    def __init__(self, screen_width, screen_height):
+    def __init__(self, screen_width, screen_height, tracer: Tracer = None, pool_size: int = POOL_SIZE,
+                 outbox_dir: str = None):
         super(ClientApp, self).__init__()
         self.WIDTH = 1000
         self.HEIGHT = 563
@@ -54,14 +77,23 @@ class ClientApp(QMainWindow):
         self.main_layout.addLayout(self.main_inter_layout)
 
         self.current_font = QtGui.QFont("Consolas", 10)
-        # tracks currently selected client.
-        self.selected_client_idx = -1
-        # stores all sockets
-        self.all_sockets: [socket.socket] = []
-        # stores all threads
-        self.all_threads: [threading.Thread] = []
-        # stores all possible queues.
-        self.all_queues = ["A", "B", "C"]
+        # the connections the clients share.
+        self.pool = ConnectionPool(HOST, PORT, pool_size)
+        # every client, by session id and by name. The connection of a record is its Client (or
+        # Outbox), its view is its item in the client list, which carries the session id.
+        self.sessions = SessionRegistry()
+        # the threads uploads and checks run on.
+        self.workers = ThreadPoolExecutor(WORKERS, thread_name_prefix="client_worker")
+        # stores all possible queues, as last listed by the server.
+        self.all_queues: [str] = []
+        # stores the units of every queue, as last listed by the server.
+        self.queue_units: {str: [str]} = {}
+        # traces a sample of the uploads and checks, if set (see tracing.py).
+        self.tracer = tracer
+        # the directory of the outboxes of the clients, if they upload through one (see outbox.py).
+        self.outbox_dir = outbox_dir
+        # the status lines of every thread, shown by drain_status_log().
+        self.status_log = EventLog()
 
         self._init_menu()
         self._init_top_layout()
@@ -70,6 +102,10 @@ class ClientApp(QMainWindow):
 
         self.main_frame.setLayout(self.main_layout)
         self.setCentralWidget(self.main_frame)
+
+        self.status_timer = QTimer(self)
+        self.status_timer.timeout.connect(self.drain_status_log)
+        self.status_timer.start(STATUS_DRAIN_INTERVAL)
         self.show()
 
     def _init_menu(self):
@@ -91,6 +127,20 @@ class ClientApp(QMainWindow):
         self.exit_action.triggered.connect(self.exit_app)
 
         self.file_menu.addActions([self.add_client_action, self.delete_client_action, self.exit_action])
+
+        self.queues_menu = self.top_menu_bar.addMenu("&Queues")
+
+        self.create_queue_action = QtWidgets.QAction("&New Queue", self)
+        self.create_queue_action.setShortcut(QtGui.QKeySequence(Qt.CTRL + Qt.Key_N))
+        self.create_queue_action.triggered.connect(self.create_queue_handler)
+
+        self.delete_queue_action = QtWidgets.QAction("De&lete Queue", self)
+        self.delete_queue_action.triggered.connect(self.delete_queue_handler)
+
+        self.list_queues_action = QtWidgets.QAction("&List Queues", self)
+        self.list_queues_action.triggered.connect(self.list_queues_handler)
+
+        self.queues_menu.addActions([self.create_queue_action, self.delete_queue_action, self.list_queues_action])
         self.main_layout.setMenuBar(self.top_menu_bar)
 
     def _init_top_layout(self):
@@ -118,6 +168,11 @@ class ClientApp(QMainWindow):
         self.upload_message_btn.setText("Upload Message")
         self.upload_message_btn.clicked.connect(self.upload_handler)
 
+        self.upload_batch_btn = QtWidgets.QPushButton()
+        self.upload_batch_btn.setFont(self.current_font)
+        self.upload_batch_btn.setText("Upload Batch")
+        self.upload_batch_btn.clicked.connect(self.upload_batch_handler)
+
         self.check_messages_btn = QtWidgets.QPushButton()
         self.check_messages_btn.setFont(self.current_font)
         self.check_messages_btn.setText("Check Messages")
@@ -127,6 +182,7 @@ class ClientApp(QMainWindow):
         self.top_layout.addWidget(self.add_client_button)
         self.top_layout.addWidget(self.delete_client_button)
         self.top_layout.addWidget(self.upload_message_btn)
+        self.top_layout.addWidget(self.upload_batch_btn)
         self.top_layout.addWidget(self.check_messages_btn)
 
         self.main_inter_layout.addLayout(self.top_layout)
@@ -170,122 +226,207 @@ class ClientApp(QMainWindow):
                                                                         "be empty.")
 
         if boo and client_name:
-            # we add the client to the list of clients to display
-            new_client_widget_item = QtWidgets.QListWidgetItem()
-            new_client_widget_item.setFont(self.current_font)
-            new_client_widget_item.setText(client_name)
-            self.client_list_widget.addItem(new_client_widget_item)
-            self.client_list_widget.setCurrentItem(self.client_list_widget.item(self.client_list_widget.count() - 1))
-            self.update_selected_client_idx()
-            client_idx = utils.get_client_idx(self, client_name)
-            client_sock = self.create_client_socket(client_name, new_client_widget_item, client_idx)
-            # check for if the user wants to upload or check for new messages.
-            self.ask_user_upload_check(client_name, client_sock, client_idx)
-
-    def ask_user_upload_check(self, client_name, client_sock, client_idx):
+            record = self.create_client(client_name)
+            if record is not None:
+                # we add the client to the list of clients to display
+                new_client_widget_item = QtWidgets.QListWidgetItem()
+                new_client_widget_item.setFont(self.current_font)
+                new_client_widget_item.setText(client_name)
+                new_client_widget_item.setData(Qt.UserRole, record.session_id)
+                record.view = new_client_widget_item
+                self.client_list_widget.addItem(new_client_widget_item)
+                self.client_list_widget.setCurrentItem(new_client_widget_item)
+                # check for if the user wants to upload or check for new messages.
+                self.ask_user_upload_check(record)
+
+    def ask_user_upload_check(self, record: SessionRecord):
         """Asks the newly created client if they want to upload a message, or check a
         queue for messages.
         Uses custom UploadCheckDialog (located in utils.py)."""
 
-        qstn_box = UploadCheckDialog(self.current_font, client_name, client_idx)
+        qstn_box = UploadCheckDialog(self.current_font, record.client_name, record.session_id)
         qstn_box.exec_()
         if qstn_box.selection == -1:
             # close button selected.
             pass
         elif qstn_box.selection == 0:
             # Here we carry out the upload option.
-            self.upload_handler(client_name, client_sock, client_idx)
+            self.upload_handler(record)
         elif qstn_box.selection == 1:
             # Here we carry out the Check for messages option.
-            self.check_handler(client_name, client_sock, client_idx)
+            self.check_handler(record)
+
+    def create_client(self, client_name) -> SessionRecord:
+        """Connects the client on the pool of connections, which sends the client name to the
+        server. If the client is added, It will return its record in the session registry
+        back to add_new_client(). Otherwise, if the server is not running, None is returned
+        and the client is never listed, unless it uploads through an outbox."""
+
+        if self.outbox_dir:
+            client = self.create_outbox_client(client_name)
+        else:
+            try:
+                client = broker_client.connect(client_name, pool=self.pool)
+            except Exception as e:
+                # handles for if the server is NOT running currently.
+                self.update_status(e.__str__())
+                self.update_status(f"{client_name} could not connect.")
+                self.update_status(f"Deleting {client_name}.")
+                return None
+
+            # handle the addition of a client here.
+            self.update_status(f"SERVER: {client_name} added.")
+            self.refresh_queues(client)
+        return self.sessions.add(client_name, client)
+
+    def create_outbox_client(self, client_name) -> Outbox:
+        """Opens the outbox of the client (sending what it still holds from the last time), which
+        connects it on the pool of connections, or keeps trying to until the server is up."""
+
+        os.makedirs(self.outbox_dir, exist_ok=True)
+        path = os.path.join(self.outbox_dir, re.sub(r"[^\w.-]", "_", client_name) + ".outbox")
+        client = Outbox(path, client_name, pool=self.pool, status_fn=self.update_status)
+        if client.connected:
+            self.update_status(f"SERVER: {client_name} added.")
+            self.refresh_queues(client)
+        else:
+            self.update_status(f"{client_name} will connect once the server is up.")
+        return client
+
+    def run_in_worker(self, client_name: str, func, *args):
+        """Runs func(*args) on a worker thread, and tells the user if its connection was lost."""
+
+        def run():
+            try:
+                func(*args)
+            except ConnectionError as e:
+                self.update_status(f"{client_name}: {e}")
+
+        self.workers.submit(run)
+
+    def refresh_queues(self, client: Client):
+        """Asks the server for the queues that currently exist (OP_LIST_QUEUES), and stores
+        them as the queues to pick from."""
+
+        try:
+            self.queue_units = client.list_queues()
+        except (BrokerError, ConnectionError) as e:
+            self.update_status(f"{client.client_name}: {e}")
+            return
+        self.all_queues = list(self.queue_units)
+
+    def get_selected_record(self, error_message: str = "You must select a client first.") -> SessionRecord:
+        """:returns the record of the client selected in the client list, found by the session
+        id its item carries, or None (after telling the user error_message) if none is selected."""
 
-    def create_client_socket(self, client_name, new_client_widget_item, client_idx) -> socket.socket:
-        """Creates the sockets for each client, and then sends the client name to the server.
-        If the client is added, It will return the client socket back to add_new_client().
-        Otherwise, if the server is not running, the client socket is closed and the client
-        is deleted."""
+        if self.client_list_widget.currentItem() is None:
+            msg_box = QMessageBox(QMessageBox.Information, "Error", error_message)
+            msg_box.exec_()
+            return None
+        return self.sessions.get(self.client_list_widget.currentItem().data(Qt.UserRole))
+
+    def get_selected_client(self) -> (str, Client):
+        """:returns the name of the client selected in the client list and the client, or
+        ("", None) (after telling the user) if none is selected."""
+
+        record = self.get_selected_record()
+        if record is None:
+            return "", None
+        return record.client_name, record.connection
+
+    def create_queue_handler(self):
+        """Asks the user for the name and the units of a new queue, then creates it on a worker
+        thread via the currently selected client."""
 
-        client_added_msg = ""
+        client_name, client = self.get_selected_client()
+        if client is None:
+            return
+
+        q, boo = QInputDialog.getText(self, "New Queue", "Insert New Queue Name:")
+        if boo and q:
+            text, boo = QInputDialog.getText(self, "New Queue", f"Enter the units of Queue {q} (separated by spaces):")
+            units = text.replace(",", " ").split()
+            if boo and units:
+                self.run_in_worker(client_name, self.create_queue, client_name, client, q, units)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.all_sockets.append(sock)
+    def create_queue(self, client_name: str = "", client: Client = None, q: str = "", units: [str] = ()):
+        """Asks the server to create queue q with the given units, then refreshes the queues."""
 
         try:
-            sock.connect((HOST, PORT))
-            sock.send(bytes(client_name, "utf-8"))
-            client_added_msg = sock.recv(1024).decode("utf-8")
-        except Exception as e:
-            # handles for if the server is NOT running currently.
-            self.update_status(e.__str__())
-            self.update_status(f"The socket for {client_name} could not connect.")
-            self.update_status(f"Deleting {client_name}.")
-            self.delete_client(client_name, client_idx, sock)
-
-        if client_added_msg == f"SERVER: {client_name} added.":
-            # handle the addition of a client here.
-            self.update_status(client_added_msg)
-            return sock
+            client.create_queue(q, units)
+            self.update_status(f"SERVER: Queue {q} created by {client_name}.")
+        except BrokerError as e:
+            self.update_status(f"SERVER: Error - Queue {q} could not be created. {e}")
+        self.refresh_queues(client)
+
+    def delete_queue_handler(self):
+        """Asks the user which queue to delete, then deletes it on a worker thread via the
+        currently selected client."""
+
+        client_name, client = self.get_selected_client()
+        if client is None:
+            return
+
+        q, boo = QInputDialog.getItem(self, "Delete Queue", f"{client_name}:\nWhich queue would you like to delete?",
+                                      self.all_queues, 0, False)
+        if boo and q:
+            self.run_in_worker(client_name, self.delete_queue, client_name, client, q)
+
+    def delete_queue(self, client_name: str = "", client: Client = None, q: str = ""):
+        """Asks the server to delete queue q (and every message in it), then refreshes the queues."""
+
+        try:
+            client.delete_queue(q)
+            self.update_status(f"SERVER: Queue {q} deleted by {client_name}.")
+        except BrokerError:
+            self.update_status(f"SERVER: Error - Queue {q} does not exist.")
+        self.refresh_queues(client)
 
-    def update_selected_client_idx(self):
-        """Updates the self.selected_client_idx based on which client is selected in the
-        self.client_list_widget."""
+    def list_queues_handler(self):
+        """Refreshes the queues via the currently selected client, and shows them with their units."""
 
-        if self.client_list_widget.count() == 0:
-            self.selected_client_idx = -1
+        client_name, client = self.get_selected_client()
+        if client is None:
             return
 
-        for i in range(0, self.client_list_widget.count()):
-            item = self.client_list_widget.item(i)
-            if item.isSelected():
-                self.selected_client_idx = i
-                break
+        self.refresh_queues(client)
+        self.update_status(f"\nQUEUES ({len(self.all_queues)}):::::::::::::")
+        for q, units in self.queue_units.items():
+            self.update_status(f"{q}: {' '.join(units)}")
+        self.update_status("END QUEUES::::::::::::::::::::\n")
 
-    def delete_client(self, client_name: str = "", client_idx: int = -1, sock: socket.socket = None):
+    def delete_client(self, record: SessionRecord = None):
         """Deletes a client. If a client has been given in parameters, then it will delete
         that client. Otherwise, it will delete the client that is currently selected in the
         client list widget."""
 
-        if (not client_name) and (client_idx == -1) and (not sock) and (self.client_list_widget.currentItem() is None):
-            # handles for no clients existing.
-            msg_box = QMessageBox(QMessageBox.Information, "Error", "You must select a client to delete.")
-            msg_box.exec_()
-            return
-        elif (not client_name) and (client_idx == -1) and (not sock):
-            # Here we handle if a user has clicked the delete button.
+        if not record:
+            # Here we handle if a user has clicked the delete button (which passes False).
             # we handle by getting operating on the currently selected client in the client list
-            client_widget_to_delete = self.client_list_widget.item(self.client_list_widget.currentRow())
-            client_name = client_widget_to_delete.text()
-            client_idx = utils.get_client_idx(self, client_name)
-            sock = self.all_sockets[client_idx]
-
-        # here the client will be sending the 'END CONNECTION' message to the server.
-        sock.send(bytes("END CONNECTION", "utf-8"))
-        self.update_status(f"Closing and removing {client_name}'s socket...")
-        sock.close()
-        self.all_sockets.remove(sock)
+            record = self.get_selected_record("You must select a client to delete.")
+            if record is None:
+                return
+
+        client_name = record.client_name
+        # here the client will be detached from the server (OP_END_SESSION), its connection stays open.
+        self.update_status(f"Detaching {client_name} from the server...")
+        record.connection.close()
+        self.sessions.remove(record.session_id)
         self.update_status(f"Removing {client_name} from list.")
-        self.client_list_widget.takeItem(client_idx)
+        self.client_list_widget.takeItem(self.client_list_widget.row(record.view))
         self.update_status(f"Deleted client: {client_name}.")
-        self.update_selected_client_idx()
 
-    def upload_handler(self, client_name: str = "", client_sock: socket.socket = None,
-                       client_idx: int = -1):
-        """Creates a thread to handle upload a message via a client.
-        Asks user for meters and which queue to upload to...
-        Starts a thread to upload from that particular client."""
+    def upload_handler(self, record: SessionRecord = None):
+        """Asks user for meters and which queue to upload to, then uploads it on a worker
+        thread via a client."""
 
-        if (not client_name) and (not client_sock) and (client_idx == -1):
-            # Here we handle if a user has clicked the button.
+        if not record:
+            # Here we handle if a user has clicked the button (which passes False).
             # we handle by getting operating on the currently selected client in the client list
-            if self.client_list_widget.currentItem() is None:
-                msg_box = QMessageBox(QMessageBox.Information, "Error",
-                                      "You must select a client to be able to upload.")
-                msg_box.exec_()
+            record = self.get_selected_record("You must select a client to be able to upload.")
+            if record is None:
                 return
-            new_client_widget = self.client_list_widget.currentItem()
-            client_name = new_client_widget.text()
-            client_idx = utils.get_client_idx(self, client_name)
-            client_sock = self.all_sockets[client_idx]
+        client_name, client = record.client_name, record.connection
 
         # We get the METERS input from the user:
         num, boo = QInputDialog.getDouble(self, "User Input", "Enter Meters:")
@@ -296,58 +437,80 @@ class ClientApp(QMainWindow):
                                           f"{client_name}:\nWhich queue would you like to upload to?",
                                           self.all_queues, 0, False)
             if boo:
-                # we handle by creating a thread to operate via the clients socket (should have already been created).
-                t = threading.Thread(name=client_name, target=self.upload, args=(client_name,
-                                                                                 client_sock, num, q), daemon=True)
-                t.start()
+                self.run_in_worker(client_name, self.upload, client_name, client, num, q)
 
-    def upload(self, client_name: str = "", client_sock: socket.socket = None, meters: float = 0.0, q: str = ""):
+    def upload(self, client_name: str = "", client: Client = None, meters: float = 0.0, q: str = ""):
         """Uploads the meters and queue to the server, where the message broker will
-        take care of conversion and storage into the correct queue.
-        Each thread that runs this function will terminate after this function is complete."""
-
-        server_msg = ""
+        take care of conversion and storage into the correct queue."""
 
-        # we prep the server for upload with this message.
-        client_sock.send(bytes("UPLOAD", "utf-8"))
+        trace = self.start_trace("upload", client_name)
+        # Then we wait for conformation from the Message Broker saying that the input
+        # has been converted and uploaded to the right queue.
+        try:
+            client.upload(meters, q, trace)
+            if isinstance(client, Outbox):
+                # the outbox tells once the server has it.
+                self.update_status(f"{client_name} has put {meters} for Queue {q} into its outbox.")
+            else:
+                self.update_status(f"SERVER: {client_name} has uploaded {meters} to Queue {q}.")
+        except BrokerError:
+            self.update_status(f"SERVER: Error - {client_name} could not upload to Queue {q}")
+            self.update_status("Upload failed. Please try again.")
+        trace.mark("display")
+        trace.set(queue=q, messages=1)
+        trace.finish()
 
-        # keep sending until server responds with 'METERS RECEIVED'
-        while server_msg != "METERS RECEIVED":
-            # Now we send the meters input...
-            client_sock.send(bytes(str(meters), "utf-8"))
-            # We wait for ACK message
-            server_msg = client_sock.recv(1024).decode("utf-8")
+    def upload_batch_handler(self):
+        """Asks the user for a number of meters values (separated by spaces or commas) and
+        which queue to upload them to. Uploads all of them at once on a worker thread, from
+        the currently selected client."""
 
-        # Now we send the queue to upload to...
-        while server_msg != "QUEUE RECEIVED":
-            client_sock.send(bytes(q, "utf-8"))
-            server_msg = client_sock.recv(1024).decode("utf-8")
+        record = self.get_selected_record("You must select a client to be able to upload.")
+        if record is None:
+            return
+        client_name, client = record.client_name, record.connection
 
-        # Now we wait for conformation from the Message Broker saying that the input
-        # has been converted and uploaded to the right queue.
-        server_msg = client_sock.recv(1024).decode("utf-8")
-        if server_msg == f"SERVER: {client_name} has uploaded {meters} to Queue {q}.":
-            self.update_status(server_msg)
-        elif server_msg == f"SERVER: Error - {client_name} could not upload to Queue {q}":
-            self.update_status(server_msg)
-            self.update_status("Upload failed. Please try again.")
+        text, boo = QInputDialog.getText(self, "User Input", "Enter Meters (separated by spaces):")
+        try:
+            all_meters = [float(value) for value in text.replace(",", " ").split()]
+        except ValueError:
+            self.update_status("Batch upload cancelled, all values must be numbers.")
+            return
+        if boo and all_meters:
+            q, boo = QInputDialog.getItem(self, "Select Queue",
+                                          f"{client_name}:\nWhich queue would you like to upload to?",
+                                          self.all_queues, 0, False)
+            if boo:
+                self.run_in_worker(client_name, self.upload_many, client_name, client, all_meters, q)
 
-    def check_handler(self, client_name: str = "", client_sock: socket.socket = None,
-                      client_idx: int = -1):
-        """Asks the user which queue to check and creates a thread to handle the checking
-        of messages via a client."""
+    def upload_many(self, client_name: str = "", client: Client = None, all_meters: [float] = (), q: str = ""):
+        """Uploads many meters values to a queue with a single request (OP_UPLOAD_BATCH).
+        The server converts and stores all of them at once, and confirms with the count."""
 
-        if (not client_name) and (not client_sock) and (client_idx == -1):
-            # Here we handle if a user has clicked the button.
-            if self.client_list_widget.currentItem() is None:
-                msg_box = QMessageBox(QMessageBox.Information, "Error", "You must select a client to be able to check.")
-                msg_box.exec_()
-                return
+        trace = self.start_trace("upload_batch", client_name)
+        try:
+            count = client.upload_many(all_meters, q, trace)
+            if isinstance(client, Outbox):
+                self.update_status(f"{client_name} has put {count} values for Queue {q} into its outbox.")
+            else:
+                self.update_status(f"SERVER: {client_name} has uploaded {count} values to Queue {q}.")
+        except BrokerError:
+            self.update_status(f"SERVER: Error - {client_name} could not upload to Queue {q}")
+            self.update_status("Batch upload failed. Please try again.")
+        trace.mark("display")
+        trace.set(queue=q, messages=len(all_meters))
+        trace.finish()
+
+    def check_handler(self, record: SessionRecord = None):
+        """Asks the user which queue to check, and checks it on a worker thread via a client."""
+
+        if not record:
+            # Here we handle if a user has clicked the button (which passes False).
             # we handle by getting operating on the currently selected client in the client list
-            new_client_widget = self.client_list_widget.currentItem()
-            client_name = new_client_widget.text()
-            client_idx = utils.get_client_idx(self, client_name)
-            client_sock = self.all_sockets[client_idx]
+            record = self.get_selected_record("You must select a client to be able to check.")
+            if record is None:
+                return
+        client_name, client = record.client_name, record.connection
 
         boo = False
         q = ""
@@ -357,77 +520,103 @@ class ClientApp(QMainWindow):
                                       self.all_queues, 0, False)
 
         if boo and q:
-            # we handle by creating a thread to operate via the clients socket (has already been created).
-            t = threading.Thread(name=client_name, target=self.check, args=(client_name,
-                                                                            client_sock, q), daemon=True)
-            t.start()
-
-    def check(self, client_name, client_sock, q):
-        """Preps the server for a check operation.
-        Sends the queue selection (already done in check_handler()).
-        Receives conformation of whether messages exist in that queue.
-        If messages, downloads and stores in temporary var messages, displays to user.
-        if no messages, informs user and terminates the thread."""
-
-        messages = []
-
-        server_msg = ""
-
-        # we will prep the server for a check operation.
-        client_sock.send(bytes("CHECK", "utf-8"))
-
-        while server_msg != "QUEUE SELECTION RECEIVED":
-            client_sock.send(bytes(q, "utf-8"))
-            server_msg = client_sock.recv(1024).decode("utf-8")
-
-        # now we seek conformation that there exists messages for us to receive.
-        server_msg = client_sock.recv(1024).decode("utf-8")
-
-        if server_msg == f"SERVER: Messages available in Queue {q}.":
-            # tell server we are ready for the download.
-            client_sock.send(bytes("READY", "utf-8"))
-            # download the messages here.
-            while server_msg != "ALL MESSAGES SENT.":
-                server_msg = client_sock.recv(1024).decode("utf-8")
-                if server_msg != "ALL MESSAGES SENT.":
-                    messages.append(server_msg)
-            self.update_status(f"\nMESSAGE RECEIVED FROM QUEUE {q}:::::::::::::")
-            # display messages to user via GUI.
-            for message in messages:
-                self.update_status(message.strip())
-            self.update_status("END MESSAGE::::::::::::::::::::\n")
-        elif server_msg == f"SERVER: NO MESSAGES IN QUEUE {q}.":
-            # Handle here. terminate the thread by returning.
-            self.update_status(server_msg)
-            return
+            self.run_in_worker(client_name, self.check, client_name, client, q)
+
+    def check(self, client_name, client, q):
+        """Drains the queue selected (already done in check_handler()) a page at a time (see
+        Client.iter_pages()). Each page is displayed to the user as soon as it has arrived, and
+        the next page is asked for until none are left, so only one page is ever held in memory.
+        Every message is leased until it is acknowledged: once a page is displayed, it is
+        acknowledged together with the request for the next page.
+        If the queue is empty, the server holds the first request for up to CHECK_WAIT seconds,
+        and answers it as soon as a message comes in. if no messages, informs user."""
+
+        received = 0
+        status = framing.STATUS_OK
+        # a single trace covers every page, it carries the request id of the first one.
+        trace = self.start_trace("check", client_name)
+        try:
+            for page in client.iter_pages(q, CHECK_WAIT, trace):
+                if received == 0:
+                    self.update_status(f"\nMESSAGE RECEIVED FROM QUEUE {q}:::::::::::::")
+                # display the page to user via GUI.
+                self.update_status("\n".join(page))
+                trace.mark("display")
+                received += len(page)
+        except BrokerError as e:
+            status = e.status
+        trace.set(queue=q, messages=received)
+        trace.finish()
+
+        if received > 0:
+            self.update_status(f"END MESSAGE ({received} messages)::::::::::::::::::::\n")
+        elif status == framing.STATUS_OK:
+            self.update_status(f"SERVER: NO MESSAGES IN QUEUE {q}.")
+        elif status == framing.STATUS_NOT_FOUND:
+            self.update_status(f"SERVER: QUEUE {q} DOES NOT EXIST.")
+        elif status == framing.STATUS_WINDOW_FULL:
+            self.update_status(f"SERVER: {client_name} HOLDS TOO MANY UNACKNOWLEDGED MESSAGES.")
+
+    def start_trace(self, kind: str, client_name: str):
+        """:returns the trace of a request, NULL_TRACE if it is not traced. It gets the request
+        id once the request is sent."""
+
+        return self.tracer.start(kind, 0, client_name) if self.tracer is not None else NULL_TRACE
 
     def update_status(self, status_message):
-        """Updates the status by adding a line to the status box. It will also keep scrolling
-        to the bottom each time it updates."""
+        """Adds a line for the status box. Safe to call from any thread, the line is shown by
+        drain_status_log()."""
+
+        self.status_log.push(status_message)
+
+    def drain_status_log(self):
+        """Runs on the GUI thread every STATUS_DRAIN_INTERVAL milliseconds. Adds the status
+        lines that came in since the last run to the status box in one go. It will also keep
+        scrolling to the bottom each time it updates."""
 
-        self.status_box.append(status_message)
+        lines, dropped = self.status_log.drain()
+        if dropped:
+            lines.insert(0, f"... {dropped} status lines skipped ...")
+        if not lines:
+            return
+        self.status_box.append("\n".join(lines))
         # reference: https://stackoverflow.com/questions/7778726/autoscroll-pyqt-qtextwidget
         self.status_box.moveCursor(QtGui.QTextCursor.End)
-        self.update()
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         self.exit_app()
 
     def exit_app(self):
-        """Closes all sockets and exits the app. Threads are all set to Daemon, they need
-        not be joined() before exiting."""
-
-        for sock in self.all_sockets:
-            sock.close()
-
-        # no need to handle the threads as they are all set to daemon.
+        """Closes every connection of the pool and exits the app. Uploads and checks still
+        running on a worker thread are abandoned, what is left in an outbox is sent the next
+        time the client is added."""
+
+        self.workers.shutdown(wait=False)
+        for record in self.sessions.records():
+            if isinstance(record.connection, Outbox):
+                record.connection.close()
+        self.pool.close()
+        if self.tracer is not None:
+            self.tracer.close()
         sys.exit(0)
 
 
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Runs the client GUI.")
+    parser.add_argument("--trace", nargs="?", const=CLIENT_TRACE_PATH, metavar="FILE",
+                        help=f"trace the phases of a sample of the uploads and checks (into {CLIENT_TRACE_PATH})")
+    parser.add_argument("--trace-sample", type=float, default=SAMPLE_RATE,
+                        help="the fraction of the requests that is traced")
+    parser.add_argument("--connections", type=int, default=POOL_SIZE,
+                        help="how many connections the clients share at most")
+    parser.add_argument("--outbox", metavar="DIR",
+                        help="keep the uploads of every client in an outbox file in DIR until the server has them")
+    args, qt_args = parser.parse_known_args()
+    tracer = Tracer(args.trace, "client", args.trace_sample) if args.trace else None
+
+    app = QApplication([sys.argv[0]] + qt_args)
     screen_size = app.primaryScreen().size()
-    GUI = ClientApp(screen_size.width(), screen_size.height())
+    GUI = ClientApp(screen_size.width(), screen_size.height(), tracer, args.connections, args.outbox)
     sys.exit(app.exec_())
 
 
@@ -0,0 +1,351 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the connection pool of the client. Instead of a socket (and a name handshake) for
+every sub-client, sub-clients share a few persistent connections to the server: every
+sub-client is attached (OP_HELLO) to the connection with the fewest sub-clients as a session
+of its own, and its requests are tagged with its session (OP_SESSION, sent only when the
+session changes), so the server still tells the sub-clients apart. Each has its own name,
+consumer and leases on the server.
+
+Requests do not block. Every request gets a request id of its connection, and a Request (a
+Future) which the reader thread of the connection resolves with the Reply once the OP_STATUS
+with that request id comes in, so any number of sub-clients and threads may have requests
+outstanding on a connection at once. The OP_MESSAGE frames of a page (see OP_CHECK) are
+collected into the Reply as they come in.
+
+Callbacks added to a Request run on the reader thread: they may send further requests, but
+must not wait for the reply to one, since it would be read by the very thread that waits.
+
+A producer need not wait for every upload to be confirmed before sending the next: a
+Pipeline keeps up to max_in_flight uploads of a session in flight at once, so a single
+producer is bound by the broker instead of by the round trip. Only once that many are
+unconfirmed does the next upload wait, for the first one to be confirmed:
+    pipeline = Pipeline(session, max_in_flight=64)
+    for meters in all_meters:
+        pipeline.upload(meters, "A", callback)
+    pipeline.flush()
+
+Nothing here depends on Qt:
+    pool = ConnectionPool(host, port)
+    session = pool.attach("client1")
+    reply = session.request(framing.OP_UPLOAD, framing.pack_upload(1.5, "A")).result()
+    session.close()
+    pool.close()"""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import functools
+import itertools
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import framing
+
+# how many connections the sub-clients share at most.
+POOL_SIZE = 4
+# how long (in seconds) to wait for the server to accept a connection, or a sub-client.
+CONNECT_TIMEOUT = 5.0
+# how long (in seconds) an idle connection goes before it is probed (TCP keepalive), how long
+# between probes, and how many probes go unanswered before the connection is taken for lost.
+# A link that drops silently then fails the connection within a minute, instead of leaving
+# it half-open.
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+# request ids are 32 bit, they start over once they run out.
+REQUEST_ID_MASK = 0xFFFFFFFF
+# how many uploads a pipeline keeps in flight at most.
+MAX_IN_FLIGHT = 64
+
+
+class Reply:
+    def __init__(self, status: int, payload: bytes, messages: [(int, str)]):
+        # the status code of the OP_STATUS frame, and the rest of its payload.
+        self.status = status
+        self.payload = payload
+        # the (delivery tag, message) of every OP_MESSAGE that came before it.
+        self.messages = messages
+
+    def count(self) -> int:
+        """:returns the count the reply holds (see framing.COUNT)."""
+
+        return framing.COUNT.unpack_from(self.payload)[0]
+
+    def text(self) -> str:
+        """:returns the reason given by a STATUS_ERROR reply."""
+
+        return self.payload.decode("utf-8", "replace")
+
+
+class Request(Future):
+    def __init__(self, request_id: int):
+        super(Request, self).__init__()
+        self.request_id = request_id
+        # the OP_MESSAGE frames received so far, see Reply.messages.
+        self.messages: [(int, str)] = []
+
+
+class Connection:
+    def __init__(self, host: str, port: int):
+        """Connects to the server. Raises OSError if it cannot be reached."""
+
+        self.sock = socket.create_connection((host, port), CONNECT_TIMEOUT)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            # not available on every platform, which then probes after hours instead.
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+        self.reader = framing.FrameReader(self.sock)
+        self.request_ids = itertools.count(1)
+        # held while a request is sent, so the frames of a request are never interleaved.
+        self.send_lock = threading.Lock()
+        # the session the server takes requests to be from, None if it is not known yet.
+        self.current_session: int = None
+        # the requests waiting for their reply, by request id.
+        self.pending: {int: Request} = {}
+        # how many sub-clients are attached, kept by the pool.
+        self.session_count = 0
+        self.closed = False
+        self.reader_thread = threading.Thread(target=self._read, name="connection_reader", daemon=True)
+        self.reader_thread.start()
+
+    def request(self, session_id: int, opcode: int, payload: bytes = b"") -> Request:
+        """Sends a request on behalf of session session_id (an OP_HELLO attaches a new one).
+        :returns its Request, resolved with the Reply. Raises ConnectionError if the
+        connection is closed."""
+
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionError("The connection to the server is closed.")
+            request = Request(next(self.request_ids) & REQUEST_ID_MASK)
+            frames = framing.encode_frame(opcode, request.request_id, payload)
+            if opcode == framing.OP_HELLO:
+                # the server switches to the new session, whose id is in the reply.
+                self.current_session = None
+            elif session_id != self.current_session:
+                frames = framing.encode_frame(framing.OP_SESSION, 0, framing.COUNT.pack(session_id)) + frames
+                self.current_session = session_id
+            self.pending[request.request_id] = request
+            try:
+                self.sock.sendall(frames)
+            except OSError as e:
+                self.pending.pop(request.request_id, None)
+                raise ConnectionError(f"The request could not be sent: {e}")
+        return request
+
+    def _read(self):
+        """The reader thread. Hands every reply to the Request waiting for it, until the
+        connection is closed."""
+
+        try:
+            while True:
+                for opcode, request_id, payload in self.reader.read_frames():
+                    request = self.pending.get(request_id)
+                    if request is None:
+                        # e.g. a message pushed to a subscription.
+                        continue
+                    if opcode == framing.OP_MESSAGE:
+                        request.messages.append(framing.unpack_message(payload))
+                    elif opcode == framing.OP_STATUS:
+                        del self.pending[request_id]
+                        request.set_result(Reply(payload[0], payload[framing.STATUS.size:], request.messages))
+        except (ConnectionError, OSError) as e:
+            self._fail(ConnectionError(f"The connection to the server was lost: {e}"))
+
+    def _fail(self, error: Exception):
+        """Marks the connection closed, and fails every request still waiting with error."""
+
+        with self.send_lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for request in pending.values():
+            request.set_exception(error)
+
+    def close(self):
+        """Ends the connection (OP_END_CONNECTION). Requests still waiting fail."""
+
+        with self.send_lock:
+            if not self.closed:
+                try:
+                    framing.send_frame(self.sock, framing.OP_END_CONNECTION, 0)
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.sock.close()
+        if threading.current_thread() is not self.reader_thread:
+            self.reader_thread.join()
+
+
+class Session:
+    def __init__(self, pool: "ConnectionPool", connection: Connection, client_name: str, session_id: int):
+        self.pool = pool
+        self.connection = connection
+        self.client_name = client_name
+        self.session_id = session_id
+
+    def request(self, opcode: int, payload: bytes = b"") -> Request:
+        """Sends a request as this sub-client. :returns its Request (see Connection.request())."""
+
+        return self.connection.request(self.session_id, opcode, payload)
+
+    def close(self):
+        """Detaches the sub-client (OP_END_SESSION), without waiting for the server to confirm.
+        Its connection stays open for the others."""
+
+        try:
+            self.request(framing.OP_END_SESSION)
+        except ConnectionError:
+            pass
+        self.pool.release(self.connection)
+
+
+class ConnectionPool:
+    def __init__(self, host: str, port: int, size: int = POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.all_connections: [Connection] = []
+        # held while connections are opened, handed out or dropped.
+        self.lock = threading.Lock()
+
+    def attach(self, client_name: str) -> Session:
+        """Attaches a sub-client to the connection with the fewest sub-clients, or to a new one
+        if every connection has some and the pool is not full. :returns its Session. Raises OSError (ConnectionError)
+        if the server cannot be reached or does not accept it."""
+
+        connection = self._acquire()
+        try:
+            request = connection.request(None, framing.OP_HELLO, client_name.encode("utf-8"))
+        except Exception:
+            self.release(connection)
+            raise
+        try:
+            reply = request.result(CONNECT_TIMEOUT)
+            if reply.status != framing.STATUS_OK:
+                raise ConnectionError(f"The server did not accept {client_name}.")
+        except TimeoutError:
+            self.release(connection)
+            # the server may still attach the client, which is detached as soon as the reply comes in.
+            request.add_done_callback(functools.partial(self._end_late_session, connection))
+            raise
+        except Exception:
+            self.release(connection)
+            raise
+        return Session(self, connection, client_name, reply.count())
+
+    @staticmethod
+    def _end_late_session(connection: Connection, request: Request):
+        """Detaches (OP_END_SESSION) the client of an OP_HELLO answered after attach() gave up
+        on it, so its session and consumer are not left behind on the server. Runs on the
+        reader thread."""
+
+        if request.exception() is not None or request.result().status != framing.STATUS_OK:
+            return
+        try:
+            connection.request(request.result().count(), framing.OP_END_SESSION)
+        except ConnectionError:
+            pass
+
+    def _acquire(self) -> Connection:
+        """:returns the connection a new sub-client is attached to, counted as taken."""
+
+        with self.lock:
+            # the connections that were lost are dropped, their sub-clients have to attach again.
+            self.all_connections = [connection for connection in self.all_connections if not connection.closed]
+            idle = [connection for connection in self.all_connections if not connection.session_count]
+            if not idle and len(self.all_connections) < self.size:
+                connection = Connection(self.host, self.port)
+                self.all_connections.append(connection)
+            else:
+                connection = min(self.all_connections, key=lambda each_connection: each_connection.session_count)
+            connection.session_count += 1
+            return connection
+
+    def release(self, connection: Connection):
+        """Counts a sub-client of connection as gone."""
+
+        with self.lock:
+            connection.session_count -= 1
+
+    def close(self):
+        """Closes every connection of the pool."""
+
+        with self.lock:
+            all_connections, self.all_connections = self.all_connections, []
+        for connection in all_connections:
+            connection.close()
+
+
+class Pipeline:
+    def __init__(self, session: Session, max_in_flight: int = MAX_IN_FLIGHT):
+        self.session = session
+        self.max_in_flight = max_in_flight
+        # a slot is taken by every request in flight, and given back once it is confirmed.
+        self.slots = threading.Semaphore(max_in_flight)
+        # the requests in flight, by request id.
+        self.in_flight: {int: Request} = {}
+        self.lock = threading.Lock()
+
+    def upload(self, meters: float, q: str, callback=None, timeout: float = None) -> Request:
+        """Uploads meters to queue q (OP_UPLOAD), see submit()."""
+
+        return self.submit(framing.OP_UPLOAD, framing.pack_upload(meters, q), callback, timeout)
+
+    def upload_many(self, all_meters: [float], q: str, callback=None, timeout: float = None) -> Request:
+        """Uploads all the values to queue q with a single request (OP_UPLOAD_BATCH), see submit()."""
+
+        return self.submit(framing.OP_UPLOAD_BATCH, framing.pack_upload_batch(all_meters, q), callback, timeout)
+
+    def submit(self, opcode: int, payload: bytes, callback=None, timeout: float = None) -> Request:
+        """Sends a request as soon as fewer than max_in_flight are in flight, waiting at most
+        timeout seconds for that (forever if None). callback (if any) is called with the
+        Request once it is confirmed, on the reader thread, so it must not submit to a full
+        pipeline. :returns the Request. Raises TimeoutError, or ConnectionError if the
+        connection is closed."""
+
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError(f"{self.max_in_flight} requests are still in flight.")
+        try:
+            request = self.session.request(opcode, payload)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.in_flight[request.request_id] = request
+        # the slot is given back after the callback has run, so flush() waits for the callbacks too.
+        if callback is not None:
+            request.add_done_callback(callback)
+        request.add_done_callback(self._confirmed)
+        return request
+
+    def _confirmed(self, request: Request):
+        with self.lock:
+            self.in_flight.pop(request.request_id, None)
+        self.slots.release()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits until every request sent so far is confirmed (or has failed), and its
+        callback has run. :returns False if timeout seconds passed first."""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        acquired = 0
+        try:
+            while acquired < self.max_in_flight:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if not self.slots.acquire(timeout=remaining):
+                    return False
+                acquired += 1
+            return True
+        finally:
+            for _ in range(acquired):
+                self.slots.release()
@@ -0,0 +1,134 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the conversion module of the message broker. The conversion rules of the
+repository ('*1000', '/2.4', ...) are compiled once into a single multiplication factor
+per unit, and the units of every queue into a tuple of those factors. Converting a value
+is then only a handful of float multiplications, instead of building and eval()-ing one
+Python expression per unit.
+
+If NumPy is installed, convert_many() converts a whole batch of values in one vectorized
+operation. Without it, it falls back to plain Python.
+
+Queues may also store the raw meters and only have them converted once they are delivered
+(see render()). Those results are memoized per set of factors, so queues with the same
+units share them, and a value that comes up again is not converted and formatted twice."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import functools
+import string
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# how many (factors, meters) results render() keeps.
+RENDER_CACHE_SIZE = 1 << 16
+REPOSITORY_PATH = "repository.txt"
+
+
+def read_repository(path: str = REPOSITORY_PATH) -> ({str: str}, {str: [str]}):
+    """Reads the repository file. :returns the conversion rule of every unit, and the units
+    of every default queue. The first lines of the repository contain the units of each
+    default queue, which are named A, B, C, ... in order (see default_queue_name()). The
+    rest of the lines contain a unit and its conversion rule. Raises FileNotFoundError."""
+
+    repository_dict = {}
+    default_queue_units = {}
+    with open(path, "r") as file:
+        for line in file.readlines():
+            segments = line.split()
+            if not segments:
+                continue
+            if len(segments) == 2 and segments[1][:1] in ("*", "/"):
+                repository_dict[segments[0]] = segments[1]
+            elif not repository_dict:
+                # a line of units, before the first conversion rule.
+                default_queue_units[default_queue_name(len(default_queue_units))] = segments
+    return repository_dict, default_queue_units
+
+
+def default_queue_name(idx: int) -> str:
+    """:returns the name of the idx-th queue of the repository file: A, B, C, ..., Z, Q26, ..."""
+
+    return string.ascii_uppercase[idx] if idx < len(string.ascii_uppercase) else f"Q{idx}"
+
+
+def compile_rule(conversion_rule: str) -> float:
+    """:returns the factor meters have to be multiplied by to follow conversion_rule.
+    A rule is either '*' or '/' followed by a number."""
+
+    operator, operand = conversion_rule[:1], conversion_rule[1:]
+    if operator == "*":
+        return float(operand)
+    if operator == "/":
+        return 1 / float(operand)
+    raise ValueError(f"Invalid conversion rule: {conversion_rule}")
+
+
+class ConversionTable:
+    def __init__(self, repository_dict: {str: str}, queue_units: {str: [str]}):
+        # the factor of every unit in the repository.
+        self.unit_factors = {unit: compile_rule(rule) for unit, rule in repository_dict.items()}
+        # the factors of every queue, in the order of the queue's units.
+        self.queue_factors = {}
+        # the same factors as numpy arrays, for convert_many().
+        self.queue_arrays = {}
+        for q, units in queue_units.items():
+            self.add_queue(q, units)
+        # the results of render(), by the factors and the meters.
+        self.render_cache = functools.lru_cache(maxsize=RENDER_CACHE_SIZE)(self._render)
+
+    def add_queue(self, q: str, units: [str]):
+        """Compiles the factors of queue q. Raises KeyError if a unit is not in the repository."""
+
+        factors = tuple(self.unit_factors[unit] for unit in units)
+        self.queue_factors[q] = factors
+        if numpy is not None:
+            self.queue_arrays[q] = numpy.array(factors, dtype=numpy.float64)
+
+    def remove_queue(self, q: str):
+        """Forgets the factors of queue q."""
+
+        self.queue_factors.pop(q, None)
+        self.queue_arrays.pop(q, None)
+
+    def convert(self, meters: float, q: str) -> [float]:
+        """:returns meters converted into every unit of queue q."""
+
+        return [meters * factor for factor in self.queue_factors[q]]
+
+    def convert_many(self, all_meters: [float], q: str) -> [[float]]:
+        """:returns each of all_meters converted into every unit of queue q, one row per value."""
+
+        if numpy is not None:
+            return numpy.multiply.outer(numpy.asarray(all_meters, dtype=numpy.float64), self.queue_arrays[q]).tolist()
+        factors = self.queue_factors[q]
+        return [[meters * factor for factor in factors] for meters in all_meters]
+
+    @staticmethod
+    def format_results(results: [float]) -> str:
+        """:returns the converted values as the space separated string that is stored in the queues."""
+
+        return " ".join(map(repr, results))
+
+    def render(self, message, q: str) -> str:
+        """:returns message as it is delivered from queue q: raw meters (a float) are converted
+        into every unit of q and formatted (see format_results()), text is returned as it is."""
+
+        if isinstance(message, str):
+            return message
+        if message == 0.0:
+            # 0.0 and -0.0 are the same key to the cache, but are formatted differently.
+            return self._render(self.queue_factors[q], message)
+        return self.render_cache(self.queue_factors[q], message)
+
+    @staticmethod
+    def _render(factors: (float,), meters: float) -> str:
+        return " ".join([repr(meters * factor) for factor in factors])
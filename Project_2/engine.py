@@ -0,0 +1,591 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the networking engine of the server. Instead of one thread per client, every
+client connection is served by a coroutine on a single asyncio event loop, which runs in
+its own thread. An idle client then costs a few kilobytes instead of a whole OS thread
+blocked in recv(), so a single process can hold tens of thousands of connections.
+
+The engine only speaks the protocol (see framing.py). What a request actually does is
+left to the functions of the broker it was given (see broker.py):
+    add_to_queue(), add_many_to_queue(), lease_messages(), ack(), wait_for_messages(),
+    create_queue(), delete_queue() and list_queues()
+and the broker is told about clients coming and going through:
+    new_client_handler(), set_client_status(), remove_client() and update_status()
+A connection may carry many clients, each attached as a session of its own (see
+framing.py). Every session is registered in the broker's session registry (see
+sessions.py), which hands out its session id, unique across connections. Every session is
+a consumer of the broker (open_consumer()/close_consumer()), so the messages leased to a
+client go back to their queue as soon as it is detached, or its connection is lost.
+
+Waiting for messages costs no polling: a long-polled OP_CHECK and every OP_SUBSCRIBE get a
+task of their own, which sleeps on the Future of wait_for_messages() until the broker
+resolves it. The tasks of a client are cancelled once it is detached.
+
+Uploads are only confirmed once the persistence thread has made them durable, and answered
+with STATUS_ERROR if it could not. The engine does not wait for that: the reply is written
+from a callback once the durability Future is resolved, so the next request of a client is
+read in the meantime. Replies that need not wait are held back behind those of the same
+session that do, so a client gets its replies in the order of its requests (see
+send_reply()). Only a long-poll is answered out of order, whenever a message comes in, so
+it holds back nothing. The sessions of a connection do not wait for each other: their
+replies are matched to their requests by request id. The latency of every command is
+recorded in the broker's metrics once its reply is written, along with the bytes received
+and sent."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import asyncio
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import framing
+from event_log import LEVEL_DEBUG, LEVEL_WARNING
+from sessions import SessionRecord
+from tracing import NULL_TRACE
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows.
+    resource = None
+
+# how many connections may wait to be accepted.
+LISTEN_BACKLOG = 1024
+# how long a disconnected client stays on the server's client list, in seconds.
+DISCONNECT_DELAY = 5
+# the longest an OP_CHECK may wait for messages, in seconds.
+MAX_WAIT = 60.0
+READ_SIZE = 65536
+# the name of every command, as it is labelled in the metrics.
+COMMAND_NAMES = {
+    framing.OP_HELLO: "hello",
+    framing.OP_UPLOAD: "upload",
+    framing.OP_UPLOAD_BATCH: "upload_batch",
+    framing.OP_CHECK: "check",
+    framing.OP_CREATE_QUEUE: "create_queue",
+    framing.OP_LIST_QUEUES: "list_queues",
+    framing.OP_DELETE_QUEUE: "delete_queue",
+    framing.OP_ACK: "ack",
+    framing.OP_SUBSCRIBE: "subscribe",
+    framing.OP_UNSUBSCRIBE: "unsubscribe",
+    framing.OP_END_SESSION: "end_session",
+}
+# the commands that are traced (see tracing.py), if the broker has a tracer.
+TRACED_OPCODES = (framing.OP_UPLOAD, framing.OP_UPLOAD_BATCH, framing.OP_CHECK)
+
+
+class Session:
+    def __init__(self, record: SessionRecord, consumer):
+        self.session_id = record.session_id
+        # the client in the broker's session registry, with its status and counters.
+        self.record = record
+        # the consumer of the client, named after it.
+        self.consumer = consumer
+        # the long-polls and subscriptions of the client, as tasks.
+        self.tasks: {asyncio.Task} = set()
+        # the subscriptions of the client, by queue name.
+        self.subscriptions: {str: asyncio.Task} = {}
+
+
+class BrokerServer:
+    def __init__(self, broker, host: str, port: int):
+        self.broker = broker
+        self.host = host
+        self.port = port
+        self.loop: asyncio.AbstractEventLoop = None
+        self.tcp_server: asyncio.AbstractServer = None
+        # the stream writer of every connection, with the replies of its sessions that are still
+        # waiting on the persistence thread, by session id (None for the replies to no session), as
+        # (durability Future, frame, timing) tuples in request order.
+        self.all_writers: {asyncio.StreamWriter: {int: deque}} = {}
+        # the clients attached to every connection, by session id.
+        self.all_sessions: {asyncio.StreamWriter: {int: Session}} = {}
+        self.engine_thread: threading.Thread = None
+        # the command being handled, when it came in and its trace, while its reply is being sent.
+        self.current_request: (str, float, object) = None
+        self.metric_command_seconds = broker.metrics.histogram(
+            "broker_command_seconds", "Time from a request coming in until its reply is written (after it is "
+            "durable), by command. Long-polls that wait for messages are left out.", "command")
+        self.metric_received_bytes = broker.metrics.counter("broker_received_bytes_total", "Bytes received.")
+        self.metric_sent_bytes = broker.metrics.counter("broker_sent_bytes_total", "Bytes sent.")
+        broker.metrics.gauge("broker_clients_connected", "Client connections.", lambda: len(self.all_writers))
+        broker.metrics.gauge("broker_clients_attached", "Clients attached to the connections.",
+                             lambda: sum(len(sessions) for sessions in list(self.all_sessions.values())))
+
+    def start(self):
+        """Starts the event loop in its own thread, and returns once the server is listening.
+        Raises whatever error kept the server from listening."""
+
+        started = Future()
+        self.engine_thread = threading.Thread(target=self._run, args=(started,), name="engine_thread", daemon=True)
+        self.engine_thread.start()
+        started.result()
+
+    def _run(self, started: Future):
+        """The engine thread. Runs the event loop until stop() is called."""
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start_serving())
+        except Exception as e:
+            started.set_exception(e)
+            return
+        started.set_result(None)
+        self.loop.run_forever()
+
+        # stop() was called, close the connections that are still open.
+        for writer in list(self.all_writers):
+            writer.close()
+        all_tasks = asyncio.all_tasks(self.loop)
+        if all_tasks:
+            # lets every client coroutine notice its connection was closed.
+            self.loop.run_until_complete(asyncio.wait(all_tasks, timeout=1))
+        self.loop.close()
+
+    async def _start_serving(self):
+        raise_file_limit()
+        self.tcp_server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                     backlog=LISTEN_BACKLOG, reuse_address=True)
+        self.broker.update_status("Socket created, now listening.")
+
+    def stop(self):
+        """Stops accepting clients, closes every connection and stops the event loop."""
+
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.tcp_server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.engine_thread.join()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves a connection until the client ends it (or the connection is lost). The first
+        frame of every client is its name (OP_HELLO), which attaches it to the connection as a
+        session. Every request is handled on behalf of the current session: the one attached
+        last, or switched to by OP_SESSION. A malformed request is answered with STATUS_ERROR,
+        and the connection is served on."""
+
+        address = writer.get_extra_info("peername")
+        self.broker.update_status("%s has established connection." % address[1])
+        self.all_writers[writer] = {}
+        sessions = self.all_sessions[writer] = {}
+        session: Session = None
+        decoder = framing.FrameDecoder()
+
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.metric_received_bytes.inc(len(data))
+                decoder.feed(data)
+                for opcode, request_id, payload in decoder.decode():
+                    try:
+                        if opcode == framing.OP_SESSION:
+                            # the requests of a session that does not exist (anymore) are refused.
+                            session = (sessions.get(framing.COUNT.unpack(payload)[0])
+                                       if len(payload) == framing.COUNT.size else None)
+                            continue
+                        client_name = session.consumer.name if session is not None else None
+                        self.current_request = (COMMAND_NAMES.get(opcode, "unknown"), time.perf_counter(),
+                                                self.start_trace(opcode, request_id, client_name))
+                        if opcode == framing.OP_HELLO:
+                            client_name = payload.decode("utf-8")
+                            self.broker.update_status(f"{client_name} accepted.")
+                            record = self.broker.new_client_handler(address, client_name, writer)
+                            session = Session(record, self.broker.open_consumer(client_name))
+                            sessions[session.session_id] = session
+                            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id,
+                                                                          framing.COUNT.pack(session.session_id)),
+                                            session_id=session.session_id)
+                        elif opcode == framing.OP_END_CONNECTION:
+                            return
+                        elif session is None:
+                            self.send_reply(writer, framing.encode_status(framing.STATUS_ERROR, request_id,
+                                                                          b"No client is attached."))
+                        elif opcode == framing.OP_END_SESSION:
+                            self.detach(sessions.pop(session.session_id))
+                            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id),
+                                            session_id=session.session_id)
+                            session = None
+                        else:
+                            session.record.requests += 1
+                            try:
+                                self.handle_request(writer, session, opcode, request_id, payload)
+                            except KeyError as e:
+                                # the request named a queue that does not exist (anymore).
+                                self.broker.update_status(f"{client_name} asked for an unknown queue: {e}",
+                                                          LEVEL_WARNING)
+                                self.send_reply(writer, framing.encode_status(framing.STATUS_NOT_FOUND, request_id),
+                                                session_id=session.session_id)
+                                self.broker.set_client_status(session.record, "Connected")
+                            except ValueError as e:
+                                self.broker.update_status(f"{client_name}'s request failed: {e}", LEVEL_WARNING)
+                                self.send_reply(writer, framing.encode_status(framing.STATUS_ERROR, request_id,
+                                                                              str(e).encode("utf-8")),
+                                                session_id=session.session_id)
+                    except (struct.error, UnicodeDecodeError) as e:
+                        # a malformed request only fails itself, the connection is served on.
+                        self.broker.update_status(f"{address[1]} sent a malformed request: {e}", LEVEL_WARNING)
+                        self.send_reply(writer, framing.encode_status(framing.STATUS_ERROR, request_id,
+                                                                      b"Malformed request."),
+                                        session_id=session.session_id if session is not None else None)
+                    self.current_request = None
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.all_writers.pop(writer, None)
+            writer.close()
+            for each_session in self.all_sessions.pop(writer, {}).values():
+                self.detach(each_session)
+
+    def detach(self, session: Session):
+        """Detaches a client from its connection: its long-polls and subscriptions end, and
+        every message leased to it goes back to its queue."""
+
+        # a task that is cancelled leases nothing more, so close_consumer() gets every lease back.
+        for task in list(session.tasks):
+            task.cancel()
+        self.broker.close_consumer(session.consumer)
+        self.end_connection(session.record)
+
+    def handle_request(self, writer: asyncio.StreamWriter, session: Session, opcode: int, request_id: int,
+                       payload: bytes):
+        """Carries out a single request of a client. The opcode determines the action taken:
+
+        OP_UPLOAD_BATCH:: converts all the values and adds them to the queue at once, leaving
+        out those whose message id came before (see Broker.add_many_to_queue()). Replies with
+        STATUS_OK and the count of values stored.
+
+        OP_UPLOAD:: converts the meters and adds the converted string to the queue. Replies with
+        STATUS_OK. Publishes the current conversion as a status event.
+
+        OP_CHECK:: if the queue has no messages, replies with STATUS_EMPTY, and if the client's
+        prefetch window is full, with STATUS_WINDOW_FULL. Otherwise leases the next page of
+        messages to the client, and sends each in an OP_MESSAGE frame (with its delivery tag),
+        followed by STATUS_OK and the number of messages left, all in a single write.
+        If the request carries a wait and the queue is empty, the reply is left to long_poll().
+
+        OP_SUBSCRIBE/OP_UNSUBSCRIBE:: starts/stops pushing the messages of the queue to the
+        client as they come in (see push_messages()). Replies with STATUS_OK.
+
+        OP_ACK:: acknowledges every delivery up to the tag. Replies with STATUS_OK and the
+        number of messages acknowledged once that is durable.
+
+        OP_CREATE_QUEUE/OP_DELETE_QUEUE:: creates/deletes a queue. Replies with STATUS_OK once
+        the change is durable.
+
+        OP_LIST_QUEUES:: replies with STATUS_OK and the definition of every queue.
+
+        A request naming a queue that does not exist raises KeyError, an invalid request
+        raises ValueError (see handle_client())."""
+
+        consumer = session.consumer
+        record = session.record
+        session_id = session.session_id
+        client_name = consumer.name
+        # the phases of an upload or a check are traced (see tracing.py), the reply ends the trace.
+        trace = self.current_request[2] if self.current_request is not None else NULL_TRACE
+        if opcode == framing.OP_UPLOAD_BATCH:
+            all_meters, q, upload_ids = framing.unpack_upload_batch(payload)
+            trace.mark("decode")
+            self.broker.update_status(f"{client_name} wants to upload {len(all_meters)} values.", LEVEL_DEBUG)
+            trace.mark("status")
+            all_results, durable = self.broker.add_many_to_queue(all_meters, q, upload_ids)
+            record.messages += len(all_results)
+            trace.mark("enqueue")
+            trace.set(queue=q, messages=len(all_results))
+
+            self.broker.update_status(f"{client_name} has uploaded {len(all_results)} values to Queue {q}.",
+                                      LEVEL_DEBUG)
+            trace.mark("status")
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id,
+                                                          framing.COUNT.pack(len(all_results))), durable, session_id)
+        elif opcode == framing.OP_UPLOAD:
+            meters, q = framing.unpack_upload(payload)
+            trace.mark("decode")
+            self.broker.update_status(f"{client_name} wants to upload.", LEVEL_DEBUG)
+            self.broker.update_status("Converting...", LEVEL_DEBUG)
+            trace.mark("status")
+            all_results, durable = self.broker.add_to_queue(meters, q)
+            record.messages += 1
+            trace.mark("enqueue")
+            trace.set(queue=q, messages=1)
+
+            self.broker.update_status(f"{client_name} has uploaded {meters} to Queue {q}:", LEVEL_DEBUG)
+            self.broker.update_status(all_results, LEVEL_DEBUG)
+            trace.mark("status")
+            # If all went smoothly, server sends a upload successful status (once it is durable).
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id), durable, session_id)
+        elif opcode == framing.OP_CHECK:
+            q, max_items, max_bytes, prefetch, visibility_timeout, wait = framing.unpack_check(payload)
+            trace.mark("decode")
+            self.broker.set_client_status(record, "Checking...")
+            self.broker.update_status(f"{client_name} wants to check for messages in Queue {q}.", LEVEL_DEBUG)
+            trace.mark("status")
+
+            deliveries, remaining = self.broker.lease_messages(consumer, q, max_items, max_bytes, prefetch,
+                                                               visibility_timeout)
+            trace.mark("lease")
+            trace.set(queue=q, messages=len(deliveries))
+            record.messages += len(deliveries)
+            # check if messages were available in that queue.
+            if deliveries or remaining or not wait:
+                if deliveries:
+                    self.broker.set_client_status(record, "Downloading...")
+                page = encode_page(request_id, deliveries, remaining)
+                trace.mark("encode")
+                self.send_reply(writer, page, session_id=session_id)
+                self.broker.set_client_status(record, "Connected")
+            else:
+                # the queue is empty: the reply is held back until a message comes in (out of order).
+                self.broker.set_client_status(record, "Waiting...")
+                reply = Future()
+                self.send_reply(writer, None, reply, session_id)
+                task = self.start_task(session, self.long_poll(reply, session, request_id, q, max_items, max_bytes,
+                                                               prefetch, visibility_timeout, min(wait, MAX_WAIT)))
+                # if the client is detached first, the long-poll is answered right away.
+                empty = framing.encode_status(framing.STATUS_EMPTY, request_id)
+                task.add_done_callback(lambda task: reply.done() or reply.set_result(empty))
+        elif opcode == framing.OP_SUBSCRIBE:
+            q, max_items, max_bytes, prefetch, visibility_timeout, wait = framing.unpack_check(payload)
+            subscriptions = session.subscriptions
+            if q in subscriptions:
+                raise ValueError(f"{client_name} has already subscribed to Queue {q}.")
+
+            # whatever is in the queue already is pushed right after the reply.
+            deliveries, remaining = self.broker.lease_messages(consumer, q, max_items, max_bytes, prefetch,
+                                                               visibility_timeout)
+            record.messages += len(deliveries)
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id)
+                            + encode_messages(request_id, deliveries), session_id=session_id)
+            subscriptions[q] = self.start_task(session, self.push_messages(writer, session, request_id, q, max_items,
+                                                                           max_bytes, prefetch, visibility_timeout))
+            self.broker.update_status(f"{client_name} has subscribed to Queue {q}.", LEVEL_DEBUG)
+        elif opcode == framing.OP_UNSUBSCRIBE:
+            q = payload.decode("utf-8")
+            session.subscriptions.pop(q).cancel()
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id), session_id=session_id)
+            self.broker.update_status(f"{client_name} has unsubscribed from Queue {q}.", LEVEL_DEBUG)
+        elif opcode == framing.OP_ACK:
+            count, durable = self.broker.ack(consumer, framing.DELIVERY_TAG.unpack(payload)[0])
+            self.broker.update_status(f"{client_name} has acknowledged {count} messages.", LEVEL_DEBUG)
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id, framing.COUNT.pack(count)),
+                            durable, session_id)
+        elif opcode == framing.OP_CREATE_QUEUE:
+            q, units = framing.unpack_queue_definition(payload)
+            durable = self.broker.create_queue(q, units)
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id), durable, session_id)
+        elif opcode == framing.OP_DELETE_QUEUE:
+            durable = self.broker.delete_queue(payload.decode("utf-8"))
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id), durable, session_id)
+        elif opcode == framing.OP_LIST_QUEUES:
+            self.send_reply(writer, framing.encode_status(framing.STATUS_OK, request_id,
+                                                          framing.pack_queue_list(self.broker.list_queues())),
+                            session_id=session_id)
+
+    def start_task(self, session: Session, coroutine) -> asyncio.Task:
+        """:returns a task running coroutine for the client, which is cancelled once it is
+        detached."""
+
+        task = self.loop.create_task(coroutine)
+        session.tasks.add(task)
+        task.add_done_callback(session.tasks.discard)
+        return task
+
+    async def wait_for_messages(self, consumer, q: str, prefetch: int, timeout: float):
+        """Sleeps until the broker may have messages of queue q for consumer, but at most
+        timeout seconds. Raises KeyError if there is no queue q."""
+
+        future, expires_in = self.broker.wait_for_messages(consumer, q, prefetch)
+        if expires_in is not None:
+            timeout = min(timeout, expires_in)
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def long_poll(self, reply: Future, session: Session, request_id: int, q: str, max_items: int, max_bytes: int,
+                        prefetch: int, visibility_timeout: float, wait: float):
+        """Answers an OP_CHECK on an empty queue as soon as a message comes in, or with
+        STATUS_EMPTY once wait seconds have passed. The reply is the result of reply."""
+
+        consumer = session.consumer
+        deadline = self.loop.time() + wait
+        deliveries, remaining = [], 0
+        try:
+            while not (deliveries or remaining) and self.loop.time() < deadline:
+                await self.wait_for_messages(consumer, q, prefetch, deadline - self.loop.time())
+                deliveries, remaining = self.broker.lease_messages(consumer, q, max_items, max_bytes, prefetch,
+                                                                   visibility_timeout)
+            session.record.messages += len(deliveries)
+            reply.set_result(encode_page(request_id, deliveries, remaining))
+        except KeyError:
+            # the queue was deleted in the meantime.
+            reply.set_result(framing.encode_status(framing.STATUS_NOT_FOUND, request_id))
+        self.broker.set_client_status(session.record, "Connected")
+
+    async def push_messages(self, writer: asyncio.StreamWriter, session: Session, request_id: int, q: str,
+                            max_items: int, max_bytes: int, prefetch: int, visibility_timeout: float):
+        """Pushes the messages of queue q to the client as they come in, as long as its
+        prefetch window has room, until it unsubscribes or is detached. If the queue is
+        deleted, the subscription ends with STATUS_NOT_FOUND."""
+
+        consumer = session.consumer
+        try:
+            while True:
+                await self.wait_for_messages(consumer, q, prefetch, MAX_WAIT)
+                deliveries, remaining = self.broker.lease_messages(consumer, q, max_items, max_bytes, prefetch,
+                                                                   visibility_timeout)
+                if deliveries:
+                    session.record.messages += len(deliveries)
+                    self.send_reply(writer, encode_messages(request_id, deliveries), session_id=session.session_id)
+                    await writer.drain()
+        except KeyError:
+            session.subscriptions.pop(q, None)
+            self.send_reply(writer, framing.encode_status(framing.STATUS_NOT_FOUND, request_id),
+                            session_id=session.session_id)
+        except (ConnectionError, OSError):
+            pass
+
+    def send_reply(self, writer: asyncio.StreamWriter, frame: bytes, durable: Future = None, session_id: int = None):
+        """Writes frame to the client, but only once durable (if any) is resolved, and never
+        ahead of an earlier reply to session session_id that is still waiting. The persistence
+        thread resolves the futures in the order the records were appended, so the replies of
+        a client stay in the order of its requests, while those of the other sessions of the
+        connection go out as soon as they are ready. If durable failed (its record could not be
+        written), the client gets STATUS_ERROR instead of frame. If frame is None, the reply
+        is the result of durable (see long_poll()): it is written as soon as durable is
+        resolved, and the later replies of the session do not wait for it."""
+
+        all_waiting = self.all_writers.get(writer)
+        if all_waiting is None:
+            # the connection is already closed.
+            return
+        # the reply to the request being handled, if any, counts towards its latency.
+        timing = self.current_request
+        if frame is None:
+            # a long-poll is answered whenever a message comes in, the client matches the reply
+            # by its request id.
+            def write_result(future: Future):
+                if writer in self.all_writers:
+                    self._write(writer, future.result(), timing, waited=True)
+
+            durable.add_done_callback(write_result)
+            return
+
+        waiting = all_waiting.get(session_id)
+        if not waiting and (durable is None or durable.done()):
+            self._write(writer, durable_reply(frame, durable), timing)
+            return
+
+        if waiting is None:
+            waiting = all_waiting[session_id] = deque()
+        waiting.append((durable, frame, timing))
+        if durable is not None and not durable.done():
+            def schedule(future: Future):
+                try:
+                    self.loop.call_soon_threadsafe(self._write_replies, writer, session_id)
+                except RuntimeError:
+                    # the engine was stopped while the record was being written.
+                    pass
+
+            durable.add_done_callback(schedule)
+
+    def _write_replies(self, writer: asyncio.StreamWriter, session_id: int):
+        """Writes the waiting replies of a session, up to the first one whose Future is not
+        resolved yet."""
+
+        all_waiting = self.all_writers.get(writer)
+        waiting = all_waiting.get(session_id) if all_waiting is not None else None
+        while waiting and (waiting[0][0] is None or waiting[0][0].done()):
+            durable, frame, timing = waiting.popleft()
+            self._write(writer, durable_reply(frame, durable), timing)
+        if all_waiting is not None and not waiting:
+            all_waiting.pop(session_id, None)
+
+    def _write(self, writer: asyncio.StreamWriter, frame: bytes, timing: (str, float, object) = None,
+               waited: bool = False):
+        """Writes frame to the client, and records it in the metrics. If timing is set (see
+        current_request), the frame is the reply to that command: its latency is recorded,
+        unless it waited for messages (a long-poll), and its trace is finished."""
+
+        writer.write(frame)
+        self.metric_sent_bytes.inc(len(frame))
+        if timing is not None:
+            command, started, trace = timing
+            if not waited:
+                self.metric_command_seconds.observe(time.perf_counter() - started, command)
+            trace.mark("wait" if waited else "reply")
+            trace.finish()
+
+    def start_trace(self, opcode: int, request_id: int, client_name: str):
+        """:returns the trace of a request, NULL_TRACE if it is not traced."""
+
+        if self.broker.tracer is None or opcode not in TRACED_OPCODES:
+            return NULL_TRACE
+        return self.broker.tracer.start(COMMAND_NAMES[opcode], request_id, client_name)
+
+    def end_connection(self, record: SessionRecord):
+        """Receives that a client has been deleted via the client GUI (or its connection was lost).
+        To cope, it will first update the status of the client to 'Disconnected' to notify the user.
+        The client is removed from the server after DISCONNECT_DELAY seconds, which gives the GUI
+        time to refresh."""
+
+        self.broker.set_client_status(record, "Disconnected")
+        self.broker.update_status(f"{record.client_name} has ended connection.")
+        self.loop.call_later(DISCONNECT_DELAY, self.broker.remove_client, record)
+
+
+def durable_reply(frame: bytes, durable: Future) -> bytes:
+    """:returns frame, the reply to a change that was to be made durable, or STATUS_ERROR
+    for the same request if durable failed: the change must not be confirmed."""
+
+    if durable is None or durable.exception() is None:
+        return frame
+    request_id = framing.HEADER.unpack_from(frame)[2]
+    return framing.encode_status(framing.STATUS_ERROR, request_id,
+                                 f"The change could not be stored: {durable.exception()}".encode("utf-8"))
+
+
+def encode_messages(request_id: int, deliveries: [(int, str)]) -> bytes:
+    """:returns an OP_MESSAGE frame for every (delivery tag, message) in deliveries."""
+
+    return b"".join(framing.encode_frame(framing.OP_MESSAGE, request_id, framing.pack_message(tag, message))
+                    for tag, message in deliveries)
+
+
+def encode_page(request_id: int, deliveries: [(int, str)], remaining: int) -> bytes:
+    """:returns the reply to an OP_CHECK: the page of messages followed by STATUS_OK and
+    the number of messages left, STATUS_WINDOW_FULL if nothing was leased although the
+    queue has messages, or STATUS_EMPTY."""
+
+    if deliveries:
+        return encode_messages(request_id, deliveries) + framing.encode_status(framing.STATUS_OK, request_id,
+                                                                               framing.COUNT.pack(remaining))
+    if remaining:
+        return framing.encode_status(framing.STATUS_WINDOW_FULL, request_id)
+    return framing.encode_status(framing.STATUS_EMPTY, request_id)
+
+
+def raise_file_limit():
+    """Raises the soft limit of open files to the hard limit, since every connection
+    uses a file descriptor."""
+
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
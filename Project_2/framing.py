@@ -0,0 +1,316 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the framing module of the client/server application. Every message sent over a
+socket is a frame: a fixed size header followed by a payload. The header holds the length
+of the payload, an opcode saying what the frame is, and a request id which the server
+copies into its replies, so a reply can always be matched to the request it answers.
+
+    payload length (I) | opcode (B) | request id (I) | payload
+
+Since the length is known up front, messages can no longer run into each other (or be
+split up) the way bare recv(1024) calls could. FrameReader receives into one reusable
+buffer, so a single recv_into() can hand back many frames at once. FrameDecoder does the
+same for bytes that were received some other way (e.g. by asyncio). A frame longer
+than MAX_FRAME_SIZE is refused with ConnectionError, since its length cannot be trusted.
+
+Replies use compact numeric status codes instead of sentences that both sides have to
+format and compare. A STATUS_ERROR reply carries the reason as text after the code.
+
+OP_CHECK drains a queue one page at a time. The request carries the most items and bytes
+the client wants in one page; the server answers with the page's OP_MESSAGE frames (one
+per item), followed by STATUS_OK and the number of items left in the queue. While that
+number (the continuation cursor) is not zero, the client asks for the next page.
+
+Messages are only leased by OP_CHECK: every OP_MESSAGE starts with a delivery tag, and the
+client acknowledges all of its deliveries up to a tag with a single OP_ACK once it has
+processed them. The OP_CHECK request also carries the client's prefetch window (how many
+unacknowledged messages it may hold) and its visibility timeout (how long, in milliseconds,
+before an unacknowledged message is delivered again). A page is refused with
+STATUS_WINDOW_FULL while the window is full. The server answers the requests of a client
+in the order they were sent, except for an OP_CHECK that waits (see below), and the
+clients sharing a connection do not wait for each other's replies.
+
+Consumers need not poll an empty queue. An OP_CHECK may also carry a wait (in
+milliseconds): if the queue is empty, the server holds the request until a message comes
+in or the wait is over, and only then answers it (STATUS_EMPTY if nothing came in). The
+replies to the requests sent in the meantime do not wait for it.
+OP_SUBSCRIBE (with the same payload as OP_CHECK) goes further: after its STATUS_OK, the
+server pushes OP_MESSAGE frames carrying the request id of the OP_SUBSCRIBE as soon as
+messages come in, for as long as the prefetch window has room, until OP_UNSUBSCRIBE.
+
+Queues are named, and are created, listed and deleted with OP_CREATE_QUEUE,
+OP_LIST_QUEUES and OP_DELETE_QUEUE. A queue definition is the queue name followed by its
+units, separated by spaces; a queue list is one definition per line.
+
+Many clients may share a connection. Every OP_HELLO attaches another client to it as a
+session of its own, which the server answers with STATUS_OK and the session id (COUNT);
+the first client of a connection is session 0. The requests that follow are on behalf of
+the client that was attached last, until an OP_SESSION (whose payload is a session id, and
+which is not answered) switches to another one. OP_END_SESSION detaches the current client,
+and leaves the connection open for the others."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import socket
+import struct
+from collections import deque
+
+HEADER = struct.Struct("!IBI")
+# the largest payload taken from a peer, so a forged length cannot make the buffer grow without bound.
+MAX_FRAME_SIZE = 1 << 24
+
+# opcodes sent by the client.
+OP_HELLO = 1
+OP_UPLOAD = 2
+OP_UPLOAD_BATCH = 3
+OP_CHECK = 4
+OP_END_CONNECTION = 5
+OP_CREATE_QUEUE = 6
+OP_LIST_QUEUES = 7
+OP_DELETE_QUEUE = 8
+OP_ACK = 9
+OP_SUBSCRIBE = 10
+OP_UNSUBSCRIBE = 11
+OP_SESSION = 12
+OP_END_SESSION = 13
+# opcodes sent by the server.
+OP_STATUS = 64
+OP_MESSAGE = 65
+
+# status codes, the first byte of every OP_STATUS payload.
+STATUS_OK = 0
+STATUS_EMPTY = 1
+STATUS_ERROR = 2
+STATUS_NOT_FOUND = 3
+STATUS_WINDOW_FULL = 4
+
+STATUS = struct.Struct("!B")
+# OP_UPLOAD payload: the meters, followed by the queue name.
+UPLOAD = struct.Struct("!d")
+# OP_UPLOAD_BATCH payload: the number of values, the values, the number of bytes of message ids
+# that follow (0 if there are none), the message ids, then the queue name. The message ids (one
+# per value, see outbox.py) are utf-8, each preceded by its length (UPLOAD_ID_LENGTH).
+# Also the payload of the OP_STATUS reply to it: the number of values stored, of the reply
+# to OP_HELLO: the session id, and of OP_SESSION.
+COUNT = struct.Struct("!I")
+UPLOAD_ID_LENGTH = struct.Struct("!B")
+# the longest message id of an upload, in bytes.
+MAX_UPLOAD_ID_LENGTH = 255
+# OP_CHECK (and OP_SUBSCRIBE) payload: the most items and the most bytes of a page, the
+# prefetch window, the visibility timeout and the wait in milliseconds, then the queue name.
+# The OP_STATUS reply to it holds the number of items left (COUNT).
+CHECK = struct.Struct("!IIIII")
+# the delivery tag at the start of every OP_MESSAGE payload, and the OP_ACK payload.
+# The OP_STATUS reply to OP_ACK holds the number of messages acknowledged (COUNT).
+DELIVERY_TAG = struct.Struct("!Q")
+
+
+def encode_frame(opcode: int, request_id: int = 0, payload: bytes = b"") -> bytes:
+    """:returns the frame as bytes, header included."""
+
+    return HEADER.pack(len(payload), opcode, request_id) + payload
+
+
+def send_frame(sock: socket.socket, opcode: int, request_id: int = 0, payload: bytes = b""):
+    """Sends a single frame over sock."""
+
+    sock.sendall(encode_frame(opcode, request_id, payload))
+
+
+def encode_status(status: int, request_id: int = 0, payload: bytes = b"") -> bytes:
+    """:returns an OP_STATUS frame holding status, followed by payload."""
+
+    return encode_frame(OP_STATUS, request_id, STATUS.pack(status) + payload)
+
+
+def pack_upload(meters: float, q: str) -> bytes:
+    """:returns the payload of an OP_UPLOAD frame."""
+
+    return UPLOAD.pack(meters) + q.encode("utf-8")
+
+
+def unpack_upload(payload: bytes) -> (float, str):
+    """:returns the meters and the queue name of an OP_UPLOAD payload."""
+
+    return UPLOAD.unpack_from(payload)[0], payload[UPLOAD.size:].decode("utf-8")
+
+
+def pack_upload_batch(all_meters: [float], q: str, upload_ids: [str] = None) -> bytes:
+    """:returns the payload of an OP_UPLOAD_BATCH frame. upload_ids (if any) are the message
+    ids of the values, one each."""
+
+    all_ids = b""
+    if upload_ids is not None:
+        encoded_ids = [upload_id.encode("utf-8") for upload_id in upload_ids]
+        all_ids = b"".join(UPLOAD_ID_LENGTH.pack(len(upload_id)) + upload_id for upload_id in encoded_ids)
+    return (COUNT.pack(len(all_meters)) + struct.pack(f"!{len(all_meters)}d", *all_meters)
+            + COUNT.pack(len(all_ids)) + all_ids + q.encode("utf-8"))
+
+
+def unpack_upload_batch(payload: bytes) -> ([float], str, [str]):
+    """:returns the values, the queue name and the message ids (None if there are none) of an
+    OP_UPLOAD_BATCH payload."""
+
+    count = COUNT.unpack_from(payload)[0]
+    all_meters = list(struct.unpack_from(f"!{count}d", payload, COUNT.size))
+    offset = COUNT.size + count * 8
+    ids_end = offset + COUNT.size + COUNT.unpack_from(payload, offset)[0]
+    offset += COUNT.size
+    upload_ids = None
+    if ids_end > offset:
+        upload_ids = []
+        while offset < ids_end:
+            length = UPLOAD_ID_LENGTH.unpack_from(payload, offset)[0]
+            offset += UPLOAD_ID_LENGTH.size
+            upload_ids.append(payload[offset:offset + length].decode("utf-8"))
+            offset += length
+        if offset != ids_end or len(upload_ids) != count:
+            raise struct.error("The message ids do not match the values.")
+    return all_meters, payload[ids_end:].decode("utf-8"), upload_ids
+
+
+def pack_check(q: str, max_items: int = 0, max_bytes: int = 0, prefetch: int = 0,
+               visibility_timeout: float = 0.0, wait: float = 0.0) -> bytes:
+    """:returns the payload of an OP_CHECK (or OP_SUBSCRIBE) frame. A limit of 0 leaves it
+    to the server. visibility_timeout and wait are in seconds."""
+
+    return CHECK.pack(max_items, max_bytes, prefetch, int(visibility_timeout * 1000),
+                      int(wait * 1000)) + q.encode("utf-8")
+
+
+def unpack_check(payload: bytes) -> (str, int, int, int, float, float):
+    """:returns the queue name, the most items, the most bytes, the prefetch window, the
+    visibility timeout and the wait (both in seconds) of an OP_CHECK payload."""
+
+    max_items, max_bytes, prefetch, visibility_timeout_ms, wait_ms = CHECK.unpack_from(payload)
+    return (payload[CHECK.size:].decode("utf-8"), max_items, max_bytes, prefetch, visibility_timeout_ms / 1000,
+            wait_ms / 1000)
+
+
+def pack_message(tag: int, message: str) -> bytes:
+    """:returns the payload of an OP_MESSAGE frame."""
+
+    return DELIVERY_TAG.pack(tag) + message.encode("utf-8")
+
+
+def unpack_message(payload: bytes) -> (int, str):
+    """:returns the delivery tag and the message of an OP_MESSAGE payload."""
+
+    return DELIVERY_TAG.unpack_from(payload)[0], payload[DELIVERY_TAG.size:].decode("utf-8")
+
+
+def pack_queue_definition(q: str, units: [str]) -> bytes:
+    """:returns the payload of an OP_CREATE_QUEUE frame."""
+
+    return " ".join([q] + list(units)).encode("utf-8")
+
+
+def unpack_queue_definition(payload: bytes) -> (str, [str]):
+    """:returns the queue name and the units of a queue definition."""
+
+    segments = payload.decode("utf-8").split()
+    return (segments[0], segments[1:]) if segments else ("", [])
+
+
+def pack_queue_list(all_queue_units: {str: [str]}) -> bytes:
+    """:returns the payload of the OP_STATUS reply to OP_LIST_QUEUES."""
+
+    return b"\n".join(pack_queue_definition(q, units) for q, units in all_queue_units.items())
+
+
+def unpack_queue_list(payload: bytes) -> {str: [str]}:
+    """:returns a dict of queue name -> units, in the order the server listed them."""
+
+    return dict(unpack_queue_definition(line) for line in payload.split(b"\n") if line.strip())
+
+
+class FrameDecoder:
+    def __init__(self, buffer_size: int = 65536):
+        self.buffer = bytearray(buffer_size)
+        # the received, but not yet decoded, bytes are buffer[start:end].
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self):
+        """Moves the undecoded bytes to the front of the buffer, and grows the buffer if it
+        is full."""
+
+        if self.start > 0:
+            leftover = self.end - self.start
+            self.buffer[:leftover] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, leftover
+        if self.end == len(self.buffer):
+            self.buffer.extend(bytes(len(self.buffer)))
+
+    def feed(self, data: bytes):
+        """Adds data that was received some other way (e.g. from an asyncio stream)."""
+
+        self._make_room()
+        if self.end + len(data) > len(self.buffer):
+            self.buffer.extend(bytes(self.end + len(data) - len(self.buffer)))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def decode(self) -> [(int, int, bytes)]:
+        """:returns every complete frame in the buffer as (opcode, request id, payload).
+        Raises ConnectionError if a frame is larger than MAX_FRAME_SIZE."""
+
+        frames = []
+        while self.end - self.start >= HEADER.size:
+            length, opcode, request_id = HEADER.unpack_from(self.buffer, self.start)
+            if length > MAX_FRAME_SIZE:
+                # the stream cannot be read any further.
+                raise ConnectionError(f"A frame of {length} bytes is larger than {MAX_FRAME_SIZE} bytes.")
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                if HEADER.size + length > len(self.buffer):
+                    # make room for the whole frame in one go.
+                    self.buffer.extend(bytes(HEADER.size + length - len(self.buffer)))
+                break
+            frames.append((opcode, request_id, bytes(self.buffer[self.start + HEADER.size:frame_end])))
+            self.start = frame_end
+        return frames
+
+
+class FrameReader(FrameDecoder):
+    def __init__(self, sock: socket.socket, buffer_size: int = 65536):
+        super(FrameReader, self).__init__(buffer_size)
+        self.sock = sock
+        # frames that were decoded, but not yet handed out by read_frame().
+        self.frames = deque()
+
+    def _fill(self):
+        """Receives as much as fits into the buffer with a single recv_into()."""
+
+        self._make_room()
+        with memoryview(self.buffer) as view:
+            received = self.sock.recv_into(view[self.end:])
+        if not received:
+            raise ConnectionError("Connection closed by peer.")
+        self.end += received
+
+    def read_frames(self) -> [(int, int, bytes)]:
+        """:returns all the frames that are available, receiving until there is at least one.
+        Raises ConnectionError once the connection has been closed."""
+
+        if self.frames:
+            frames = list(self.frames)
+            self.frames.clear()
+            return frames
+        frames = self.decode()
+        while not frames:
+            self._fill()
+            frames = self.decode()
+        return frames
+
+    def read_frame(self) -> (int, int, bytes):
+        """:returns the next frame as (opcode, request id, payload)."""
+
+        if not self.frames:
+            self.frames.extend(self.read_frames())
+        return self.frames.popleft()
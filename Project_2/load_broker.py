@@ -0,0 +1,462 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is a load generator for the message broker. It starts a headless server (or uses
+one that is already running), and has many simulated producers and consumers talk to it
+over the same protocol the client speaks (see framing.py): every one of them connects with
+OP_HELLO, producers upload with OP_UPLOAD (or OP_UPLOAD_BATCH), consumers drain pages with
+OP_CHECK and acknowledge them with OP_ACK, and all of them leave with OP_END_CONNECTION.
+
+    --rate       how many values are uploaded per second in all (0: as fast as possible).
+    --batch      how many values an upload holds: N, uniform:LOW:HIGH or exponential:MEAN.
+                 Single values go out as OP_UPLOAD, more as OP_UPLOAD_BATCH.
+    --queues     the queues and how much of the load each gets, e.g. LOAD_A=3,LOAD_B=1.
+                 Missing queues are created with --units.
+    --pipeline   how many uploads a producer keeps in flight (see connection_pool.Pipeline).
+                 With 1, a producer waits for every upload to be confirmed before the next.
+
+Two latencies are measured. The upload latency runs from the moment an upload was due (not
+when it was sent, so a server that falls behind shows up in it) until the server confirmed
+it. The delivery latency runs from the same moment until a consumer got the value: every
+uploaded value is the time it was due, and the first unit of the queues is meters, so the
+consumer reads it back from the message. The first --warmup seconds are left out.
+
+The results are printed (or written with --output) as JSON: the throughput and the p50,
+p99 and p999 latencies, with a histogram of each. Results of two versions are compared with
+--compare, which prints how every number changed:
+    python load_broker.py --seconds 10 --output before.json
+    python load_broker.py --seconds 10 --output after.json
+    python load_broker.py --compare before.json after.json
+
+Run from the Project_2 directory (the repository file is read from there). The server it
+starts runs in a temporary directory, so its queue files are thrown away afterwards."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import argparse
+import functools
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import framing
+from connection_pool import ConnectionPool, Pipeline, Request
+from broker import HOST, DURABILITY, STORAGE, STORAGE_RAW, STORAGE_TEXT
+from queue_log import DURABILITY_NONE, DURABILITY_BATCHED, DURABILITY_FSYNC
+
+# the percentiles reported for every latency.
+PERCENTILES = {"p50": 0.5, "p99": 0.99, "p999": 0.999}
+# how long a consumer's OP_CHECK waits for messages, and how many it takes at once.
+CHECK_WAIT = 0.5
+CHECK_PAGE_ITEMS = 500
+CHECK_PREFETCH = 2 * CHECK_PAGE_ITEMS
+CHECK_VISIBILITY_TIMEOUT = 30.0
+# how long the server it starts may take to listen, in seconds.
+SERVER_START_TIMEOUT = 30.0
+
+
+class Histogram:
+    def __init__(self):
+        # every sample, in seconds.
+        self.samples = []
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def merge(self, other: "Histogram"):
+        self.samples.extend(other.samples)
+
+    def summary(self) -> dict:
+        """:returns the count, mean, percentiles and maximum (in milliseconds) of the samples,
+        with a histogram of them: how many took up to 2^n microseconds, for every n."""
+
+        samples = sorted(self.samples)
+        if not samples:
+            return {"count": 0}
+        summary = {"count": len(samples), "mean_ms": sum(samples) / len(samples) * 1000}
+        for name, fraction in PERCENTILES.items():
+            summary[f"{name}_ms"] = samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+        summary["max_ms"] = samples[-1] * 1000
+        buckets = {}
+        for seconds in samples:
+            bucket = 1 << max(0, math.ceil(math.log2(max(seconds * 1e6, 1.0))))
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        summary["histogram_us"] = {str(bucket): count for bucket, count in sorted(buckets.items())}
+        return summary
+
+
+class Connection:
+    def __init__(self, host: str, port: int, client_name: str):
+        """Connects to the server as client_name (OP_HELLO). Raises ConnectionError if the
+        server does not accept it."""
+
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = framing.FrameReader(self.sock)
+        self.request_ids = itertools.count(1)
+        opcode, payload = self.request(framing.OP_HELLO, client_name.encode("utf-8"))
+        if payload[0] != framing.STATUS_OK:
+            raise ConnectionError(f"The server did not accept {client_name}.")
+
+    def send(self, opcode: int, payload: bytes = b"") -> bytes:
+        """:returns the frame of a request, to be sent along with others."""
+
+        return framing.encode_frame(opcode, next(self.request_ids), payload)
+
+    def request(self, opcode: int, payload: bytes = b"") -> (int, bytes):
+        """Sends a request. :returns the opcode and the payload of the reply."""
+
+        self.sock.sendall(self.send(opcode, payload))
+        opcode, request_id, payload = self.reader.read_frame()
+        return opcode, payload
+
+    def close(self):
+        try:
+            framing.send_frame(self.sock, framing.OP_END_CONNECTION, next(self.request_ids))
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Load:
+    def __init__(self, args: argparse.Namespace, port: int):
+        self.args = args
+        self.host = args.host or HOST
+        self.port = port
+        self.queues, self.weights = parse_queues(args.queues)
+        self.batch_size = parse_batch(args.batch)
+        self.stopped = threading.Event()
+        # the monotonic time at which the measurement starts, after the warmup.
+        self.measure_start = 0.0
+        self.lock = threading.Lock()
+        self.upload_latency = Histogram()
+        self.delivery_latency = Histogram()
+        self.uploaded_requests = 0
+        self.uploaded_values = 0
+        self.delivered_values = 0
+        self.errors = 0
+
+    def produce(self, producer: int):
+        """Uploads values at this producer's share of --rate, until stopped, with up to
+        --pipeline uploads in flight."""
+
+        pool = ConnectionPool(self.host, self.port, 1)
+        pipeline = Pipeline(pool.attach(f"load_producer{producer}"), self.args.pipeline)
+        rng = random.Random(producer)
+        rate = self.args.rate / self.args.producers
+        # the monotonic and the wall clock time of the same moment: values are wall clock times.
+        clock_offset = time.time() - time.monotonic()
+        latency = Histogram()
+        uploaded_requests = uploaded_values = errors = 0
+
+        # called on the reader thread of the connection, once an upload is confirmed.
+        def confirmed(request: Request, due: float, count: int):
+            nonlocal uploaded_requests, uploaded_values, errors
+            done = time.monotonic()
+            try:
+                reply = request.result()
+            except ConnectionError:
+                errors += 1
+                return
+            if reply.status != framing.STATUS_OK:
+                errors += 1
+            elif due >= self.measure_start:
+                latency.add(done - due)
+                uploaded_requests += 1
+                uploaded_values += count
+
+        due = time.monotonic()
+        try:
+            while not self.stopped.is_set():
+                now = time.monotonic()
+                if rate and due > now:
+                    time.sleep(due - now)
+                elif not rate:
+                    due = now
+                q = rng.choices(self.queues, self.weights)[0]
+                count = self.batch_size(rng)
+                value = due + clock_offset
+                callback = functools.partial(confirmed, due=due, count=count)
+                if count == 1:
+                    pipeline.upload(value, q, callback)
+                else:
+                    pipeline.upload_many([value] * count, q, callback)
+                if rate:
+                    due += count / rate
+        finally:
+            pipeline.flush(SERVER_START_TIMEOUT)
+            pool.close()
+            with self.lock:
+                self.upload_latency.merge(latency)
+                self.uploaded_requests += uploaded_requests
+                self.uploaded_values += uploaded_values
+                self.errors += errors
+
+    def consume(self, consumer: int):
+        """Drains pages of the queues (picked by their weights) until stopped, acknowledging
+        each page along with the request for the next one."""
+
+        connection = Connection(self.host, self.port, f"load_consumer{consumer}")
+        rng = random.Random(-1 - consumer)
+        latency = Histogram()
+        delivered_values = errors = 0
+        last_tag = 0
+        try:
+            while not self.stopped.is_set():
+                q = rng.choices(self.queues, self.weights)[0]
+                request = connection.send(framing.OP_CHECK, framing.pack_check(
+                    q, CHECK_PAGE_ITEMS, 0, CHECK_PREFETCH, CHECK_VISIBILITY_TIMEOUT, CHECK_WAIT))
+                check_id = framing.HEADER.unpack_from(request)[2]
+                if last_tag:
+                    # the acknowledgement goes along with the request for the next page.
+                    connection.sock.sendall(connection.send(framing.OP_ACK, framing.DELIVERY_TAG.pack(last_tag))
+                                            + request)
+                    last_tag = 0
+                else:
+                    connection.sock.sendall(request)
+
+                opcode, request_id, payload = connection.reader.read_frame()
+                while request_id != check_id:
+                    # the reply to an acknowledgement, which a long-poll may answer ahead of.
+                    opcode, request_id, payload = connection.reader.read_frame()
+                received = time.time()
+                while opcode == framing.OP_MESSAGE:
+                    last_tag, message = framing.unpack_message(payload)
+                    due = float(message.split(" ", 1)[0])
+                    if due - received + time.monotonic() >= self.measure_start:
+                        latency.add(received - due)
+                        delivered_values += 1
+                    opcode, request_id, payload = connection.reader.read_frame()
+                if payload[0] not in (framing.STATUS_OK, framing.STATUS_EMPTY):
+                    errors += 1
+            if last_tag:
+                connection.request(framing.OP_ACK, framing.DELIVERY_TAG.pack(last_tag))
+        finally:
+            connection.close()
+            with self.lock:
+                self.delivery_latency.merge(latency)
+                self.delivered_values += delivered_values
+                self.errors += errors
+
+    def create_queues(self):
+        """Creates the queues that do not exist yet. Raises ValueError if one of them does
+        not start with meters, since the delivery latency is read from that unit."""
+
+        connection = Connection(self.host, self.port, "load_setup")
+        try:
+            opcode, payload = connection.request(framing.OP_LIST_QUEUES)
+            all_queue_units = framing.unpack_queue_list(payload[framing.STATUS.size:])
+            for q in self.queues:
+                if q not in all_queue_units:
+                    units = self.args.units.split()
+                    opcode, payload = connection.request(framing.OP_CREATE_QUEUE,
+                                                         framing.pack_queue_definition(q, units))
+                    if payload[0] != framing.STATUS_OK:
+                        raise ValueError(f"Queue {q} could not be created: {payload[1:].decode('utf-8')}")
+                    all_queue_units[q] = units
+                if all_queue_units[q][:1] != ["meters"]:
+                    raise ValueError(f"The first unit of queue {q} is not meters.")
+        finally:
+            connection.close()
+
+    def run(self) -> dict:
+        """Runs the load for --warmup plus --seconds seconds. :returns the results."""
+
+        self.create_queues()
+        threads = [threading.Thread(target=self.produce, args=(idx,), daemon=True)
+                   for idx in range(self.args.producers)]
+        threads += [threading.Thread(target=self.consume, args=(idx,), daemon=True)
+                    for idx in range(self.args.consumers)]
+        self.measure_start = time.monotonic() + self.args.warmup
+        for thread in threads:
+            thread.start()
+        time.sleep(self.args.warmup + self.args.seconds)
+        self.stopped.set()
+        for thread in threads:
+            thread.join()
+
+        return {
+            "upload": {
+                "requests_per_s": self.uploaded_requests / self.args.seconds,
+                "values_per_s": self.uploaded_values / self.args.seconds,
+                "latency": self.upload_latency.summary(),
+            },
+            "delivery": {
+                "values_per_s": self.delivered_values / self.args.seconds,
+                "latency": self.delivery_latency.summary(),
+            },
+            "errors": self.errors,
+        }
+
+
+def parse_queues(spec: str) -> ([str], [float]):
+    """:returns the queue names and weights of a spec such as LOAD_A=3,LOAD_B=1 (a queue
+    without a weight gets 1). Raises ValueError."""
+
+    queues, weights = [], []
+    for each_queue in spec.split(","):
+        q, _, weight = each_queue.strip().partition("=")
+        if not q:
+            raise ValueError(f"Invalid queue mix: {spec}")
+        queues.append(q)
+        weights.append(float(weight or 1))
+    return queues, weights
+
+
+def parse_batch(spec: str):
+    """:returns a function that draws a batch size from a random.Random, following a spec:
+    N, uniform:LOW:HIGH or exponential:MEAN. Raises ValueError."""
+
+    kind, _, bounds = spec.partition(":")
+    if kind.isdigit() and int(kind) > 0:
+        return lambda rng: int(kind)
+    if kind == "uniform":
+        low, high = (int(bound) for bound in bounds.split(":"))
+        if 0 < low <= high:
+            return lambda rng: rng.randint(low, high)
+    elif kind == "exponential":
+        mean = float(bounds)
+        if mean >= 1:
+            return lambda rng: max(1, round(rng.expovariate(1 / mean)))
+    raise ValueError(f"Invalid batch size: {spec}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args: argparse.Namespace, directory: str, port: int) -> subprocess.Popen:
+    """Starts a headless server in directory, and returns once it is listening on port."""
+
+    shutil.copy("repository.txt", directory)
+    command = [sys.executable, os.path.abspath("broker.py"), "--headless", "--quiet", "--port", str(port),
+               "--durability", args.durability, "--storage", args.storage]
+    server = subprocess.Popen(command, cwd=directory)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("The server did not start.")
+            time.sleep(0.1)
+
+
+def git_version() -> str:
+    """:returns the commit the working tree is at, or None."""
+
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: dict, prefix: str = "") -> {str: float}:
+    """:returns the numbers of results by their dotted path, leaving out the histograms."""
+
+    numbers = {}
+    for key, value in results.items():
+        if isinstance(value, dict) and not key.startswith("histogram"):
+            numbers.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            numbers[f"{prefix}{key}"] = value
+    return numbers
+
+
+def compare(before_path: str, after_path: str):
+    """Prints every number of two results side by side, with how much it changed."""
+
+    with open(before_path) as file:
+        before = json.load(file)
+    with open(after_path) as file:
+        after = json.load(file)
+    print(f"{'':<32} {before.get('version') or before_path:>14} {after.get('version') or after_path:>14}")
+    before_numbers = flatten(before["results"])
+    after_numbers = flatten(after["results"])
+    for key, before_value in before_numbers.items():
+        after_value = after_numbers.get(key)
+        if after_value is None:
+            continue
+        change = f"{(after_value - before_value) / before_value * 100:+.1f}%" if before_value else ""
+        print(f"{key:<32} {before_value:>14.3f} {after_value:>14.3f} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Puts the message broker under load and measures it.")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two results and exit")
+    parser.add_argument("--host", help="use the server running on this host (with --port)")
+    parser.add_argument("--port", type=int, help="the port of a running server, or of the one started")
+    parser.add_argument("--durability", default=DURABILITY, choices=[DURABILITY_NONE, DURABILITY_BATCHED,
+                                                                     DURABILITY_FSYNC])
+    parser.add_argument("--storage", default=STORAGE, choices=[STORAGE_RAW, STORAGE_TEXT])
+    parser.add_argument("--producers", type=int, default=4)
+    parser.add_argument("--consumers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0.0, help="values uploaded per second in all")
+    parser.add_argument("--batch", default="1", help="N, uniform:LOW:HIGH or exponential:MEAN")
+    parser.add_argument("--pipeline", type=int, default=1, help="uploads every producer keeps in flight")
+    parser.add_argument("--queues", default="LOAD_A=1,LOAD_B=1", help="NAME=WEIGHT,...")
+    parser.add_argument("--units", default="meters foot mile", help="the units of the queues that are created")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--output", help="write the results to this file instead of printing them")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.producers < 1 or args.consumers < 0 or args.seconds <= 0 or args.pipeline < 1:
+        parser.error("There must be at least one producer, and --seconds and --pipeline must be positive.")
+
+    server = None
+    directory = None
+    port = args.port or (55557 if args.host else free_port())
+    try:
+        if not args.host:
+            directory = tempfile.mkdtemp(prefix="load_broker_")
+            server = start_server(args, directory, port)
+        try:
+            load = Load(args, port)
+            results = load.run()
+        except ValueError as e:
+            parser.error(str(e))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "output")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
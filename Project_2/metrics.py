@@ -0,0 +1,251 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the metrics module of the message broker. The broker counts what it does in
+counters and histograms, and reads what it holds (queue depths, connected clients) through
+gauges, all kept in a Metrics registry (see Broker.metrics). A registry can serve them over
+HTTP, for monitoring:
+    /metrics        in the Prometheus text format.
+    /metrics.json   as a JSON snapshot.
+
+Recording is cheap enough to leave on: a counter or histogram keeps a cell for every thread
+that records into it, which no other thread ever writes to, so recording takes no lock. The
+cells of all threads are only added up when the metrics are scraped, which may be a few
+records behind. A gauge records nothing, it is read when it is scraped.
+
+A metric may have a label (e.g. the queue), and then holds a value for every value of its
+label. Latencies are histograms in seconds, with the buckets of LATENCY_BUCKETS."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the upper bounds of the histogram buckets, in seconds. There is always a last one, +Inf.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    def __init__(self, name: str, help_text: str, label: str = None):
+        self.name = name
+        self.help_text = help_text
+        # the name of the metric's label, if it has one.
+        self.label = label
+        self.local = threading.local()
+        # the cells of every thread that has recorded into the metric, as {label value: cell}.
+        self.all_cells: [dict] = []
+        self.cells_lock = threading.Lock()
+
+    def _cells(self) -> dict:
+        """:returns the cells of the calling thread."""
+
+        try:
+            return self.local.cells
+        except AttributeError:
+            cells = self.local.cells = {}
+            with self.cells_lock:
+                self.all_cells.append(cells)
+            return cells
+
+    def _thread_cells(self) -> [dict]:
+        """:returns a copy of the cells of every thread."""
+
+        with self.cells_lock:
+            all_cells = list(self.all_cells)
+        # a thread may add a label value while it is being copied, copying a dict is atomic.
+        return [dict(cells) for cells in all_cells]
+
+    def _labels(self, label_value: str) -> str:
+        """:returns the labels of a sample, in the Prometheus text format."""
+
+        return f'{{{self.label}="{escape(label_value)}"}}' if self.label else ""
+
+
+class Counter(Metric):
+    def inc(self, amount: int = 1, label_value: str = ""):
+        cells = self._cells()
+        cells[label_value] = cells.get(label_value, 0) + amount
+
+    def collect(self) -> {str: int}:
+        """:returns the total of every label value, over all threads."""
+
+        totals = {}
+        for cells in self._thread_cells():
+            for label_value, count in cells.items():
+                totals[label_value] = totals.get(label_value, 0) + count
+        return totals
+
+    def prometheus(self) -> [str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{self._labels(label_value)} {count}"
+                     for label_value, count in sorted(self.collect().items()))
+        return lines
+
+
+class Histogram(Metric):
+    def __init__(self, name: str, help_text: str, label: str = None, buckets: (float,) = LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label)
+        self.buckets = buckets
+
+    def observe(self, value: float, label_value: str = ""):
+        cells = self._cells()
+        cell = cells.get(label_value)
+        if cell is None:
+            # how many values fell into every bucket (and +Inf), followed by their sum.
+            cell = cells[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def collect(self) -> {str: ([int], float)}:
+        """:returns the cumulative count of every bucket (the last is +Inf, the total count)
+        and the sum, of every label value, over all threads."""
+
+        totals = {}
+        for cells in self._thread_cells():
+            for label_value, cell in cells.items():
+                total = totals.setdefault(label_value, [0] * len(cell))
+                for idx, value in enumerate(cell):
+                    total[idx] += value
+        results = {}
+        for label_value, total in totals.items():
+            counts = []
+            for count in total[:-1]:
+                counts.append(count + (counts[-1] if counts else 0))
+            results[label_value] = (counts, total[-1])
+        return results
+
+    def prometheus(self) -> [str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total) in sorted(self.collect().items()):
+            label = f'{self.label}="{escape(label_value)}",' if self.label else ""
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{label}le="{le}"}} {count}')
+            lines.append(f"{self.name}_sum{self._labels(label_value)} {total!r}")
+            lines.append(f"{self.name}_count{self._labels(label_value)} {counts[-1]}")
+        return lines
+
+    def quantile(self, counts: [int], fraction: float):
+        """:returns the upper bound of the bucket holding the given fraction of the values,
+        None if there are none, and "+Inf" if it is the last bucket."""
+
+        if not counts[-1]:
+            return None
+        idx = bisect.bisect_left(counts, fraction * counts[-1])
+        return self.buckets[idx] if idx < len(self.buckets) else "+Inf"
+
+
+class Gauge(Metric):
+    def __init__(self, name: str, help_text: str, label: str = None, read_fn=None):
+        super(Gauge, self).__init__(name, help_text, label)
+        # returns the value of the gauge, or {label value: value} if it has a label.
+        self.read_fn = read_fn
+
+    def collect(self) -> {str: float}:
+        values = self.read_fn()
+        return values if self.label else {"": values}
+
+    def prometheus(self) -> [str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        lines.extend(f"{self.name}{self._labels(label_value)} {value}"
+                     for label_value, value in sorted(self.collect().items()))
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.all_metrics: [Metric] = []
+        self.http_server: ThreadingHTTPServer = None
+
+    def counter(self, name: str, help_text: str, label: str = None) -> Counter:
+        return self._add(Counter(name, help_text, label))
+
+    def histogram(self, name: str, help_text: str, label: str = None,
+                  buckets: (float,) = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, label, buckets))
+
+    def gauge(self, name: str, help_text: str, read_fn, label: str = None) -> Gauge:
+        return self._add(Gauge(name, help_text, label, read_fn))
+
+    def _add(self, metric: Metric):
+        self.all_metrics.append(metric)
+        return metric
+
+    def prometheus(self) -> str:
+        """:returns every metric in the Prometheus text format."""
+
+        lines = []
+        for metric in self.all_metrics:
+            lines.extend(metric.prometheus())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """:returns every metric as {name: {label value: value}} (without a label, the value
+        itself). The value of a histogram is its count, sum, p50, p99 and p999 (estimated by
+        the buckets) and cumulative buckets."""
+
+        snapshot = {}
+        for metric in self.all_metrics:
+            if isinstance(metric, Histogram):
+                values = {}
+                for label_value, (counts, total) in metric.collect().items():
+                    values[label_value] = {
+                        "count": counts[-1], "sum": total,
+                        "p50": metric.quantile(counts, 0.5), "p99": metric.quantile(counts, 0.99),
+                        "p999": metric.quantile(counts, 0.999),
+                        "buckets": {"+Inf" if idx == len(metric.buckets) else repr(metric.buckets[idx]): count
+                                    for idx, count in enumerate(counts)},
+                    }
+            else:
+                values = metric.collect()
+            snapshot[metric.name] = values if metric.label else values.get("", 0)
+        return snapshot
+
+    def serve(self, host: str, port: int):
+        """Serves the metrics over HTTP on its own thread. Raises OSError if the port cannot
+        be bound."""
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.prometheus().encode("utf-8"), PROMETHEUS_CONTENT_TYPE
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.snapshot()).encode("utf-8"), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are not worth a line each.
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, name="metrics_thread", daemon=True).start()
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+
+def escape(label_value: str) -> str:
+    """:returns label_value escaped for the Prometheus text format."""
+
+    return label_value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,394 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the outbox of a client: uploads are kept in an append-only file until the server
+has confirmed them, so a producer on a flaky link loses nothing while the server cannot be
+reached, and does not have to wait for it either. An Outbox stands in for a Client (see
+broker_client.py): upload() and upload_many() only append to the outbox and return, and a
+flusher thread sends what is in it to the server.
+
+While the server cannot be reached, the flusher tries to reconnect with exponential backoff
+and full jitter: the n-th attempt waits a random time between 0 and
+min(BACKOFF_CAP, BACKOFF_BASE * 2^n) seconds, so a server coming back is not hit by every
+client at once. The first attempt after a connection is lost waits too, and the backoff
+only starts over once the server has answered an upload. A batch the server does not answer
+within REPLY_TIMEOUT seconds is taken to mean the link dropped silently: the connection is
+closed, and the flusher backs off and reconnects. A batch the server could not store is
+sent again after backing off too; only those it will never take (their queue is gone) are
+dropped. Once connected, the backlog goes
+out as large batches (OP_UPLOAD_BATCH, up to batch_size values of a queue each) instead of
+a request per value.
+
+Every upload has a message id (a random one, unless the producer gives its own, of at most
+framing.MAX_UPLOAD_ID_LENGTH bytes). An upload whose id is already in the outbox, or among
+the last DEDUP_WINDOW ids the server confirmed, is dropped, so a producer can upload again
+whatever it is not sure made it into the outbox. The ids are sent along with every batch,
+and the server drops the values whose id came with one of its last uploads to the queue
+(see Broker.add_many_to_queue()): a batch the server stored, but whose confirmation was
+lost along with the connection, is not stored twice when it is sent again. The server only
+remembers the ids while it runs, so a batch sent again after the server restarted may
+still be stored twice.
+
+The outbox file holds a JSON line per upload ({"id", "q", "meters"}) and per confirmed batch
+({"done": [ids]}). It is compacted as it grows, whether or not uploads are still waiting
+(see _done()). When it is opened, a torn last line (of a client killed mid-write) is
+skipped. Uploads are flushed to the OS, but only synced to the disk with fsync=True.
+
+The other calls of a Client (check(), list_queues(), ...) go to the current connection, and
+raise ConnectionError while there is none."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import uuid
+from collections import OrderedDict
+
+import broker_client
+import framing
+from broker_client import BrokerError, Client, HOST, PORT
+from connection_pool import ConnectionPool
+
+# how many values are sent in a single request at most.
+FLUSH_BATCH = 5000
+# the longest wait before the first attempt to reconnect, and before any other, in seconds.
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# how often (in seconds) an idle flusher checks that its connection is still there.
+IDLE_CHECK = 1.0
+# how long (in seconds) the flusher waits for the server to confirm a batch, before it takes
+# the connection for lost.
+REPLY_TIMEOUT = 30.0
+# how many of the message ids the server confirmed are remembered, to drop uploads that come again.
+DEDUP_WINDOW = 100000
+# how large the outbox file grows before it is compacted, at least.
+COMPACT_BYTES = 1 << 20
+
+
+def backoff(attempt: int) -> float:
+    """:returns how long to wait before the attempt-th retry (counting from 0), with full jitter."""
+
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def check_message_id(message_id: str):
+    """Raises ValueError if message_id is too long to be sent along with an upload."""
+
+    if len(message_id.encode("utf-8")) > framing.MAX_UPLOAD_ID_LENGTH:
+        raise ValueError(f"Message id {message_id!r} is longer than {framing.MAX_UPLOAD_ID_LENGTH} bytes.")
+
+
+class Outbox:
+    def __init__(self, path: str, client_name: str, host: str = HOST, port: int = PORT, pool: ConnectionPool = None,
+                 status_fn=None, fsync: bool = False, batch_size: int = FLUSH_BATCH):
+        """Opens the outbox file at path (sending whatever it still holds), and connects as
+        client_name, on a connection of pool if given. If the server cannot be reached, the
+        flusher keeps trying. status_fn (if any) is told about the connection coming and
+        going, and every batch sent."""
+
+        self.path = path
+        self.client_name = client_name
+        self.host = host
+        self.port = port
+        self.pool = pool
+        self.status_fn = status_fn
+        self.fsync = fsync
+        self.batch_size = batch_size
+        # the uploads not confirmed yet, by queue name, as message id -> (order, meters) in the
+        # order they were uploaded, so a batch is taken from the front of its queue. A queue is
+        # dropped once it has none left.
+        self.pending: {str: OrderedDict} = {}
+        # hands out the order of the uploads, across queues.
+        self.upload_order = itertools.count()
+        # the last DEDUP_WINDOW message ids the server confirmed, oldest first.
+        self.done_ids: {str: None} = {}
+        # held while pending, done_ids or the file are used.
+        self.lock = threading.Lock()
+        # notified once pending is empty.
+        self.flushed = threading.Condition(self.lock)
+        # set by every upload, to wake the flusher.
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        # the client the flusher sends with, None while the server cannot be reached.
+        self.client: Client = None
+
+        self.file = None
+        # the size of the outbox file after it was last compacted.
+        self.compacted_bytes = 0
+        self._load()
+        self._compact()
+        try:
+            self.client = self._connect()
+        except OSError as e:
+            self._status(f"{client_name} could not connect ({e}), its uploads are kept in {path}.")
+        self.flusher = threading.Thread(target=self._run, name="outbox_flusher", daemon=True)
+        self.flusher.start()
+
+    @property
+    def connected(self) -> bool:
+        client = self.client
+        return client is not None and not client.session.connection.closed
+
+    def upload(self, meters: float, q: str, trace=None, message_id: str = None) -> str:
+        """Puts an upload of meters to queue q into the outbox. :returns its message id."""
+
+        message_id = message_id or uuid.uuid4().hex
+        check_message_id(message_id)
+        self._put([(message_id, q, meters)])
+        if trace is not None:
+            trace.mark("append")
+        return message_id
+
+    def upload_many(self, all_meters: [float], q: str, trace=None, message_ids: [str] = None) -> int:
+        """Puts an upload of every value to queue q into the outbox. :returns how many were
+        put, leaving out those whose message id came before."""
+
+        message_ids = message_ids or [uuid.uuid4().hex for _ in all_meters]
+        for message_id in message_ids:
+            check_message_id(message_id)
+        count = self._put([(message_id, q, meters) for message_id, meters in zip(message_ids, all_meters)])
+        if trace is not None:
+            trace.mark("append")
+        return count
+
+    def _put(self, uploads: [(str, str, float)]) -> int:
+        """Appends the uploads whose message ids are new to the outbox, and wakes the flusher.
+        :returns how many were new."""
+
+        with self.lock:
+            new_uploads = []
+            for message_id, q, meters in uploads:
+                if message_id not in self.done_ids and not self._is_pending(message_id):
+                    self.pending.setdefault(q, OrderedDict())[message_id] = (next(self.upload_order), meters)
+                    new_uploads.append({"id": message_id, "q": q, "meters": meters})
+            self._append(new_uploads)
+        self.wake.set()
+        return len(new_uploads)
+
+    def _is_pending(self, message_id: str) -> bool:
+        return any(message_id in uploads for uploads in self.pending.values())
+
+    def _pending_count(self) -> int:
+        return sum(len(uploads) for uploads in self.pending.values())
+
+    def _append(self, records: [dict]):
+        if not records:
+            return
+        self.file.write("".join(json.dumps(record) + "\n" for record in records))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def _load(self):
+        """Reads back what the outbox file holds."""
+
+        if not os.path.exists(self.path):
+            return
+        # the uploads not confirmed, as message id -> (queue name, meters), in file order.
+        pending = {}
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a client that was killed mid-write.
+                    continue
+                if "done" in record:
+                    for message_id in record["done"]:
+                        pending.pop(message_id, None)
+                        self.done_ids[message_id] = None
+                elif record["id"] not in self.done_ids:
+                    pending[record["id"]] = (record["q"], record["meters"])
+        for message_id, (q, meters) in pending.items():
+            self.pending.setdefault(q, OrderedDict())[message_id] = (next(self.upload_order), meters)
+        self._forget_done_ids()
+
+    def _compact(self):
+        """Rewrites the outbox file with only the uploads not confirmed yet, and the message
+        ids remembered. Called holding the lock (or before the flusher is started)."""
+
+        if self.file is not None:
+            self.file.close()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            self.file = file
+            self._append([{"done": list(self.done_ids)}] if self.done_ids else [])
+            # in the order they were uploaded, across queues.
+            self._append([record for order, record in heapq.merge(
+                *(self._records(q, uploads) for q, uploads in self.pending.items()), key=lambda entry: entry[0])])
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.compacted_bytes = os.path.getsize(self.path)
+
+    @staticmethod
+    def _records(q: str, uploads: OrderedDict):
+        """Yields (order, record) for every upload of uploads, those to queue q."""
+
+        for message_id, (order, meters) in uploads.items():
+            yield order, {"id": message_id, "q": q, "meters": meters}
+
+    def _forget_done_ids(self):
+        for message_id in list(self.done_ids)[:max(0, len(self.done_ids) - DEDUP_WINDOW)]:
+            del self.done_ids[message_id]
+
+    def _connect(self) -> Client:
+        return broker_client.connect(self.client_name, self.host, self.port, self.pool)
+
+    def _status(self, status_message: str):
+        if self.status_fn is not None:
+            self.status_fn(status_message)
+
+    def _run(self):
+        """The flusher thread. Keeps connected, and sends the outbox to the server, until
+        the outbox is closed."""
+
+        attempt = 0
+        while not self.stopped.is_set():
+            if self.client is None or self.client.session.connection.closed:
+                if self.client is not None:
+                    self._disconnect()
+                # even the first attempt waits, so the clients that lost the server at the same
+                # time do not all come back at the same time.
+                if self.stopped.wait(backoff(attempt)):
+                    break
+                attempt += 1
+                try:
+                    self.client = self._connect()
+                except OSError:
+                    continue
+                self._status(f"{self.client_name} is connected again, {self._pending_count()} uploads to send.")
+
+            self.wake.clear()
+            batch = self._next_batch()
+            if batch is None:
+                self.wake.wait(IDLE_CHECK)
+                continue
+            q, message_ids, all_meters = batch
+            try:
+                self.client.upload_many(all_meters, q, timeout=REPLY_TIMEOUT, upload_ids=message_ids)
+                self._status(f"SERVER: {self.client_name} has uploaded {len(all_meters)} values to Queue {q}.")
+            except (ConnectionError, TimeoutError) as e:
+                if isinstance(e, TimeoutError):
+                    # the link may have dropped without the connection noticing (half-open), in
+                    # which case it never fails on its own.
+                    self.client.session.connection.close()
+                # sent again once connected, after backing off: the connection may not be marked
+                # closed yet, or may drop right after every connect.
+                self._disconnect()
+                continue
+            except BrokerError as e:
+                if e.status != framing.STATUS_NOT_FOUND:
+                    # e.g. the server could not store them, sent again after backing off.
+                    self._status(f"SERVER: Error - {len(all_meters)} uploads of {self.client_name} will be "
+                                 f"sent again. {e}")
+                    if self.stopped.wait(backoff(attempt)):
+                        break
+                    attempt += 1
+                    continue
+                # the server will never take them (the queue is gone).
+                self._status(f"SERVER: Error - {len(all_meters)} uploads of {self.client_name} were dropped. {e}")
+            # the server answered, so the connection works.
+            attempt = 0
+            self._done(q, message_ids)
+
+    def _next_batch(self) -> (str, [str], [float]):
+        """:returns the next batch to send: the queue name of the oldest upload not confirmed,
+        and the message ids and values of the first batch_size uploads to that queue. None if
+        there are none. They stay pending until _done()."""
+
+        with self.lock:
+            if not self.pending:
+                return None
+            # the queue whose first upload is the oldest.
+            q = min(self.pending, key=lambda each_q: next(iter(self.pending[each_q].values()))[0])
+            message_ids, all_meters = [], []
+            for message_id, (order, meters) in itertools.islice(self.pending[q].items(), self.batch_size):
+                message_ids.append(message_id)
+                all_meters.append(meters)
+            return q, message_ids, all_meters
+
+    def _done(self, q: str, message_ids: [str]):
+        """Records that the uploads to queue q with message_ids are done with. The outbox file
+        is compacted once it is over COMPACT_BYTES, and twice as large as it was after the last
+        compaction, so a backlog that never drains does not rewrite it on every batch."""
+
+        with self.lock:
+            uploads = self.pending.get(q, {})
+            for message_id in message_ids:
+                uploads.pop(message_id, None)
+                self.done_ids[message_id] = None
+            if not uploads:
+                self.pending.pop(q, None)
+            self._forget_done_ids()
+            self._append([{"done": message_ids}])
+            if self.file.tell() > max(COMPACT_BYTES, 2 * self.compacted_bytes):
+                self._compact()
+            if not self.pending:
+                self.flushed.notify_all()
+
+    def _disconnect(self):
+        self._status(f"{self.client_name} lost its connection, its uploads are kept in {self.path}.")
+        try:
+            self.client.close()
+        except OSError:
+            pass
+        self.client = None
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits until the server has confirmed everything in the outbox. :returns False if
+        timeout seconds passed first."""
+
+        with self.lock:
+            return self.flushed.wait_for(lambda: not self.pending, timeout)
+
+    def _current_client(self) -> Client:
+        client = self.client
+        if client is None or client.session.connection.closed:
+            raise ConnectionError(f"{self.client_name} is not connected to the server.")
+        return client
+
+    def list_queues(self) -> {str: [str]}:
+        return self._current_client().list_queues()
+
+    def create_queue(self, q: str, units: [str]):
+        self._current_client().create_queue(q, units)
+
+    def delete_queue(self, q: str):
+        self._current_client().delete_queue(q)
+
+    def check(self, q: str, wait: float = broker_client.CHECK_WAIT) -> [str]:
+        return self._current_client().check(q, wait)
+
+    def iter_messages(self, q: str, wait: float = broker_client.CHECK_WAIT):
+        return self._current_client().iter_messages(q, wait)
+
+    def iter_pages(self, q: str, wait: float = broker_client.CHECK_WAIT, trace=None):
+        return self._current_client().iter_pages(q, wait, trace)
+
+    def close(self):
+        """Stops the flusher and closes the connection. What the server has not confirmed
+        stays in the outbox file, and is sent once it is opened again."""
+
+        self.stopped.set()
+        self.wake.set()
+        self.flusher.join()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self) -> "Outbox":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,758 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the persistence module of the message broker. Instead of re-pickling every
+queue on each change, every mutation is appended to a log file as a small checksummed
+record. Every so often the log is compacted: the queues are written into a snapshot
+('all_queues.p') and the log records that the snapshot already covers are thrown away.
+
+On startup the snapshot is loaded and whatever is left in the log is replayed on top of it.
+
+Records are not written by the client threads themselves. They are handed to a single
+persistence thread which writes whatever has piled up as one batch (group commit), so
+concurrent uploads share one write (and one fsync) instead of queueing up on the disk.
+Each append returns a Future that is resolved once its record is as durable as the
+durability mode promises, or failed with the OSError that kept it from being written:
+    DURABILITY_NONE - written behind, never fsync'd. The Future resolves immediately.
+    DURABILITY_BATCHED - one fsync per batch. The Future resolves after that fsync.
+    DURABILITY_FSYNC - every record is written and fsync'd on its own.
+
+Record layout (little-endian):
+    crc32 (I) | op (B) | queue name length (H) | payload length (I) | seq (Q) | name | payload
+The crc32 covers everything after itself. A torn or corrupt record marks the end of the
+log, anything after it is ignored (and truncated away).
+
+Every record carries a per-queue sequence number, and the snapshot stores the last
+sequence number it includes for each queue. Replay skips records the snapshot already
+contains, so a crash half-way through a compaction never applies a record twice.
+
+Queues themselves are created and deleted through the log as well (CREATE/DELETE records,
+the payload of a CREATE is the queue's units), and the snapshot stores the units of every
+queue next to its contents. A queue name keeps counting up its sequence numbers after the
+queue is deleted, so a queue re-created under the same name never clashes with the
+records of the old one.
+
+The sequence number of an ENQUEUE record is also the id of the message it holds. An
+ENQUEUE_RAW record holds the raw values (doubles) of several messages at once, and takes up
+as many sequence numbers: its own is the id of the last of them. Messages
+are handed out to consumers before they are acknowledged, and not always in order, so an
+ACK record lists the ids of the messages it removes. Queue contents (in the snapshot and
+as put into the queues by recover()) are (message id, message) tuples.
+
+Neither compaction nor recovery reads the queues message by message. The snapshot is a
+small header, and the messages are kept in data files ('all_queues.<number>.data') in
+the format of a segment of segment_queue.py. The header lists, for every queue, its number
+of messages and the regions of data files it is made of, in order. On startup every region
+is memory-mapped as a segment of its queue, and read only once it is consumed; messages
+acknowledged after the snapshot was taken are left out when the segment is read. Only the
+log files are replayed record by record (they are memory-mapped too), and the log is
+compacted before it grows past COMPACT_MAX_RECORDS records, so startup time does not grow
+with the number of queued messages. Closing the log compacts it, so a clean restart does
+not replay anything at all.
+
+Compaction is incremental: a region of an older data file that is still part of a queue is
+referred to by the new header instead of being copied. Only the parts of the queues held
+in memory (and the segments spilled since the last compaction, which then make way for
+their copies) are written to the new data file. A data file is deleted once no snapshot
+refers to it any more.
+
+A failed write or compaction does not stop the persistence thread. The records of a failed
+write are failed (see above), and the log is cut back to the end of the last good record,
+so the records written after them are not lost behind a torn one on recovery; if it cannot
+be, the log carries on in a new file. A failed compaction leaves the older log files in
+place, and is tried again COMPACT_RETRY_SECONDS later."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import glob
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+from segment_queue import Segment, encode_items
+
+# record op codes.
+ENQUEUE = 1
+DEQUEUE = 2
+CREATE = 3
+DELETE = 4
+ACK = 5
+ENQUEUE_RAW = 6
+
+RECORD_HEADER = struct.Struct("<IBHIQ")
+COUNT = struct.Struct("<I")
+# a message id in an ACK record. Signed, since messages carried over from storage files
+# without ids may get ids below 1 (see _load_items()).
+MESSAGE_ID = struct.Struct("<q")
+# a raw value in an ENQUEUE_RAW record.
+RAW_VALUE = struct.Struct("<d")
+
+# the log is never compacted before it holds this many records.
+COMPACT_MIN_RECORDS = 10000
+# the log is always compacted once it holds this many records, however many messages the
+# queues hold, so replaying it never takes long.
+COMPACT_MAX_RECORDS = 100000
+# how many messages are encoded at a time while a snapshot is written.
+SNAPSHOT_CHUNK_ITEMS = 10000
+# how many bytes of a segment are copied at a time while a snapshot is written.
+SNAPSHOT_COPY_BYTES = 1 << 20
+# how many message ids a chunk of a MessageIdSet covers.
+ID_CHUNK_SIZE = 1 << 16
+# how long a failed compaction waits before it is tried again, in seconds.
+COMPACT_RETRY_SECONDS = 5.0
+
+DURABILITY_NONE = "none"
+DURABILITY_BATCHED = "batched"
+DURABILITY_FSYNC = "fsync"
+
+
+def all_durable(futures: [Future]) -> Future:
+    """:returns a Future that is resolved once all of futures are, or failed with the error of
+    the first of them that failed. The Future of the last record is not enough: a record
+    that could not be written is not written again, so the records after it may be durable
+    while it is not."""
+
+    combined = Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def resolve(future: Future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        for each_future in futures:
+            if each_future.exception() is not None:
+                combined.set_exception(each_future.exception())
+                return
+        combined.set_result(None)
+
+    if not futures:
+        combined.set_result(None)
+    for future in futures:
+        future.add_done_callback(resolve)
+    return combined
+
+
+class MessageIdSet:
+    """A set of message ids, kept as a bitmap with one bit per id. Recovery keeps the ids of
+    every message acknowledged since the snapshot, which come in long runs of ids, so that
+    costs a bit each instead of a whole int object. The bitmap is split into chunks of
+    ID_CHUNK_SIZE ids, and only the chunks that hold an id are allocated."""
+
+    def __init__(self):
+        self.chunks: {int: bytearray} = {}
+
+    def add(self, message_id: int):
+        chunk_idx, bit = divmod(message_id, ID_CHUNK_SIZE)
+        chunk = self.chunks.get(chunk_idx)
+        if chunk is None:
+            chunk = self.chunks[chunk_idx] = bytearray(ID_CHUNK_SIZE // 8)
+        chunk[bit >> 3] |= 1 << (bit & 7)
+
+    def update(self, message_ids):
+        for message_id in message_ids:
+            self.add(message_id)
+
+    def __contains__(self, message_id: int) -> bool:
+        chunk_idx, bit = divmod(message_id, ID_CHUNK_SIZE)
+        chunk = self.chunks.get(chunk_idx)
+        return chunk is not None and chunk[bit >> 3] & (1 << (bit & 7)) != 0
+
+    def union(self, other: "MessageIdSet") -> "MessageIdSet":
+        """:returns a new set holding the ids of both sets."""
+
+        result = MessageIdSet()
+        for chunk_idx in self.chunks.keys() | other.chunks.keys():
+            bits = (int.from_bytes(self.chunks.get(chunk_idx, b""), "little")
+                    | int.from_bytes(other.chunks.get(chunk_idx, b""), "little"))
+            result.chunks[chunk_idx] = bytearray(bits.to_bytes(ID_CHUNK_SIZE // 8, "little"))
+        return result
+
+
+class QueueLog:
+    def __init__(self, base_name: str = "all_queues", durability: str = DURABILITY_BATCHED,
+                 flush_interval: float = 0.005, max_batch: int = 512):
+        if durability not in (DURABILITY_NONE, DURABILITY_BATCHED, DURABILITY_FSYNC):
+            raise ValueError(f"Unknown durability mode: {durability}")
+
+        self.snapshot_path = base_name + ".p"
+        self.base_name = base_name
+        self.durability = durability
+        # how long the persistence thread waits for a batch to fill up, in seconds.
+        self.flush_interval = flush_interval
+        # a batch is written as soon as it holds this many records.
+        self.max_batch = max_batch
+        # called by the persistence thread when the log needs compacting. It must call
+        # write_snapshot() with the queue contents (see write_snapshot()).
+        self.snapshot_fn = None
+        # called by the persistence thread with the seconds a batch took to write, and its
+        # number of records, if set.
+        self.flush_fn = None
+        # called by the persistence thread with what failed and the error, whenever a write or
+        # a compaction fails, if set.
+        self.error_fn = None
+        # a failed compaction is not tried again before this time.monotonic().
+        self.compact_after = 0.0
+        # last sequence number given out for each queue.
+        self.seqs: {str: int} = {}
+        # number of items the log says are in the queues, used to decide when to compact.
+        self.live_items = 0
+        # generation of the log file currently being appended to.
+        self.generation = 0
+        # records appended since the last snapshot.
+        self.records_since_snapshot = 0
+        # how many messages the last recover() put into the queues from the snapshot, and
+        # how many from the log.
+        self.snapshot_items = 0
+        self.log_items = 0
+        self.log_file = None
+        self.lock = threading.Lock()
+        # records waiting for the persistence thread, as (record, future) tuples.
+        self.pending = []
+        self.pending_cond = threading.Condition(self.lock)
+        self.running = False
+        # whether the persistence thread is waiting for a record to come in at all.
+        self.idle = False
+        self.persistence_thread = None
+
+    def _log_path(self, generation: int) -> str:
+        return f"{self.base_name}.{generation}.log"
+
+    def _data_paths(self) -> [str]:
+        return glob.glob(glob.escape(self.base_name) + ".*.data")
+
+    def _new_data_path(self) -> str:
+        """:returns the path of a data file that does not exist yet. Data files are numbered
+        on their own, a snapshot may be written more than once per generation."""
+
+        numbers = [int(path.split(".")[-2]) for path in self._data_paths()]
+        return f"{self.base_name}.{max(numbers, default=0) + 1}.data"
+
+    def recover(self, default_units: {str: [str]}, new_queue) -> ({str: object}, {str: [str]}):
+        """:returns a dict of queue name -> queue, and a dict of queue name -> units.
+
+        Every queue is made by new_queue(name). The regions of the snapshot's data files are
+        attach()ed to it as segments, without being read, then the messages logged after
+        the snapshot are put() into it in order, as (message id, message) tuples. The log
+        files are read twice: first for everything but the messages (which queues were
+        deleted or re-created, which messages were acknowledged), then once more to put the
+        messages that are left into their queues. Snapshots of the older formats are read
+        back message by message instead.
+        The last log file is truncated to its last good record and re-opened so that new
+        records are appended to it. default_units are the queues that exist before anything
+        was ever logged (and the units of older snapshots, which did not store them)."""
+
+        snapshot, snapshot_chunks = self._read_snapshot(default_units)
+        snapshot_gen = snapshot["generation"]
+        snapshot_seqs = snapshot["seqs"]
+        snapshot_regions = snapshot.get("regions", {})
+        units = snapshot.get("units") or {name: list(queue_units) for name, queue_units in default_units.items()}
+
+        self.seqs = dict(snapshot_seqs)
+        for name in units:
+            self.seqs.setdefault(name, 0)
+
+        log_gens = sorted(int(path.split(".")[-2]) for path in glob.glob(glob.escape(self.base_name) + ".*.log"))
+        for gen in log_gens:
+            if gen < snapshot_gen:
+                # left behind by a compaction that crashed after writing the snapshot.
+                os.remove(self._log_path(gen))
+        log_gens = [gen for gen in log_gens if gen >= snapshot_gen]
+        # data files left behind by a compaction that crashed before writing the snapshot.
+        self._remove_data_files(snapshot_regions)
+
+        # the sequence number of the last CREATE/DELETE record of each queue: the messages
+        # logged before it are gone.
+        resets = {}
+        # the number of messages taken from the front of each queue by DEQUEUE records,
+        # which were written before acknowledgements existed.
+        dequeued = {}
+        # the ids of the acknowledged messages of each queue, and how many of them are in
+        # the snapshot.
+        acked = {}
+        snapshot_acked = {}
+        good_lengths = []
+        for gen in log_gens:
+            good_length = 0
+            for op, name, seq, data, start, end in self._read_log(self._log_path(gen)):
+                good_length = end
+                self.records_since_snapshot += 1
+                if seq <= snapshot_seqs.get(name, 0):
+                    continue
+                self.seqs[name] = seq
+                if op == DEQUEUE:
+                    dequeued[name] = dequeued.get(name, 0) + COUNT.unpack_from(data, start)[0]
+                elif op == ACK:
+                    message_ids = [message_id for message_id, in MESSAGE_ID.iter_unpack(data[start:end])]
+                    acked.setdefault(name, MessageIdSet()).update(message_ids)
+                    last_snapshot_seq = snapshot_seqs.get(name, 0)
+                    snapshot_acked[name] = snapshot_acked.get(name, 0) + sum(
+                        1 for message_id in message_ids if message_id <= last_snapshot_seq)
+                elif op in (CREATE, DELETE):
+                    resets[name] = seq
+                    dequeued.pop(name, None)
+                    acked.pop(name, None)
+                    snapshot_acked.pop(name, None)
+                    if op == CREATE:
+                        units[name] = data[start:end].decode("utf-8").split()
+                    else:
+                        units.pop(name, None)
+            good_lengths.append(good_length)
+
+        all_queues = {name: new_queue(name) for name in units}
+        self.snapshot_items = 0
+        self.log_items = 0
+
+        data_maps = {}
+        for name, (count, regions) in snapshot_regions.items():
+            if name not in all_queues or name in resets:
+                continue
+            segments = []
+            for path, start, end, skip_ids in regions:
+                if path not in data_maps:
+                    data_maps[path] = self._map_data_file(path)
+                if name in acked:
+                    skip_ids = acked[name] if skip_ids is None else skip_ids.union(acked[name])
+                segments.append(Segment(data_maps[path], start, end, path, skip_ids))
+            count -= snapshot_acked.get(name, 0)
+            all_queues[name].attach(segments, count)
+            self.snapshot_items += count
+
+        def restore(name: str, item: (int, object)) -> int:
+            """Puts item into queue name, unless it is gone. :returns how many were put."""
+
+            if dequeued.get(name):
+                dequeued[name] -= 1
+            elif item[0] not in acked.get(name, ()):
+                all_queues[name].put(item)
+                return 1
+            return 0
+
+        for name, items in snapshot_chunks:
+            if name in all_queues and name not in resets:
+                for item in items:
+                    self.snapshot_items += restore(name, item)
+        for gen, good_length in zip(log_gens, good_lengths):
+            for op, name, seq, data, start, end in self._read_log(self._log_path(gen), good_length):
+                if op not in (ENQUEUE, ENQUEUE_RAW) or name not in all_queues or seq <= max(
+                        snapshot_seqs.get(name, 0), resets.get(name, 0)):
+                    continue
+                if op == ENQUEUE:
+                    self.log_items += restore(name, (seq, data[start:end].decode("utf-8")))
+                    continue
+                count = (end - start) // RAW_VALUE.size
+                values = struct.unpack_from(f"<{count}d", data, start)
+                for item in zip(range(seq - count + 1, seq + 1), values):
+                    self.log_items += restore(name, item)
+
+        self.generation = log_gens[-1] if log_gens else snapshot_gen
+        self.log_file = open(self._log_path(self.generation), "ab")
+        self.log_file.truncate(good_lengths[-1] if good_lengths else 0)
+        self.live_items = self.snapshot_items + self.log_items
+        self._start_persistence_thread()
+        return all_queues, units
+
+    def _read_snapshot(self, default_units: {str: [str]}) -> (dict, iter):
+        """:returns the snapshot's header (its generation, seqs, units and the regions of
+        every queue), and an iterator over the contents of the older snapshot formats, which
+        have no regions, as (queue name, [(message id, message)]) chunks."""
+
+        empty = {"generation": 0, "seqs": {}}
+        try:
+            file = open(self.snapshot_path, "rb")
+        except FileNotFoundError:
+            return empty, iter(())
+        try:
+            snapshot = pickle.load(file)
+        except EOFError:
+            file.close()
+            return empty, iter(())
+
+        if isinstance(snapshot, dict) and snapshot.get("chunks"):
+            return snapshot, self._read_chunks(file)
+        file.close()
+        if isinstance(snapshot, dict) and "regions" in snapshot:
+            return snapshot, iter(())
+        if isinstance(snapshot, dict):
+            # older snapshots hold every queue in one piece.
+            seqs = snapshot["seqs"]
+            return snapshot, ((name, self._load_items(items, seqs.get(name, 0)))
+                              for name, items in snapshot["queues"].items())
+        # older storage files are a plain list of lists, one per queue.
+        return empty, ((name, self._load_items(items, 0)) for name, items in zip(default_units, snapshot))
+
+    @staticmethod
+    def _map_data_file(path: str) -> mmap.mmap:
+        """:returns a read-only memory map of a data file."""
+
+        with open(path, "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _remove_data_files(self, regions: {str: (int, list)}):
+        """Deletes every data file that none of regions refers to."""
+
+        referenced = {path for count, queue_regions in regions.values() for path, start, end, skip_ids in queue_regions}
+        for path in self._data_paths():
+            if path not in referenced:
+                os.remove(path)
+
+    @staticmethod
+    def _read_chunks(file):
+        """Yields the chunks of a snapshot, up to the end marker, then closes file."""
+
+        with file:
+            while True:
+                chunk = pickle.load(file)
+                if chunk is None:
+                    return
+                yield chunk
+
+    @staticmethod
+    def _load_items(items: list, last_seq: int) -> [(int, str)]:
+        """:returns the items of an older snapshot as (message id, message) tuples. Older
+        storage files hold bare messages, without ids: these get the ids right up to last_seq
+        (the last sequence number the snapshot includes), which no later record can have."""
+
+        if items and not isinstance(items[0], tuple):
+            return [(last_seq - len(items) + 1 + idx, item) for idx, item in enumerate(items)]
+        return items
+
+    def _start_persistence_thread(self):
+        """Starts the thread that writes the pending records to the log."""
+
+        self.running = True
+        self.persistence_thread = threading.Thread(target=self._persist, name="persistence_thread", daemon=True)
+        self.persistence_thread.start()
+
+    @staticmethod
+    def _read_log(path: str, length: int = None):
+        """Yields (op, queue name, seq, data, payload start, payload end) for every valid
+        record in the first length bytes (all of them by default) of a log file, where
+        data is the memory-mapped file. The end of the last record yielded is the length
+        of the valid part of the file."""
+
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                data_end = len(data) if length is None else length
+                offset = 0
+                while offset + RECORD_HEADER.size <= data_end:
+                    crc, op, name_len, payload_len, seq = RECORD_HEADER.unpack_from(data, offset)
+                    end = offset + RECORD_HEADER.size + name_len + payload_len
+                    if end > data_end or zlib.crc32(data[offset + 4:end]) != crc:
+                        break
+                    name_end = offset + RECORD_HEADER.size + name_len
+                    name = data[offset + RECORD_HEADER.size:name_end].decode("utf-8")
+                    yield op, name, seq, data, name_end, end
+                    offset = end
+
+    def _append(self, op: int, name: str, payload: bytes, live_change: int, seq_count: int = 1) -> (int, Future):
+        """Builds a record, which takes up seq_count sequence numbers, and hands it to the
+        persistence thread.
+        :returns the (last) sequence number of the record, and a Future that is resolved
+        once the record is durable."""
+
+        future = Future()
+        if self.durability == DURABILITY_NONE:
+            # resolved before the persistence thread can see it, which would resolve it too.
+            future.set_result(None)
+        name_bytes = name.encode("utf-8")
+        with self.lock:
+            if not self.running:
+                raise RuntimeError("The queue log is closed.")
+            seq = self.seqs.get(name, 0) + seq_count
+            self.seqs[name] = seq
+            self.live_items += live_change
+            body = RECORD_HEADER.pack(0, op, len(name_bytes), len(payload), seq)[4:] + name_bytes + payload
+            self.pending.append((struct.pack("<I", zlib.crc32(body)) + body, future))
+            if self.idle or len(self.pending) >= self.max_batch:
+                self.pending_cond.notify()
+        return seq, future
+
+    def append_enqueue(self, name: str, item: str) -> (int, Future):
+        """Logs that item was put at the back of queue name.
+        :returns the id of the message, and a Future resolved once it is durable."""
+
+        return self._append(ENQUEUE, name, item.encode("utf-8"), 1)
+
+    def append_enqueue_many(self, name: str, items: [str]) -> ([int], Future):
+        """Logs that all items were put at the back of queue name, a record each.
+        :returns the ids of the messages, and a Future resolved once all of them are
+        durable (see all_durable())."""
+
+        message_ids = []
+        futures = []
+        for item in items:
+            message_id, future = self._append(ENQUEUE, name, item.encode("utf-8"), 1)
+            message_ids.append(message_id)
+            futures.append(future)
+        return message_ids, all_durable(futures)
+
+    def append_enqueue_raw(self, name: str, all_meters: [float]) -> ([int], Future):
+        """Logs that the raw values all_meters were put at the back of queue name, in a
+        single record. :returns the ids of the messages, and a Future resolved once they are
+        durable."""
+
+        count = len(all_meters)
+        seq, future = self._append(ENQUEUE_RAW, name, struct.pack(f"<{count}d", *all_meters), count, count)
+        return list(range(seq - count + 1, seq + 1)), future
+
+    def append_ack(self, name: str, message_ids: [int]) -> Future:
+        """Logs that the messages message_ids of queue name were acknowledged (and are gone)."""
+
+        payload = b"".join(MESSAGE_ID.pack(message_id) for message_id in message_ids)
+        return self._append(ACK, name, payload, -len(message_ids))[1]
+
+    def append_create(self, name: str, units: [str]) -> Future:
+        """Logs that queue name was created, converting into units."""
+
+        return self._append(CREATE, name, " ".join(units).encode("utf-8"), 0)[1]
+
+    def append_delete(self, name: str, count: int = 0) -> Future:
+        """Logs that queue name was deleted, along with the count items it still held."""
+
+        return self._append(DELETE, name, b"", -count)[1]
+
+    def _persist(self):
+        """The persistence thread. Waits for records to pile up (for at most flush_interval
+        seconds, or until max_batch records are pending), writes them in one go and then
+        resolves their futures. Compacts the log when it has grown large enough."""
+
+        while True:
+            with self.lock:
+                if self.running and len(self.pending) < self.max_batch:
+                    self.pending_cond.wait(self.flush_interval)
+                batch, self.pending = self.pending, []
+                running = self.running
+
+            if batch:
+                self._write_batch(batch)
+
+            if not running:
+                return
+
+            if (self.snapshot_fn is not None and time.monotonic() >= self.compact_after
+                    and self.records_since_snapshot >= max(COMPACT_MIN_RECORDS,
+                                                           min(self.live_items, COMPACT_MAX_RECORDS))):
+                self._compact()
+
+            if not batch:
+                # nothing came in, no need to spin until the next record does.
+                with self.lock:
+                    self.idle = True
+                    while self.running and not self.pending:
+                        self.pending_cond.wait()
+                    self.idle = False
+
+    def _write_batch(self, batch: [(bytes, Future)]):
+        """Writes a batch of records to the log and resolves their futures. If that fails, the
+        futures of the records not written yet are failed with the error, and the torn records
+        are cut off the log (see _drop_torn_records())."""
+
+        started = time.perf_counter()
+        # the length of the log up to the end of its last good record.
+        good_length = None
+        try:
+            if self.log_file is None:
+                # the log could not be re-opened after an earlier failure.
+                self._start_generation()
+            good_length = self.log_file.tell()
+            if self.durability == DURABILITY_FSYNC:
+                for record, future in batch:
+                    self.log_file.write(record)
+                    self.log_file.flush()
+                    os.fsync(self.log_file.fileno())
+                    good_length += len(record)
+                    future.set_result(None)
+            else:
+                self.log_file.write(b"".join(record for record, future in batch))
+                self.log_file.flush()
+                if self.durability == DURABILITY_BATCHED:
+                    os.fsync(self.log_file.fileno())
+                for record, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+        except OSError as e:
+            for record, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            self._report_error("Writing to the log failed", e)
+            if good_length is not None:
+                self._drop_torn_records(good_length)
+        self.records_since_snapshot += len(batch)
+        if self.flush_fn is not None:
+            self.flush_fn(time.perf_counter() - started, len(batch))
+
+    def _drop_torn_records(self, good_length: int):
+        """Cuts the log back to its first good_length bytes after a failed write. recover()
+        stops reading a log file at its first bad record, so the records written after a
+        torn one would be lost. If the log cannot be cut back, a new log file is started
+        instead, which recover() reads on its own."""
+
+        try:
+            self.log_file.close()
+        except OSError:
+            # whatever it could not flush is cut off below.
+            pass
+        self.log_file = None
+        try:
+            os.truncate(self._log_path(self.generation), good_length)
+            self.log_file = open(self._log_path(self.generation), "ab")
+            return
+        except OSError as e:
+            self._report_error("Cutting the log back failed", e)
+        try:
+            self._start_generation()
+        except OSError as e:
+            # the next batch tries again.
+            self._report_error("Starting a new log file failed", e)
+
+    def _start_generation(self):
+        """Closes the log file (if it is open) and starts appending to the next one."""
+
+        log_file = open(self._log_path(self.generation + 1), "ab")
+        if self.log_file is not None:
+            try:
+                self.log_file.close()
+            except OSError:
+                # every batch was flushed (or cut off) already.
+                pass
+        self.log_file = log_file
+        self.generation += 1
+
+    def _compact(self):
+        """Starts a new log file and asks the owner of the queues for a snapshot.
+        Every record written to the older log files was appended before snapshot_fn
+        collected the queue contents, so the snapshot covers all of them. If that fails, the
+        older log files are kept (recover() still replays them), and the compaction is tried
+        again COMPACT_RETRY_SECONDS later."""
+
+        records, self.records_since_snapshot = self.records_since_snapshot, 0
+        try:
+            self._start_generation()
+            self.snapshot_fn()
+        except Exception as e:
+            self.records_since_snapshot += records
+            self.compact_after = time.monotonic() + COMPACT_RETRY_SECONDS
+            self._report_error("Compacting the log failed", e)
+
+    def _report_error(self, what: str, error: Exception):
+        """Hands a failure of the persistence thread to error_fn, if set."""
+
+        if self.error_fn is not None:
+            self.error_fn(what, error)
+
+    def current_seqs(self) -> {str: int}:
+        """:returns a copy of the last sequence number given out for each queue."""
+
+        with self.lock:
+            return dict(self.seqs)
+
+    def current_seq(self, name: str) -> int:
+        """:returns the last sequence number given out for queue name. Must be read while no
+        records can be appended to the queue, together with its contents."""
+
+        with self.lock:
+            return self.seqs.get(name, 0)
+
+    def write_snapshot(self, contents: {str: (int, list)}, seqs: {str: int},
+                       units: {str: [str]}) -> {str: [(object, Segment)]}:
+        """Writes a new snapshot of contents (and the units of every queue), then drops the
+        log files and the data files it no longer needs. contents holds, for every queue,
+        its number of messages and the parts it is made of, front first: lists of
+        (message id, message) tuples and (segment, start, end) tuples, as returned by
+        SegmentedQueue.snapshot(). Lists and spilled segments are written to a new data file,
+        segments of older data files are only referred to. seqs holds the last sequence number
+        of every queue, read (see current_seq()) while its contents were being collected.
+        :returns the parts that were written to the new data file, for every queue, as
+        (part, copy) tuples, where copy is a segment over what was written (see
+        SegmentedQueue.rebase())."""
+
+        data_path = self._new_data_path()
+        all_regions = {}
+        copied = []
+        with open(data_path, "wb") as data_file:
+            for name, (count, parts) in contents.items():
+                regions = []
+                for part in parts:
+                    offset = data_file.tell()
+                    if isinstance(part, list):
+                        for idx in range(0, len(part), SNAPSHOT_CHUNK_ITEMS):
+                            data_file.write(encode_items(part[idx:idx + SNAPSHOT_CHUNK_ITEMS]))
+                        self._add_region(regions, (data_path, offset, data_file.tell(), None))
+                        copied.append((name, part, offset, data_file.tell()))
+                        continue
+                    segment, start, end = part
+                    if segment.path is not None:
+                        self._add_region(regions, (segment.path, start, end, segment.skip_ids))
+                        continue
+                    for copy_start in range(start, end, SNAPSHOT_COPY_BYTES):
+                        data_file.write(segment.map[copy_start:min(copy_start + SNAPSHOT_COPY_BYTES, end)])
+                        segment.release(copy_start, min(copy_start + SNAPSHOT_COPY_BYTES, end))
+                    self._add_region(regions, (data_path, offset, data_file.tell(), None))
+                    copied.append((name, part, offset, data_file.tell()))
+                all_regions[name] = (count, regions)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+        snapshot = {"generation": self.generation, "seqs": seqs, "units": units, "regions": all_regions}
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        for path in glob.glob(glob.escape(self.base_name) + ".*.log"):
+            if int(path.split(".")[-2]) < self.generation:
+                os.remove(path)
+        self._remove_data_files(all_regions)
+
+        copies = {}
+        if any(start < end for name, part, start, end in copied):
+            data_map = self._map_data_file(data_path)
+            for name, part, start, end in copied:
+                if start < end:
+                    copies.setdefault(name, []).append((part, Segment(data_map, start, end, data_path)))
+        return copies
+
+    @staticmethod
+    def _add_region(regions: list, region: (str, int, int, MessageIdSet)):
+        """Appends region to regions, merging it into the last one if it carries on from it."""
+
+        path, start, end, skip_ids = region
+        if start == end:
+            return
+        if regions and regions[-1][0] == path and regions[-1][2] == start and regions[-1][3] is skip_ids:
+            regions[-1] = (path, regions[-1][1], end, skip_ids)
+        else:
+            regions.append(region)
+
+    def close(self):
+        """Flushes every pending record, stops the persistence thread and closes the log.
+        The log is compacted first if it holds any records, so the next recover() does not
+        need to replay it."""
+
+        with self.lock:
+            self.running = False
+            self.pending_cond.notify()
+        if self.persistence_thread is not None:
+            self.persistence_thread.join()
+            self.persistence_thread = None
+            if self.snapshot_fn is not None and self.records_since_snapshot:
+                self._compact()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
@@ -0,0 +1,333 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the in-memory side of a queue of the message broker, kept within a memory limit.
+Only the head of the queue (the messages handed out next) and its tail (the messages put
+last) are kept as Python objects. Once the tail grows past half of the memory limit, it is
+spilled into segments: fixed-size memory-mapped files, which are filled in order and paged
+back into the head one chunk at a time as the queue is drained.
+
+    head (deque) | segment | segment | ... | tail (deque)
+
+The segment files are anonymous temporary files in the spill directory: they are deleted
+as soon as they are created and only live on through their memory map, so they free their
+disk space once the segment is dropped, and a crash leaves nothing behind. Durability is
+left to queue_log, the segments only take the cold middle of the queue out of memory.
+A segment can also be a range of a snapshot's data file, which is in the same format: on
+startup the queues are made of those (see attach()) instead of being read back message by
+message, and once a snapshot has copied a spilled segment (or the tail) into its data file,
+the copy takes its place (see rebase()).
+A message is either text (str), or a raw value (float) the broker only converts once it is
+delivered. Raw messages with consecutive ids are stored as runs of doubles, 8 bytes each.
+Whenever a range of a segment has been written or read, its pages are dropped from the
+process with madvise(), so the resident set stays flat however far the queue grows, and
+the kernel is free to write the pages back and reclaim them.
+
+A SegmentedQueue is not thread-safe. The broker only touches a queue while holding its
+lock."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import mmap
+import struct
+import tempfile
+from collections import deque
+
+# the size of a segment file. A message larger than that gets a segment of its own.
+SEGMENT_SIZE = 16 << 20
+# how many bytes of messages a queue keeps in memory, unless told otherwise.
+MEMORY_LIMIT = 64 << 20
+# how many messages are paged in from a segment at a time.
+PAGE_IN_ITEMS = 1024
+# roughly what a (message id, message) tuple costs in memory, on top of the message itself.
+ITEM_OVERHEAD = 120
+# a message in a segment: its id and its length, followed by the message (utf-8). A negative
+# length -n is a run of n raw messages (float meters) with the ids that follow on from it,
+# followed by their values (little-endian doubles).
+ITEM = struct.Struct("<qi")
+# the size of a raw message in a segment, and the most raw messages in a run.
+RAW_SIZE = 8
+MAX_RUN = PAGE_IN_ITEMS
+# a page fault also maps the pages around it that are cached (64 KiB on Linux), which may
+# be pages that were released just before, so every release reaches back that far.
+FAULT_AROUND_BYTES = 64 << 10
+
+
+def message_size(message) -> int:
+    """:returns how many bytes message takes up in a segment, not counting ITEM."""
+
+    return RAW_SIZE if isinstance(message, float) else len(message)
+
+
+def encode_items(items: [(int, str)]) -> bytes:
+    """:returns items in the format of a segment."""
+
+    return b"".join(_records(items))
+
+
+def _records(items: [(int, str)]):
+    """Yields items encoded as segment records: one per text message, one per run of raw
+    messages with consecutive ids."""
+
+    run_id, run = 0, []
+    for message_id, message in items:
+        if isinstance(message, float):
+            if run and message_id == run_id + len(run) and len(run) < MAX_RUN:
+                run.append(message)
+                continue
+            if run:
+                yield _run_record(run_id, run)
+            run_id, run = message_id, [message]
+            continue
+        if run:
+            yield _run_record(run_id, run)
+            run = []
+        data = message.encode("utf-8")
+        yield ITEM.pack(message_id, len(data)) + data
+    if run:
+        yield _run_record(run_id, run)
+
+
+def _run_record(first_id: int, run: [float]) -> bytes:
+    return ITEM.pack(first_id, -len(run)) + struct.pack(f"<{len(run)}d", *run)
+
+
+class Segment:
+    def __init__(self, data_map: mmap.mmap, start: int = 0, end: int = 0, path: str = None, skip_ids=None):
+        self.map = data_map
+        # the file the segment is a part of, if it belongs to a snapshot (see queue_log.py).
+        # Those segments already hold their messages, and cannot take any more.
+        self.path = path
+        self.size = len(data_map) if path is None else end
+        # the messages not read yet are map[read_offset:write_offset].
+        self.read_offset = start
+        self.write_offset = end
+        # the ids of messages that are still in the segment, but gone from the queue. They
+        # are left out when the segment is read.
+        self.skip_ids = skip_ids
+
+    @classmethod
+    def create(cls, directory: str, size: int = SEGMENT_SIZE) -> "Segment":
+        """:returns a new, empty segment backed by an anonymous file in directory."""
+
+        with tempfile.TemporaryFile(dir=directory) as file:
+            file.truncate(size)
+            # the map keeps the (already deleted) file alive for as long as the segment lives.
+            return cls(mmap.mmap(file.fileno(), size))
+
+    def append(self, record: bytes) -> bool:
+        """Writes a record (see encode_items()) at the end of the segment.
+        :returns False if it does not fit."""
+
+        end = self.write_offset + len(record)
+        if end > self.size:
+            return False
+        self.map[self.write_offset:end] = record
+        self.write_offset = end
+        return True
+
+    def read(self, max_items: int) -> [(int, str)]:
+        """:returns (and consumes) up to max_items of the messages not read yet (a run of raw
+        messages is read as a whole, so there may be up to MAX_RUN more)."""
+
+        start = self.read_offset
+        items, self.read_offset = self._decode(start, self.write_offset, max_items)
+        self.release(start, self.read_offset)
+        return items
+
+    def exhausted(self) -> bool:
+        return self.read_offset == self.write_offset
+
+    def _decode(self, start: int, end: int, max_items: int) -> ([(int, str)], int):
+        """:returns up to max_items messages from map[start:end], and the offset after them."""
+
+        items = []
+        offset = start
+        while len(items) < max_items and offset < end:
+            message_id, length = ITEM.unpack_from(self.map, offset)
+            offset += ITEM.size
+            if length < 0:
+                values = struct.unpack_from(f"<{-length}d", self.map, offset)
+                run = zip(range(message_id, message_id - length), values)
+                offset -= length * RAW_SIZE
+                items.extend(run if self.skip_ids is None else
+                             (item for item in run if item[0] not in self.skip_ids))
+                continue
+            if self.skip_ids is None or message_id not in self.skip_ids:
+                items.append((message_id, self.map[offset:offset + length].decode("utf-8")))
+            offset += length
+        return items, offset
+
+    def release(self, start: int, end: int):
+        """Drops the pages of map[start:end] from the process. They are still in the file
+        (or the page cache), and are read back in if they are touched again."""
+
+        if end <= start or not hasattr(self.map, "madvise") or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        start = max(0, start - start % mmap.PAGESIZE - FAULT_AROUND_BYTES)
+        self.map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+class SegmentedQueue:
+    def __init__(self, memory_limit: int = MEMORY_LIMIT, spill_dir: str = "."):
+        # how many bytes of messages (counting ITEM_OVERHEAD for each) are kept in memory.
+        self.memory_limit = memory_limit
+        # where the segment files are created.
+        self.spill_dir = spill_dir
+        # the front of the queue, as (message id, message) tuples.
+        self.head = deque()
+        # the messages between the head and the tail, oldest segment first.
+        self.segments = deque()
+        # the back of the queue, and how many bytes it holds.
+        self.tail = deque()
+        self.tail_bytes = 0
+        # how many messages have ever been taken from the front of the tail, and the tail as
+        # it was (and that number) when snapshot() was last called, see rebase().
+        self.tail_taken = 0
+        self.snapshot_tail = (None, 0)
+        # the number of messages in the queue.
+        self.count = 0
+
+    def qsize(self) -> int:
+        return self.count
+
+    def spilled_bytes(self) -> int:
+        """:returns how many bytes of the queue are held in segments."""
+
+        return sum(segment.write_offset - segment.read_offset for segment in self.segments)
+
+    def set_memory_limit(self, memory_limit: int):
+        self.memory_limit = memory_limit
+        if self.tail_bytes > memory_limit // 2:
+            self._spill()
+
+    def put(self, item: (int, str)):
+        """Puts item at the back of the queue."""
+
+        self.tail.append(item)
+        self.tail_bytes += message_size(item[1]) + ITEM_OVERHEAD
+        self.count += 1
+        if self.tail_bytes > self.memory_limit // 2:
+            self._spill()
+
+    def put_front(self, items: [(int, str)]):
+        """Puts items, in their order, back at the front of the queue."""
+
+        self.head.extendleft(reversed(items))
+        self.count += len(items)
+
+    def peek(self) -> (int, str):
+        """:returns the item at the front of the queue, without taking it. Raises IndexError
+        if the queue is empty."""
+
+        self._fill_head()
+        return self.head[0]
+
+    def get(self) -> (int, str):
+        """:returns (and takes) the item at the front of the queue. Raises IndexError if the
+        queue is empty."""
+
+        self._fill_head()
+        item = self.head.popleft()
+        self.count -= 1
+        return item
+
+    def _fill_head(self):
+        """Makes sure the head holds the next items of the queue, if there are any."""
+
+        # a segment may only hold messages that are left out (see Segment.skip_ids).
+        while not self.head and self.segments:
+            segment = self.segments[0]
+            self.head.extend(segment.read(PAGE_IN_ITEMS))
+            if segment.exhausted():
+                self.segments.popleft()
+        if not self.head and self.tail:
+            self.tail_taken += len(self.tail)
+            self.head, self.tail = self.tail, deque()
+            self.tail_bytes = 0
+
+    def _spill(self):
+        """Moves the whole tail into segments, filling up the last one first."""
+
+        segment = self.segments[-1] if self.segments else None
+        start = segment.write_offset if segment is not None else 0
+        for record in _records(self.tail):
+            if segment is None or not segment.append(record):
+                if segment is not None:
+                    segment.release(start, segment.write_offset)
+                segment = Segment.create(self.spill_dir, max(SEGMENT_SIZE, len(record)))
+                self.segments.append(segment)
+                start = 0
+                segment.append(record)
+        if segment is not None:
+            segment.release(start, segment.write_offset)
+        self.tail_taken += len(self.tail)
+        self.tail.clear()
+        self.tail_bytes = 0
+
+    def attach(self, segments: [Segment], count: int):
+        """Puts the messages of segments (count of them, not counting the ones they leave
+        out) at the back of the queue, without reading them."""
+
+        if self.tail:
+            self._spill()
+        self.segments.extend(segments)
+        self.count += count
+
+    def snapshot(self) -> list:
+        """:returns the parts the queue is made of, front first, as the queue is now: changes
+        made to the queue afterwards do not show up in them. The head and the tail are copied
+        as lists of (message id, message) tuples, the segments are (segment, start, end)
+        tuples, since their map[start:end] never changes (segments are only ever appended to,
+        and live on for as long as anything refers to them)."""
+
+        parts = [list(self.head)]
+        parts.extend((segment, segment.read_offset, segment.write_offset) for segment in self.segments)
+        self.snapshot_tail = (list(self.tail), self.tail_taken)
+        parts.append(self.snapshot_tail[0])
+        return parts
+
+    def rebase(self, copies: [(object, Segment)]):
+        """Swaps parts of the queue for their copies, once a snapshot has copied them into
+        its data file. copies holds (part, copy) tuples, where part is one of the parts
+        snapshot() returned, and copy is a segment over the copy of it.
+        A spilled segment makes way for its copy: whatever has been read from the segment
+        since snapshot() is skipped in the copy, and whatever has been written to it since
+        stays in the segment, after the copy. The tail makes way for its copy (which frees
+        its memory) unless messages have been taken from its front since. Other parts are
+        left as they are."""
+
+        segment_copies = {}
+        tail_copy = None
+        for part, copy in copies:
+            if not isinstance(part, list):
+                segment, start, end = part
+                segment_copies[id(segment)] = (start, end, copy)
+            elif part is self.snapshot_tail[0] and self.tail_taken == self.snapshot_tail[1]:
+                tail_copy = copy
+
+        segments = deque()
+        for segment in self.segments:
+            if id(segment) not in segment_copies:
+                segments.append(segment)
+                continue
+            start, end, copy = segment_copies[id(segment)]
+            if segment.read_offset < end:
+                copy.read_offset += segment.read_offset - start
+                segments.append(copy)
+                segment.read_offset = end
+            # the last segment is kept even when it has nothing left, more is spilled into it.
+            if not segment.exhausted() or segment is self.segments[-1]:
+                segments.append(segment)
+
+        if tail_copy is not None:
+            for _ in range(len(self.snapshot_tail[0])):
+                self.tail_bytes -= message_size(self.tail.popleft()[1]) + ITEM_OVERHEAD
+            self.tail_taken += len(self.snapshot_tail[0])
+            segments.append(tail_copy)
+        self.snapshot_tail = (None, 0)
+        self.segments = segments
@@ -2,19 +2,18 @@
 # -*- coding: utf-8 -*-
 
 """ This is the (GUI) server-side of a server/client application in which the client can
-create a number of sub-clients. Each client will have its own socket, running on its own
-thread. The server will then listen infinitely to each client, allowing them to upload messages,
-check for messages, or end the connection.
+create a number of sub-clients. Each client will have its own socket, served by the asyncio
+engine (see engine.py). The server will then listen infinitely to each client, allowing them to
+upload messages, check for messages, or end the connection.
 
-The message-broker portion of the server is integrated within this class. The message
-broker takes care of maintaining/updating the queue storage file, updating the queue,
-and adding messages to the correct output queue.
+The message broker itself lives in broker.py, and can run without this GUI. The GUI is only
+an observer of the broker: it subscribes to the broker's events and shows them.
 
-The functions that could be considered as part of the message broker are:
-    _init_repository_dict()
-    _init_all_queues()
-    add_to_queue()
-    update_all_queues_file()"""
+The events come in on the broker's threads, which never touch Qt themselves. Status lines
+are pushed into an event_log.EventLog, which is drained by a QTimer on the GUI thread every
+STATUS_DRAIN_INTERVAL milliseconds. The status box keeps at most STATUS_MAX_LINES lines.
+The client lists are views of the broker's session registry (see sessions.py): on the same
+timer, they take the changes the registry noted since the last run, in one go."""
 
 __author__ = "Hannan Khan"
 __credits__ = ["Hannan Khan"]
@@ -22,26 +21,26 @@ __version__ = "1.0"
 __maintainer__ = "Hannan Khan"
 __email__ = "hannan.khan@mavs.uta.edu"
 
-import pickle
-import queue
-import socket
 import sys
-import threading
-import time
 
 from PyQt5 import QtWidgets, QtGui
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow
 
-import utils
+import broker
+import event_log
+from broker import Broker
+from event_log import EventLog
+from sessions import SessionRecord
 
-HOST = socket.gethostname()
-PORT = 55557
-MAX_CLIENTS = 3
+# how often the status box is brought up to date, in milliseconds.
+STATUS_DRAIN_INTERVAL = 100
+# the oldest lines of the status box are dropped past this many.
+STATUS_MAX_LINES = 1000
 
 
 class ServerApp(QMainWindow):
-    def __init__(self, screen_width: int, screen_height: int):
+    def __init__(self, screen_width: int, screen_height: int, message_broker: Broker = None):
         super(ServerApp, self).__init__()
         self.WIDTH = 1000
         self.HEIGHT = 563
@@ -53,23 +52,13 @@ class ServerApp(QMainWindow):
         self.setFixedSize(self.WIDTH, self.HEIGHT)
         self.setWindowTitle("Server")
 
-        # stores the conversion rules of each unit.
-        self.repository_dict = {}
-        # stores the units for queue a
-        self.a_units = []
-        # stores the units for queue b
-        self.b_units = []
-        # stores the units for queue c
-        self.c_units = []
         self.current_font = QtGui.QFont("Consolas", 10)
-        # stores all client names
-        self.all_clients: [str] = []
-        # stores all client sockets.
-        self.all_client_sockets: [socket.socket] = []
-        # stores all threads
-        self.all_threads = []
-        # keeps track of all active threads. Gets updated based on all_threads.
-        self.active_threads = []
+        # the message broker this GUI shows.
+        self.broker = message_broker or Broker()
+        # status lines waiting to be shown, written to by the broker's threads.
+        self.status_log = EventLog(min_level=event_log.LEVEL_INFO)
+        # the client lists are brought up to date from the changes of the session registry.
+        self.broker.sessions.track_changes = True
 
         self.main_frame = QtWidgets.QFrame()
         self.main_layout = QtWidgets.QHBoxLayout()
@@ -88,10 +77,12 @@ class ServerApp(QMainWindow):
         self.main_frame.setLayout(self.main_layout)
         self.setCentralWidget(self.main_frame)
 
-        self._init_repository_dict()
-        self._init_all_queues()
-        self._init_socket()
-        self._start_listening_thread()
+        self.status_timer = QTimer(self)
+        self.status_timer.timeout.connect(self.drain_status_log)
+        self.status_timer.start(STATUS_DRAIN_INTERVAL)
+
+        self.broker.subscribe(self.on_broker_event)
+        self.broker.start()
 
         self.show()
 
@@ -153,341 +144,114 @@ class ServerApp(QMainWindow):
         self.bottom_layout = QtWidgets.QVBoxLayout()
         self.bottom_layout.setSpacing(10)
 
+        self.status_header_layout = QtWidgets.QHBoxLayout()
+
         self.status_label = QtWidgets.QLabel()
         self.status_label.setText("Status")
         self.status_label.setFont(self.current_font)
 
-        self.status_box_widget = QtWidgets.QTextEdit()
+        self.status_level_combo = QtWidgets.QComboBox()
+        self.status_level_combo.setFont(self.current_font)
+        for level, level_name in event_log.LEVEL_NAMES.items():
+            self.status_level_combo.addItem(level_name, level)
+        self.status_level_combo.setCurrentIndex(self.status_level_combo.findData(self.status_log.min_level))
+        self.status_level_combo.currentIndexChanged.connect(self.set_status_level)
+
+        self.status_header_layout.addWidget(self.status_label)
+        self.status_header_layout.addStretch()
+        self.status_header_layout.addWidget(self.status_level_combo)
+
+        # a plain text box with a block limit, so appending stays cheap however long it runs.
+        self.status_box_widget = QtWidgets.QPlainTextEdit()
         self.status_box_widget.setReadOnly(True)
         self.status_box_widget.setFont(self.current_font)
+        self.status_box_widget.setMaximumBlockCount(STATUS_MAX_LINES)
 
-        self.bottom_layout.addWidget(self.status_label)
+        self.bottom_layout.addLayout(self.status_header_layout)
         self.bottom_layout.addWidget(self.status_box_widget)
 
         self.main_inter_layout.addLayout(self.bottom_layout)
 
-    def _init_repository_dict(self):
-        """Opens the repository text file, and loads the conversion rules into memory.
-        Assumes that the file already exists, so the application can run.
-        The first 3 lines of the repository contain the units of each queue.
-        The rest of the lines contain a unit and its conversion rules.
-        This way, the repository can be modified and still run."""
-
-        try:
-            with open("repository.txt", "r") as file:
-                self.a_units.extend(file.readline().strip().split())
-                self.b_units.extend(file.readline().strip().split())
-                self.c_units.extend(file.readline().strip().split())
-
-                for line in file.readlines():
-                    segments = line.split(" ")
-                    unit, conversion_rule = (segments[0], segments[1].strip())
-                    self.repository_dict[unit] = conversion_rule
-        except FileNotFoundError as e:
-            print(e)
-            print("No repository file found.\nApplication cannot run without a repository file.")
-            sys.exit(1)
-
-    def _init_all_queues(self):
-        """Initializes all the queues, and loads the serialized versions into volatile memory.
-        Will create a queue storage file if none exists."""
-
-        self.a_queue = queue.Queue()
-        self.b_queue = queue.Queue()
-        self.c_queue = queue.Queue()
-
-        try:
-            try:
-                # reference: https://stackoverflow.com/questions/6568007/how-do-i-save-and-restore-multiple-variables-in-python
-                all_queues = pickle.load(open("all_queues.p", "rb"))
-                # we put all of the lists' items into our volatile memory queues.
-                for i, each_queue in enumerate(all_queues):
-                    for item in each_queue:
-                        if i == 0:
-                            self.a_queue.put(item)
-                        elif i == 1:
-                            self.b_queue.put(item)
-                        elif i == 2:
-                            self.c_queue.put(item)
-                self.update_status("Queues loaded into volatile memory.")
-            except EOFError:
-                self.update_status("EOF ERROR: The queue storage is currently empty.")
-        except FileNotFoundError:
-            # we create the file here if it does not exist.
-            # keep in mind all queues are already initialized to null, no need to fill them.
-            self.update_status("No queue storage file exists. Creating one...")
-            file = open("all_queues.p", "wb")
-            file.close()
-
-    def _init_socket(self):
-        """Creates the socket to which all clients will bind to."""
-
-        self.update_status("Socket is being created...")
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((HOST, PORT))
-        self.sock.listen(MAX_CLIENTS)
-        self.update_status("Socket created, now listening.")
-
-    def _start_listening_thread(self):
-        """Starts the thread used for listening for incoming clients."""
-
-        self.listening_thread = threading.Thread(target=self._start_listening)
-        self.listening_thread.setDaemon(True)
-        self.listening_thread.setName("listening_thread")
-        self.listening_thread.start()
-        self.all_threads.append(self.listening_thread)
-
-    def _start_listening(self):
-        """Listens for incoming clients in infinite loop."""
-
-        self.update_status("Starting listening...")
-        self.update_status("Thread Started: %s" % threading.current_thread())
-
-        while True:
-            # make sure we have an up-to-date active threads list before accepting new client.
-            self.update_active_threads_list()
-            client_socket, address = self.sock.accept()
-            self.update_status("%s has established connection." % address[1])
-            client_name = client_socket.recv(1024).decode("utf-8")
-            # Here is what we do if a client is accepted.
-            self.update_status(f"{client_name} accepted.")
-            self.new_client_handler(client_socket, address, client_name)
-
-    def add_to_queue(self, meters: float = 0.0, q: str = "") -> str:
-        """:returns the results in a string to be shown in our server GUI.
-
-        Converts the meters input into the units specified in the selected q.
-        Places the results into the related queue file (non-volatile mem.)."""
-
-        selected_units = []
-        selected_queue = None
-        all_results = []
-
-        if q == "A":
-            selected_units = self.a_units
-            selected_queue = self.a_queue
-        elif q == "B":
-            selected_units = self.b_units
-            selected_queue = self.b_queue
-        elif q == "C":
-            selected_units = self.c_units
-            selected_queue = self.c_queue
-
-        for unit in selected_units:
-            # Here we convert the meters into the units for the queue.
-            result = eval(str(meters) + self.repository_dict[unit])
-            # Now we add the result to the selected queue.
-            all_results.append(str(result))
-
-        # concatenate all strings to get our results_string.
-        results_string = " ".join([st for st in all_results])
-
-        # puts the string into our queue.
-        selected_queue.put(results_string)
-        # updates our queue storage file to match what is in our volatile memory.
-        self.update_all_queues_file()
-
-        return results_string
-
-    def update_all_queues_file(self):
-        """Updates the queues storage file with the most up-to-date values.
-        The queues are converted into lists then serialized and stored into 'all_queues.p'
-        file.
-        List conversion is done because queue.Queue() objects cannot be serialized
-        as they utilize thread locks."""
-
-        # reference: https://stackoverflow.com/questions/8196254/how-to-iterate-queue-queue-items-in-python
-        a_contents = list(self.a_queue.queue)
-        b_contents = list(self.b_queue.queue)
-        c_contents = list(self.c_queue.queue)
-
-        # reference: https://stackoverflow.com/questions/6568007/how-do-i-save-and-restore-multiple-variables-in-python
-        pickle.dump([a_contents, b_contents, c_contents], open("all_queues.p", "wb"))
-
-    def new_client_handler(self, client_socket: socket.socket = None, address: tuple = (), client_name: str = ""):
+    def on_broker_event(self, kind: str, *args):
+        """Receives an event of the broker (see broker.py for the events). Called on the
+        broker's threads, so the status line is only stored here, drain_status_log() shows it.
+        The client events are left out, the client lists follow the session registry instead."""
+
+        if kind == broker.EVENT_STATUS:
+            self.status_log.push(*args)
+
+    def drain_status_log(self):
+        """Runs on the GUI thread every STATUS_DRAIN_INTERVAL milliseconds. Brings the client
+        lists up to date, then adds the new status lines to the status box in one go."""
+
+        self.refresh_client_lists()
+
+        lines, dropped = self.status_log.drain()
+        if dropped:
+            lines.insert(0, f"... {dropped} status lines skipped ...")
+        if lines:
+            self.update_status("\n".join(lines))
+
+    def set_status_level(self, index: int):
+        """Changes the lowest level of status lines shown, as selected in the level box."""
+
+        self.status_log.min_level = self.status_level_combo.itemData(index)
+
+    def refresh_client_lists(self):
+        """Takes the clients added, changed and removed since the last run from the broker's
+        session registry, and shows them in the client list and the client status list in
+        one go. A client whose status changed many times in between is redrawn once."""
+
+        changed, removed = self.broker.sessions.take_changes()
+        if not (changed or removed):
+            return
+        self.client_list_widget.setUpdatesEnabled(False)
+        self.client_status_widget.setUpdatesEnabled(False)
+        for record in removed:
+            # a client added and removed since the last run was never shown.
+            if record.view is not None:
+                self.remove_client(record)
+        for record in changed:
+            if record.view is None:
+                self.new_client_handler(record)
+            # the status of a client (Connected, Checking..., etc.).
+            record.view[1].setText(record.state)
+        self.client_list_widget.setUpdatesEnabled(True)
+        self.client_status_widget.setUpdatesEnabled(True)
+
+    def new_client_handler(self, record: SessionRecord):
         """Handles the addition of new clients to the server GUI.
         First - it will add the client to the list of clients.
-        Second - It will update the current list of all clients.
-        Third - It will update the client status list.
-        Fourth - Server will send a client added message to the client as confirmation.
-        The infinite loop thread for that client will also get started."""
+        Second - It will update the client status list.
+        The items are kept as the view of the client's record."""
 
         list_item = QtWidgets.QListWidgetItem()
         list_item.setFont(self.current_font)
-        list_item.setText(client_name)
+        list_item.setText(record.client_name)
         self.client_list_widget.addItem(list_item)
-        self.update_status(f"{address[1]} added under {client_name}.")
-
-        self.all_clients.append(client_name)
-        self.all_client_sockets.append(client_socket)
 
         status_item = QtWidgets.QListWidgetItem()
         status_item.setFont(self.current_font)
-        status_item.setText("Connected")
+        status_item.setText(record.state)
         self.client_status_widget.addItem(status_item)
+        record.view = (list_item, status_item)
+
+    def remove_client(self, record: SessionRecord):
+        """Removes a client that has ended its connection from the GUI."""
 
-        client_added_msg = f"SERVER: {client_name} added."
-        client_socket.send(bytes(client_added_msg, "utf-8"))
-
-        # Start the thread that wil listen to this client infinitely.
-        self.start_client_thread(client_socket, client_name)
-
-    def start_client_thread(self, client_socket: socket.socket = None, client_name: str = ""):
-        """Starts the infinite loop thread for each client. Keeps track of this thread by
-        appending it to self.all_threads."""
-
-        t = threading.Thread(name=client_name, target=self.listen_to_client, args=(client_socket, client_name),
-                             daemon=True)
-        self.all_threads.append(t)
-        t.start()
-
-    def listen_to_client(self, client_socket: socket.socket = None, client_name: str = ""):
-        """The infinite loop that will run in a separate thread for each client. While running,
-        it will check for incoming messages from the client. The message contents will
-        determine the action taken by the server. (before each action, the client_idx is updated.)
-
-        UPLOAD:: receives the meters and which queue to upload to (sends conformation
-        for each received). Converts the input. Adds converted string to the queue.
-        Displays the current conversion on the server GUI (under status).
-
-        CHECK:: receives the queue to check for messages and returns with conformation.
-        If queue has no messages, it will let the client know. If there are messages, it
-        will let the client know, to which the client will respond 'READY'. Finally it will send
-        the messages.
-
-        END CONNECTION:: receives that a client has been deleted via the client GUI.
-        To cope, it will first update the status of the client to 'Disconnected' to notify
-        the user. It will re-set the client index (in case multiple clients are being deleted
-        at once). It will close the socket and remove the client from the GUI. The thread
-        is terminated when 'return' is called. The list of active threads is updated in the
-        infinite loop that is running on the MainThread."""
-
-        while True:
-            # Get message and update client idx.
-            msg = client_socket.recv(1024).decode("utf-8").upper()
-            client_idx = utils.get_client_idx(self, client_name)
-
-            if msg == "UPLOAD":
-                self.update_status(f"{client_name} wants to upload.")
-                # Handle here for the upload message, recv the length in meters and the queue to upload from.
-                meters = float(client_socket.recv(1024).decode("utf-8"))
-                server_msg = "METERS RECEIVED"
-                client_socket.send(bytes(server_msg, "utf-8"))
-
-                q = client_socket.recv(1024).decode("utf-8")
-                server_msg = "QUEUE RECEIVED"
-                client_socket.send(bytes(server_msg, "utf-8"))
-
-                self.update_status("Converting...")
-
-                all_results = self.add_to_queue(meters, q)
-
-                # If all went smoothly, server sends a upload successful message.
-                server_msg = f"SERVER: {client_name} has uploaded {meters} to Queue {q}."
-                client_socket.send(bytes(server_msg, "utf-8"))
-                self.client_status_widget.item(client_idx).setText("Connected")
-                self.update_status(f"{client_name} has uploaded {meters} to Queue {q}:")
-                self.update_status(all_results)
-            elif msg == "CHECK":
-                self.client_status_widget.item(client_idx).setText("Checking...")
-                # handle here for the check messages portion. Get which queue to check for. See if it is empty.
-                q = client_socket.recv(1024).decode("utf-8")
-                server_msg = "QUEUE SELECTION RECEIVED"
-                client_socket.send(bytes(server_msg, "utf-8"))
-                self.update_status(f"{client_name} wants to check for messages in Queue {q}.")
-
-                # check if messages are available in that queue. Send conformation.
-                if self.queue_has_messages(q):
-                    server_msg = f"SERVER: Messages available in Queue {q}."
-                    client_socket.send(bytes(server_msg, "utf-8"))
-                    # We wait to see if client can start receiving...
-                    client_msg = client_socket.recv(1024).decode("utf-8")
-                    if client_msg == "READY":
-                        self.client_status_widget.item(client_idx).setText("Downloading...")
-                        # start sending the messages.
-                        self.send_messages_from_queue(client_socket, q)
-                        client_socket.send(bytes("ALL MESSAGES SENT.", "utf-8"))
-                        self.client_status_widget.item(client_idx).setText("Connected")
-                else:
-                    # If empty reply Queue empty. IF not then keep replying with the values of the queue.
-                    server_msg = f"SERVER: NO MESSAGES IN QUEUE {q}."
-                    client_socket.send(bytes(server_msg, "utf-8"))
-                    self.client_status_widget.item(client_idx).setText("Connected")
-            elif msg == "END CONNECTION":
-                # Delete client from all vars and end loop thereby ending thread.
-                self.client_status_widget.item(client_idx).setText("Disconnected")
-                self.update()
-                self.update_status(f"{client_name} has ended connection.")
-
-                # Gives the GUI time to refresh.
-                time.sleep(5)
-                # RE-SET the client index, in case multiple users are deleted at once.
-                client_idx = utils.get_client_idx(self, client_name)
-
-                self.update_status(f"Closing and removing {client_name}...")
-                self.all_client_sockets.remove(client_socket)
-                client_socket.close()
-                self.client_list_widget.takeItem(client_idx)
-                self.client_status_widget.takeItem(client_idx)
-                self.all_clients.remove(client_name)
-
-                return
-
-    def queue_has_messages(self, q: str = "") -> int:
-        """Checks whether a queue has messages in it. Returns zero or one correspondingly.
-        Used in lieu of the queue.empty() function since I am using a FOR-loop iteration,
-        and not a while loop iteration, for iterating over items in the queue."""
-
-        selected_queue = None
-
-        if q == "A":
-            selected_queue = self.a_queue
-        elif q == "B":
-            selected_queue = self.b_queue
-        elif q == "C":
-            selected_queue = self.c_queue
-
-        if selected_queue.qsize() > 0:
-            return 1
-        return 0
-
-    def send_messages_from_queue(self, client_socket, q):
-        """Sends messages from queue q to the client socket.
-        This function is operated by the individual client threads."""
-
-        selected_queue = None
-
-        if q == "A":
-            selected_queue = self.a_queue
-        elif q == "B":
-            selected_queue = self.b_queue
-        elif q == "C":
-            selected_queue = self.c_queue
-
-        for i in range(0, selected_queue.qsize()):
-            item_to_send = selected_queue.get()
-            client_socket.send(bytes(item_to_send, "utf-8"))
-
-        # update the queue storage file to match what we have in our memory.
-        self.update_all_queues_file()
-
-    def update_active_threads_list(self):
-        """"Updates active threads based on if they are alive or not."""
-
-        # reference: https://stackoverflow.com/questions/4067786/checking-on-a-thread-remove-from-list
-        self.active_threads = [thread for thread in self.all_threads if thread.is_alive()]
+        list_item, status_item = record.view
+        self.client_list_widget.takeItem(self.client_list_widget.row(list_item))
+        self.client_status_widget.takeItem(self.client_status_widget.row(status_item))
+        record.view = None
 
     def update_status(self, status_message):
         """Updates the status by adding a line to the status box. It will also keep scrolling
-        to the bottom each time it updates.
-        POSSIBLE ERROR:: at times, this function, when run by threads can exhibit loss
-        of characters to be displayed. The entire message is never lost, only certain characters.
-        Occurs intermittently."""
+        to the bottom each time it updates. Must be called on the GUI thread, other threads
+        go through the broker's events (see on_broker_event())."""
 
-        self.status_box_widget.append(str(status_message))
+        self.status_box_widget.appendPlainText(str(status_message))
         # reference: https://stackoverflow.com/questions/7778726/autoscroll-pyqt-qtextwidget
         self.status_box_widget.moveCursor(QtGui.QTextCursor.End)
-        self.update()
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         """Used to override the closeEvent() integrated GUI function."""
@@ -497,18 +261,16 @@ class ServerApp(QMainWindow):
     def exit_app(self):
         """Closes all sockets and exits the app."""
 
-        for client_socket in self.all_client_sockets:
-            client_socket.close()
-
-        self.sock.close()
-        print(self.all_threads)
+        self.broker.stop()
         sys.exit(0)
 
 
-def main():
-    app = QApplication(sys.argv)
+def main(message_broker: Broker = None, qt_args: [str] = None):
+    """Runs the server GUI. Also started by broker.py when it is run without --headless."""
+
+    app = QApplication([sys.argv[0]] + (sys.argv[1:] if qt_args is None else qt_args))
     screen_size = app.primaryScreen().size()
-    ServerApp(screen_size.width(), screen_size.height())
+    GUI = ServerApp(screen_size.width(), screen_size.height(), message_broker)
     sys.exit(app.exec_())
 
 
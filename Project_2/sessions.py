@@ -0,0 +1,125 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the session registry of the client/server application. It is where the server
+and the client keep their clients, instead of the rows of their client list: every client
+is a SessionRecord, found by its session id or by its name with a dict lookup, however
+many clients there are.
+
+    registry = SessionRegistry(track_changes=True)
+    record = registry.add("client1", connection, address)
+    registry.set_state(record, "Checking...")
+    registry.find("client1") is registry.get(record.session_id)
+
+The client lists of the GUIs are views derived from the registry. On the server, whatever
+happens to the clients comes in on the broker's threads, so the registry only notes which
+records were added, changed or removed (with track_changes), and the GUI takes those
+changes on its timer and brings the lists up to date in one go (see take_changes()). A
+client that changes its state many times in between is redrawn once. A registry is safe to
+use from any thread."""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import itertools
+import threading
+
+
+class SessionRecord:
+    __slots__ = ("session_id", "client_name", "connection", "address", "state", "requests", "messages", "view")
+
+    def __init__(self, session_id: int, client_name: str, connection, address: tuple, state: str):
+        self.session_id = session_id
+        self.client_name = client_name
+        # the connection of the client: its stream writer on the server, its Client on the client.
+        self.connection = connection
+        # the address of the client, on the server.
+        self.address = address
+        # what the client is doing, as shown to the user (Connected, Checking..., etc.).
+        self.state = state
+        # how many requests the client has made, and how many messages it has uploaded or been delivered.
+        self.requests = 0
+        self.messages = 0
+        # whatever the GUI shows the client with (e.g. its list items), None until it is shown.
+        self.view = None
+
+
+class SessionRegistry:
+    def __init__(self, track_changes: bool = False):
+        self.by_id: {int: SessionRecord} = {}
+        # the records of every client name, by session id, oldest first: names need not be unique.
+        self.by_name: {str: {int: SessionRecord}} = {}
+        self.session_ids = itertools.count()
+        # the records added or changed, and those removed, since the last take_changes().
+        self.track_changes = track_changes
+        self.changed: {int: SessionRecord} = {}
+        self.removed: [SessionRecord] = []
+        self.lock = threading.Lock()
+
+    def add(self, client_name: str, connection=None, address: tuple = None, state: str = "Connected") -> SessionRecord:
+        """Registers a new client under a new session id. :returns its record."""
+
+        with self.lock:
+            record = SessionRecord(next(self.session_ids), client_name, connection, address, state)
+            self.by_id[record.session_id] = record
+            self.by_name.setdefault(client_name, {})[record.session_id] = record
+            if self.track_changes:
+                self.changed[record.session_id] = record
+            return record
+
+    def get(self, session_id: int) -> SessionRecord:
+        """:returns the record of session session_id, None if there is none."""
+
+        return self.by_id.get(session_id)
+
+    def find(self, client_name: str) -> SessionRecord:
+        """:returns the record of the oldest client named client_name, None if there is none."""
+
+        with self.lock:
+            records = self.by_name.get(client_name)
+            return next(iter(records.values())) if records else None
+
+    def set_state(self, record: SessionRecord, state: str):
+        """Changes what the client of record is doing."""
+
+        record.state = state
+        if self.track_changes:
+            with self.lock:
+                if record.session_id in self.by_id:
+                    self.changed[record.session_id] = record
+
+    def remove(self, session_id: int) -> SessionRecord:
+        """Unregisters a client. :returns its record, None if there was none."""
+
+        with self.lock:
+            record = self.by_id.pop(session_id, None)
+            if record is None:
+                return None
+            records = self.by_name[record.client_name]
+            del records[session_id]
+            if not records:
+                del self.by_name[record.client_name]
+            if self.track_changes:
+                self.changed.pop(session_id, None)
+                self.removed.append(record)
+            return record
+
+    def take_changes(self) -> ([SessionRecord], [SessionRecord]):
+        """:returns the records added or changed since the last call, and those removed."""
+
+        with self.lock:
+            changed, self.changed = list(self.changed.values()), {}
+            removed, self.removed = self.removed, []
+            return changed, removed
+
+    def records(self) -> [SessionRecord]:
+        """:returns the record of every client, oldest first."""
+
+        with self.lock:
+            return list(self.by_id.values())
+
+    def __len__(self) -> int:
+        return len(self.by_id)
@@ -0,0 +1,212 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Stress test of the message broker's locking. Producer and consumer threads hammer a
+headless broker (no sockets, no GUI) all at once, on 1, 2, 4, ... queues, while the
+persistence thread keeps compacting the log. Consumers now and then drop a page without
+acknowledging it (closing their consumer, as a dropped connection would), so messages are
+delivered again along the way.
+
+Every round fails unless:
+    every page hands out the values of each producer in the order they were uploaded
+    (apart from the values delivered again, which come first),
+    every uploaded value is acknowledged exactly once, and nothing else is,
+    a broker restarted on the same files holds exactly the values never acknowledged.
+
+Prints the throughput (values uploaded and acknowledged per second) of every round, and
+the slowest uploads, which would stall if a snapshot held every queue at once.
+
+Runs in a temporary directory, with the repository file copied from the current one:
+    python stress_broker.py [--queues 1 2 4 8] [--seconds 5] [--threads-per-queue 1]"""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import queue_log
+from broker import Broker, HOST
+
+# the ids of the producers are kept apart in the values they upload: producer * ID_SPAN + n.
+ID_SPAN = 1 << 32
+BATCH_SIZE = 100
+PAGE_ITEMS = 100
+# how often a consumer drops a page instead of acknowledging it.
+DROP_RATE = 0.05
+
+
+class Round:
+    def __init__(self, broker: Broker, all_queues: [str]):
+        self.broker = broker
+        self.all_queues = all_queues
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        # every value uploaded, acknowledged, and the values of each producer delivered so far.
+        self.uploaded = set()
+        self.acked = []
+        self.delivered = set()
+        self.upload_times = []
+        self.errors = []
+
+    def produce(self, producer: int, q: str):
+        count = 0
+        upload_times = []
+        while not self.stopped.is_set():
+            values = [float(producer * ID_SPAN + count + idx) for idx in range(BATCH_SIZE)]
+            started = time.perf_counter()
+            self.broker.add_many_to_queue(values, q)
+            upload_times.append(time.perf_counter() - started)
+            count += BATCH_SIZE
+            with self.lock:
+                self.uploaded.update(values)
+        with self.lock:
+            self.upload_times.extend(upload_times)
+
+    def consume(self, name: str, q: str):
+        consumer = self.broker.open_consumer(name)
+        while not self.stopped.is_set():
+            deliveries, remaining = self.broker.lease_messages(consumer, q, PAGE_ITEMS, 0, 0, 3600.0)
+            if not deliveries:
+                time.sleep(0.001)
+                continue
+            values = [float(message.split()[0]) for tag, message in deliveries]
+            with self.lock:
+                self.check_page(q, values)
+                self.delivered.update(values)
+            if random.random() < DROP_RATE:
+                # every lease of the consumer goes back into the queue.
+                self.broker.close_consumer(consumer)
+                consumer = self.broker.open_consumer(name)
+                continue
+            acked_count, durable = self.broker.ack(consumer, deliveries[-1][0])
+            if acked_count != len(deliveries):
+                self.errors.append(f"{q}: {acked_count} of {len(deliveries)} messages acknowledged")
+            with self.lock:
+                self.acked.extend(values)
+        self.broker.close_consumer(consumer)
+
+    def check_page(self, q: str, values: [float]):
+        """Checks that the values of a page, which were not delivered before, come in the
+        order their producer uploaded them."""
+
+        last_values = {}
+        for value in values:
+            if value in self.delivered:
+                continue
+            producer = int(value) // ID_SPAN
+            if last_values.get(producer, -1.0) >= value:
+                self.errors.append(f"{q}: {value} was delivered after {last_values[producer]}")
+            last_values[producer] = value
+
+
+def run_round(queue_count: int, seconds: float, threads_per_queue: int, repository: str) -> dict:
+    """Runs the stress test on queue_count queues, in a directory of its own.
+    :returns the numbers of the round."""
+
+    directory = tempfile.mkdtemp(prefix="stress_broker_")
+    working_directory = os.getcwd()
+    try:
+        os.chdir(directory)
+        shutil.copy(repository, "repository.txt")
+        broker = Broker(HOST, 0, queue_log.DURABILITY_BATCHED)
+        broker.queue_log.snapshot_fn = broker.update_all_queues_file
+        broker._init_repository_dict()
+        broker._init_all_queues()
+        all_queues = [f"S{idx}" for idx in range(queue_count)]
+        for q in all_queues:
+            broker.create_queue(q, ["meters"]).result()
+
+        stress_round = Round(broker, all_queues)
+        threads = []
+        for idx, q in enumerate(all_queues):
+            for thread_idx in range(threads_per_queue):
+                producer = idx * threads_per_queue + thread_idx
+                threads.append(threading.Thread(target=stress_round.produce, args=(producer, q)))
+                threads.append(threading.Thread(target=stress_round.consume, args=(f"consumer{producer}", q)))
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stress_round.stopped.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        broker.queue_log.close()
+
+        errors = list(stress_round.errors)
+        acked = stress_round.acked
+        if len(set(acked)) != len(acked):
+            errors.append(f"{len(acked) - len(set(acked))} values were acknowledged more than once")
+        if not set(acked) <= stress_round.uploaded:
+            errors.append("values that were never uploaded were acknowledged")
+
+        # whatever was not acknowledged must survive a restart, and nothing else.
+        restarted = Broker(HOST, 0, queue_log.DURABILITY_BATCHED)
+        restarted._init_repository_dict()
+        restarted._init_all_queues()
+        consumer = restarted.open_consumer("check")
+        left = []
+        for q in all_queues:
+            while True:
+                deliveries, remaining = restarted.lease_messages(consumer, q)
+                left.extend(float(message.split()[0]) for tag, message in deliveries)
+                if deliveries:
+                    restarted.ack(consumer, deliveries[-1][0])
+                if not remaining:
+                    break
+        restarted.queue_log.close()
+        if sorted(left) != sorted(stress_round.uploaded - set(acked)):
+            errors.append(f"{len(left)} values left after a restart, "
+                          f"{len(stress_round.uploaded) - len(acked)} were not acknowledged")
+
+        upload_times = sorted(stress_round.upload_times) or [0.0]
+        return {
+            "queues": queue_count,
+            "threads": len(threads),
+            "uploaded": len(stress_round.uploaded) / elapsed,
+            "acked": len(acked) / elapsed,
+            "upload p99": upload_times[int(len(upload_times) * 0.99)],
+            "upload max": upload_times[-1],
+            "errors": errors,
+        }
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress tests the locking of the message broker.")
+    parser.add_argument("--queues", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--threads-per-queue", type=int, default=1,
+                        help="how many producers (and as many consumers) every queue gets")
+    parser.add_argument("--compact-records", type=int, default=20000,
+                        help="compact the log every this many records, to take snapshots under load")
+    args = parser.parse_args()
+
+    queue_log.COMPACT_MIN_RECORDS = queue_log.COMPACT_MAX_RECORDS = args.compact_records
+    repository = os.path.abspath("repository.txt")
+    failed = False
+    print(f"{'queues':>6} {'threads':>7} {'uploaded/s':>11} {'acked/s':>9} {'upload p99':>11} {'upload max':>11}")
+    for queue_count in args.queues:
+        result = run_round(queue_count, args.seconds, args.threads_per_queue, repository)
+        print(f"{result['queues']:>6} {result['threads']:>7} {result['uploaded']:>11.0f} {result['acked']:>9.0f} "
+              f"{result['upload p99'] * 1000:>9.2f}ms {result['upload max'] * 1000:>9.2f}ms")
+        for error in result["errors"]:
+            failed = True
+            print(f"    FAILED: {error}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This is the tracing module of the client/server application. It breaks the latency of a
+request down into its phases, on the server (see BrokerServer.handle_request()) and on the
+client (see ClientApp.upload() and ClientApp.check()), e.g. for an upload on the server:
+
+    decode | status | enqueue | reply
+
+A trace is started for a request, and every phase is ended with Trace.mark(), so the phases
+follow on from each other and add up to the whole request. Timestamps are time.monotonic(),
+which the client and the server share on the same machine, and every trace carries the
+request id, so the traces of both sides of a request can be matched up.
+
+Tracing is opt-in (--trace on the server and on the client), and sampled: only a fraction
+of the requests (--trace-sample) is traced. The others get NULL_TRACE, whose mark() does
+nothing, so leaving tracing on costs next to nothing. Traces are written as JSON lines to a
+trace file, which is rotated once it grows past max_bytes: the last backup_count files are
+kept as <file>.1, <file>.2, ...
+
+Tracing never holds up or breaks a request. Finished traces are handed to a writer thread
+of the tracer, so the thread serving the request (e.g. the event loop of the server) never
+waits for the file. A trace that cannot be written (the file cannot be written or rotated,
+or MAX_PENDING traces are already waiting) is dropped, and counted in Tracer.dropped.
+
+Run as a script, it is the analyzer: it reads trace files (with their rotated backups) and
+prints, for every kind of request, how long requests took and how long each of their phases
+took, and their share of the total:
+    python tracing.py broker_trace.jsonl client_trace.jsonl"""
+
+__author__ = "Hannan Khan"
+__credits__ = ["Hannan Khan"]
+__version__ = "1.0"
+__maintainer__ = "Hannan Khan"
+__email__ = "hannan.khan@mavs.uta.edu"
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+# the fraction of the requests that is traced, unless told otherwise.
+SAMPLE_RATE = 0.01
+# how large a trace file grows before it is rotated, and how many rotated files are kept.
+MAX_BYTES = 16 << 20
+BACKUP_COUNT = 3
+# how many finished traces may wait for the writer thread, those that come in beyond that are dropped.
+MAX_PENDING = 10000
+BROKER_TRACE_PATH = "broker_trace.jsonl"
+CLIENT_TRACE_PATH = "client_trace.jsonl"
+
+
+class Trace:
+    def __init__(self, tracer: "Tracer", kind: str, request_id: int, client_name: str):
+        self.tracer = tracer
+        self.kind = kind
+        self.request_id = request_id
+        self.client_name = client_name
+        self.start = time.monotonic()
+        # the phases so far, as (name, start, end) tuples. A phase starts where the last one ended.
+        self.phases = []
+        self.last = self.start
+        # written along with the trace, e.g. the queue and the number of messages.
+        self.attributes = {}
+
+    def mark(self, phase: str):
+        """Ends the current phase, which is then called phase."""
+
+        now = time.monotonic()
+        self.phases.append((phase, self.last, now))
+        self.last = now
+
+    def set(self, **attributes):
+        """Adds attributes to the trace."""
+
+        self.attributes.update(attributes)
+
+    def set_request_id(self, request_id: int):
+        """Sets the request id of the trace, unless it has one: a trace carries the request id
+        of its first request."""
+
+        if not self.request_id:
+            self.request_id = request_id
+
+    def finish(self):
+        """Ends the trace, and writes it to the trace file."""
+
+        self.tracer.write(self)
+
+
+class NullTrace:
+    """The trace of a request that is not traced."""
+
+    def mark(self, phase: str):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def set_request_id(self, request_id: int):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer:
+    def __init__(self, path: str, side: str, sample_rate: float = SAMPLE_RATE, max_bytes: int = MAX_BYTES,
+                 backup_count: int = BACKUP_COUNT):
+        self.path = path
+        # "server" or "client".
+        self.side = side
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # opened once the first trace is written, and appended to. Only used by the writer thread.
+        self.file = None
+        # the records of the traces waiting for the writer thread.
+        self.pending = deque()
+        # notified once a trace comes in, or the tracer is closed.
+        self.pending_cond = threading.Condition()
+        self.closed = False
+        # how many traces were dropped, and how many times writing (or rotating) the trace file failed.
+        self.dropped = 0
+        self.errors = 0
+        self.writer_thread = threading.Thread(target=self._write_pending, name="trace_writer", daemon=True)
+        self.writer_thread.start()
+
+    def start(self, kind: str, request_id: int = 0, client_name: str = ""):
+        """:returns a new Trace for a request of kind, or NULL_TRACE if it is not sampled."""
+
+        if random.random() >= self.sample_rate:
+            return NULL_TRACE
+        return Trace(self, kind, request_id, client_name)
+
+    def write(self, trace: Trace):
+        """Hands trace to the writer thread, which writes it to the trace file as a single
+        line. Never waits for the file, and never fails: a trace that cannot be written is
+        dropped (see dropped)."""
+
+        record = {"side": self.side, "kind": trace.kind, "request_id": trace.request_id,
+                  "client": trace.client_name, "pid": os.getpid(), "start": trace.start, "end": trace.last,
+                  "phases": [[name, start, end - start] for name, start, end in trace.phases]}
+        record.update(trace.attributes)
+        with self.pending_cond:
+            if self.closed or len(self.pending) >= MAX_PENDING:
+                self.dropped += 1
+                return
+            self.pending.append(record)
+            self.pending_cond.notify()
+
+    def _write_pending(self):
+        """The writer thread. Writes the traces handed to it, until the tracer is closed."""
+
+        while True:
+            with self.pending_cond:
+                while not self.pending and not self.closed:
+                    self.pending_cond.wait()
+                records, self.pending = self.pending, deque()
+                closed = self.closed
+            if records:
+                self._write_records(records)
+            if closed:
+                return
+
+    def _write_records(self, records: deque):
+        """Writes records to the trace file, a line each, rotating the file once it is full.
+        If that fails, the records not written yet are dropped, and the file is opened again
+        for the next ones."""
+
+        written = 0
+        try:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+            for record in records:
+                line = (json.dumps(record) + "\n").encode("utf-8")
+                if self.file.tell() and self.file.tell() + len(line) > self.max_bytes:
+                    self._rotate()
+                self.file.write(line)
+                written += 1
+            self.file.flush()
+        except OSError:
+            self.errors += 1
+            self.dropped += len(records) - written
+            self._close_file()
+
+    def _close_file(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+
+    def _rotate(self):
+        """Moves the trace file to <path>.1 (and <path>.1 to <path>.2, ...), dropping the
+        oldest, and starts a new one."""
+
+        self.file.close()
+        self.file = None
+        for idx in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{idx}"):
+                os.replace(f"{self.path}.{idx}", f"{self.path}.{idx + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "ab")
+
+    def close(self):
+        """Writes the traces still waiting, and closes the trace file."""
+
+        with self.pending_cond:
+            self.closed = True
+            self.pending_cond.notify()
+        self.writer_thread.join()
+        self._close_file()
+
+
+def read_traces(paths: [str]):
+    """Yields every trace in the trace files paths, and their rotated backups."""
+
+    for path in paths:
+        backups = []
+        idx = 1
+        while os.path.exists(f"{path}.{idx}"):
+            backups.append(f"{path}.{idx}")
+            idx += 1
+        for each_path in reversed(backups + [path]):
+            if not os.path.exists(each_path):
+                continue
+            with open(each_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a file whose writer was killed mid-write.
+                        continue
+
+
+def percentile(sorted_values: [float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Breaks the latency of traced requests down by phase.")
+    parser.add_argument("paths", nargs="+", help="trace files (their rotated backups are read as well)")
+    args = parser.parse_args()
+
+    # the total time of every trace, and the time of every phase in it, per (side, kind).
+    totals = {}
+    phases = {}
+    for trace in read_traces(args.paths):
+        key = (trace["side"], trace["kind"])
+        totals.setdefault(key, []).append(trace["end"] - trace["start"])
+        # a phase may come up more than once (e.g. once per page), its times are added up.
+        trace_phases = {}
+        for name, start, duration in trace["phases"]:
+            trace_phases[name] = trace_phases.get(name, 0.0) + duration
+        for name, duration in trace_phases.items():
+            phases.setdefault(key, {}).setdefault(name, []).append(duration)
+
+    if not totals:
+        print("No traces found.")
+        return
+    for key in sorted(totals):
+        durations = sorted(totals[key])
+        total_time = sum(durations)
+        print(f"\n{key[0]} {key[1]}: {len(durations)} traces, p50 {percentile(durations, 0.5) * 1000:.3f} ms, "
+              f"p99 {percentile(durations, 0.99) * 1000:.3f} ms")
+        print(f"    {'phase':<12} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10} {'share':>7}")
+        for name, phase_durations in phases.get(key, {}).items():
+            phase_durations = sorted(phase_durations)
+            phase_time = sum(phase_durations)
+            print(f"    {name:<12} {phase_time / len(phase_durations) * 1000:>10.3f} "
+                  f"{percentile(phase_durations, 0.5) * 1000:>10.3f} {percentile(phase_durations, 0.99) * 1000:>10.3f} "
+                  f"{phase_time / total_time if total_time else 0:>7.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,8 @@
 
 """This is the utility module for the client/server application. It contains a dialog class
 which will prompt the user to select an action (Upload/Check).
-It also contains any and all functions that are shared between the server and the
-client."""
+The clients themselves are kept in a session registry (see sessions.py), shared by the
+server and the client."""
 
 __author__ = "Hannan Khan"
 __credits__ = ["Hannan Khan"]
@@ -13,12 +13,11 @@ __maintainer__ = "Hannan Khan"
 __email__ = "hannan.khan@mavs.uta.edu"
 
 from PyQt5 import QtWidgets, QtGui
-from PyQt5.QtWidgets import QMainWindow
 from PyQt5.QtCore import Qt
 
 
 class UploadCheckDialog(QtWidgets.QDialog):
-    def __init__(self, current_font: QtGui.QFont, client_name: str, client_idx: int):
+    def __init__(self, current_font: QtGui.QFont, client_name: str, session_id: int):
         super(UploadCheckDialog, self).__init__()
 
         # reference:
@@ -29,7 +28,7 @@ class UploadCheckDialog(QtWidgets.QDialog):
         self.selection = -1
 
         self.client_name = client_name
-        self.client_idx = client_idx
+        self.session_id = session_id
 
         self.client_name_label = QtWidgets.QLabel()
         self.client_name_label.setText(self.client_name + ":")
@@ -63,15 +62,3 @@ class UploadCheckDialog(QtWidgets.QDialog):
             self.selection = -1
 
         self.close()
-
-
-def get_client_idx(self: QMainWindow = None, client_name: str = "") -> int:
-    """Gets the clients index in the list based on its name.
-    This func is used in both client.py and server.py."""
-
-    for i in range(0, self.client_list_widget.count()):
-        item = self.client_list_widget.item(i)
-        if item.text() == client_name:
-            return i
-
-    return -1